@@ -0,0 +1,77 @@
+# Бенчмарк профиля SQLite на пути вставки бронирования (Database.add_booking).
+# Сравнивает записи/сек: настройки SQLite по умолчанию (rollback journal,
+# synchronous=FULL) против профиля из переменных окружения DB_*.
+# Параллельные писатели имитируют пик (вечер пятницы): их записи
+# склеиваются групповым коммитом, в выводе видно число реальных COMMIT.
+# Запуск: python bench_db_profile.py [число_вставок] [писателей] [путь_к_боту]
+
+import asyncio
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+WRITERS = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+BOT_FILE = sys.argv[3] if len(sys.argv) > 3 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 "vera_assistant_v0.4.1.py")
+
+LEGACY_PROFILE = {"journal_mode": "DELETE", "synchronous": "FULL"}
+
+
+def load_bot(workdir: str):
+    # бот создаёт схему при импорте — направляем его файлы во временный каталог
+    os.environ["DB_FILE"] = os.path.join(workdir, "schema.db")
+    os.environ["KEYFILE"] = os.path.join(workdir, "bench.key")
+    spec = importlib.util.spec_from_file_location("vera_bench_bot", BOT_FILE)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def make_db(mod, path: str, pragmas):
+    db = mod.Database(path, pragmas=pragmas)
+    for (sql,) in mod.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name='bookings' AND sql IS NOT NULL").fetchall():
+        db.conn.execute(sql)
+    db.conn.commit()
+    return db
+
+
+async def run_inserts(db, n: int, writers: int) -> float:
+    args = (42, "Бенчмарк Тестович", "+70000000000", "01.01.2030 19:00", "bench", "", "pending",
+            "2030-01-01 19:00:00")
+
+    async def writer(count: int):
+        for _ in range(count):
+            await db.add_booking(*args)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(n // writers + (i < n % writers)) for i in range(writers)))
+    return time.perf_counter() - started
+
+
+async def bench(mod, workdir: str, name: str, pragmas):
+    db = make_db(mod, os.path.join(workdir, f"{name}.db"), pragmas)
+    try:
+        elapsed = await run_inserts(db, N, WRITERS)
+    finally:
+        db.close()
+    profile = ", ".join(f"{k}={v}" for k, v in db.pragmas.items()) or "—"
+    print(f"{name:<8} {N / elapsed:>10.0f} записей/с  {db.commits / elapsed:>8.0f} коммитов/с  "
+          f"({elapsed:.2f} с; {profile})")
+    return N / elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        mod = load_bot(workdir)
+        before = asyncio.run(bench(mod, workdir, "legacy", LEGACY_PROFILE))
+        after = asyncio.run(bench(mod, workdir, "profile", None))
+        mod.db.close()
+        print(f"ускорение: x{after / before:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,28 +8,50 @@
 # - Меню управления, Кухня (Stop-list / To-go list) — сохранены и работают
 # - Управление фото (замена/удаление) — сохранено
 # - Везде где уместно — «Назад» (кроме главного меню)
-# Требования: aiogram>=3.7.0, apscheduler, sqlite3, (опционально cryptography)
-# Установка: pip install aiogram apscheduler cryptography
+# Требования: aiogram>=3.7.0, apscheduler, sqlite3, (опционально cryptography, sqlalchemy)
+# Установка: pip install aiogram apscheduler cryptography sqlalchemy
 
 import asyncio
 import logging
 import sqlite3
 import os
 import csv
+import codecs
+import gzip
+import io
+import json
+import time
+import functools
+import hashlib
+import itertools
+import math
+import signal
+import tempfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Optional, List, Tuple, Dict, Any
+from typing import Optional, List, Tuple, Dict, Any, Iterable, Iterator
 
-from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram import Bot, Dispatcher, F, Router, types, BaseMiddleware
+from aiogram.methods import AnswerCallbackQuery
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, DataNotDictLikeError
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import (Message, CallbackQuery, InlineKeyboardMarkup,
-                           InlineKeyboardButton, InputMediaPhoto)
+                           InlineKeyboardButton, InputMediaPhoto, InputFile)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import FormData, web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.memory import MemoryJobStore
 
 PHOTO_MSG_CACHE = {}  # admin_user_id -> list[tuple(chat_id, message_id)]
 
@@ -42,6 +64,71 @@ ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "1077878777").split(","
 DB_FILE = os.environ.get("DB_FILE", "vera.db")
 VERSION = "v0.4.0"
 
+# Профиль хранилища SQLite (PRAGMA при открытии соединения).
+# Пустое значение или "default" — оставить настройку SQLite по умолчанию.
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_MMAP_SIZE = os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024))  # байт
+DB_CACHE_SIZE = os.environ.get("DB_CACHE_SIZE", "-16000")              # <0 — в КиБ
+DB_TEMP_STORE = os.environ.get("DB_TEMP_STORE", "MEMORY")
+DB_BUSY_TIMEOUT = os.environ.get("DB_BUSY_TIMEOUT", "5000")            # мс
+# Групповой коммит: записи копятся до DB_COMMIT_BATCH штук или DB_COMMIT_DELAY_MS мс.
+# 0 — до следующего шага event loop; пока идёт COMMIT, новые записи всё равно
+# собираются в следующую пачку, так что под нагрузкой окно растёт само.
+DB_COMMIT_BATCH = int(os.environ.get("DB_COMMIT_BATCH", "64"))
+DB_COMMIT_DELAY_MS = float(os.environ.get("DB_COMMIT_DELAY_MS", "0"))
+# Импорт CSV: строк в одной пачке executemany; кусков по 64 КиБ в очереди загрузки
+IMPORT_BATCH = int(os.environ.get("IMPORT_BATCH", "1000"))
+IMPORT_QUEUE_CHUNKS = int(os.environ.get("IMPORT_QUEUE_CHUNKS", "16"))
+# Экспорт CSV: размер пачки чтения, порог выгрузки буфера на диск, сжатие ("", gzip, zip)
+EXPORT_CHUNK = int(os.environ.get("EXPORT_CHUNK", "1000"))
+EXPORT_SPOOL_MAX = int(os.environ.get("EXPORT_SPOOL_MAX", str(4 * 1024 * 1024)))  # байт
+EXPORT_COMPRESSION = os.environ.get("EXPORT_COMPRESSION", "").strip().lower()
+
+# Получение обновлений: polling (по умолчанию) или webhook со встроенным aiohttp-сервером.
+# В webhook-режиме Telegram (или локальный стенд из TELEGRAM_API_URL) шлёт POST на
+# WEBHOOK_URL; обратный прокси передаёт его на WEBHOOK_HOST:WEBHOOK_PORT + WEBHOOK_PATH.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")             # https://bot.example.com/tg
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/tg")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+# пусто — выводится из токена: у всех воркеров один и тот же секрет
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+# несколько процессов на одном порту (SO_REUSEPORT), ядро делит соединения между ними.
+# Процессы видят общую БД, но не память друг друга: кэши процесса (роли, FSM)
+# по умолчанию выключены, а порядок апдейтов одного чата соблюдается только внутри
+# процесса — соседние апдейты чата могут попасть в разные воркеры.
+WEBHOOK_REUSE_PORT = os.environ.get("WEBHOOK_REUSE_PORT", "0") == "1"
+MULTI_WORKER = BOT_MODE == "webhook" and WEBHOOK_REUSE_PORT
+# планировщик (напоминания, дайджест, чистки) — ровно в одном процессе: ему RUN_SCHEDULER=1,
+# остальным воркерам 0
+RUN_SCHEDULER = os.environ.get("RUN_SCHEDULER", "0" if MULTI_WORKER else "1") == "1"
+# Обработка обновлений: внутри чата — строго по очереди, между чатами — параллельно.
+# UPDATE_CONCURRENCY — хендлеров одновременно; UPDATE_QUEUE — апдейтов в работе вместе
+# с ожидающими (лимит polling/webhook); CHAT_QUEUE — очередь одного чата, сверх неё
+# нажатия кнопок отбрасываются, на лишние сообщения бот просит подождать.
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+UPDATE_QUEUE = int(os.environ.get("UPDATE_QUEUE", "256"))
+CHAT_QUEUE = int(os.environ.get("CHAT_QUEUE", "8"))
+# Через сколько секунд нажатая кнопка подтверждается сама, если хендлер ещё не ответил
+CALLBACK_ACK_DELAY = float(os.environ.get("CALLBACK_ACK_DELAY", "0.1"))
+# Свой Bot API сервер (telegram-bot-api --local или тестовый стенд); пусто — api.telegram.org
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+TELEGRAM_API_LOCAL = os.environ.get("TELEGRAM_API_LOCAL", "0") == "1"
+
+# FSM (незаконченные диалоги) хранится в DB_FILE; сессия без изменений дольше FSM_TTL
+# секунд сбрасывается и удаляется фоновой чисткой раз в FSM_SWEEP_INTERVAL секунд.
+FSM_TTL = float(os.environ.get("FSM_TTL", str(24 * 3600)))
+FSM_SWEEP_INTERVAL = int(os.environ.get("FSM_SWEEP_INTERVAL", "600"))
+# горячие сессии в памяти процесса; 0 — без кэша (несколько воркеров на одной БД)
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "0" if MULTI_WORKER else "2048"))
+
+# Идемпотентность создания брони (повторная доставка, двойное нажатие): ключи живут
+# IDEMPOTENCY_TTL секунд; IDEMPOTENCY_CAPACITY — расчётное число ключей для Bloom-фильтра
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", str(7 * 24 * 3600)))
+IDEMPOTENCY_CAPACITY = int(os.environ.get("IDEMPOTENCY_CAPACITY", "100000"))
+
 # -----------------------------------------------------------------------------
 # Логирование
 # -----------------------------------------------------------------------------
@@ -52,16 +139,314 @@ logging.basicConfig(
 )
 logger = logging.getLogger("vera-bot")
 
+# -----------------------------------------------------------------------------
+# Планировщик: задачи хранятся в DB_FILE (если есть sqlalchemy)
+# -----------------------------------------------------------------------------
+try:
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    from sqlalchemy import create_engine, event as sa_event
+    HAS_SQLALCHEMY = True
+except Exception:
+    HAS_SQLALCHEMY = False
+
+SCHEDULER_MISFIRE_GRACE = int(os.environ.get("SCHEDULER_MISFIRE_GRACE", "3600"))  # сек.
+
+def _jobstore_engine():
+    # тот же файл, что у Database, — и тот же профиль PRAGMA (busy_timeout, synchronous…);
+    # профиль берётся при подключении, когда db уже открыта и перевела файл в WAL
+    engine = create_engine(f"sqlite:///{DB_FILE}", connect_args={"check_same_thread": False})
+
+    @sa_event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_conn, _record):
+        for name, value in db.pragmas.items():
+            if name != "journal_mode":  # режим журнала хранится в файле БД
+                dbapi_conn.execute(f"PRAGMA {name}={value}")
+
+    return engine
+
+def make_scheduler() -> AsyncIOScheduler:
+    # add_job/remove_job коммитят в DB_FILE синхронно — вызывать их через db.run
+    if HAS_SQLALCHEMY:
+        jobstore = SQLAlchemyJobStore(engine=_jobstore_engine(), tablename="apscheduler_jobs")
+    else:
+        logger.warning("sqlalchemy не установлен — задачи планировщика хранятся только в памяти")
+        jobstore = MemoryJobStore()
+    return AsyncIOScheduler(
+        jobstores={"default": jobstore},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": SCHEDULER_MISFIRE_GRACE}
+    )
+
 # -----------------------------------------------------------------------------
 # Бот и диспетчер
 # -----------------------------------------------------------------------------
-bot = Bot(API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+class KeyboardCachingSession(AiohttpSession):
+    """aiohttp-сессия, которая не сериализует клавиатуры из реестра заново.
+
+    aiogram на каждый запрос делает model_dump всего метода вместе с
+    reply_markup; для зарегистрированной клавиатуры подставляем готовый JSON.
+    """
+
+    def build_form_data(self, bot: Bot, method):
+        markup = getattr(method, "reply_markup", None)
+        if markup is None or _KB_REGISTRY.get(id(markup)) is not markup:
+            return super().build_form_data(bot=bot, method=method)
+        cached = _KB_JSON.get(id(markup))
+        if cached is None:
+            cached = _KB_JSON[id(markup)] = self.prepare_value(markup, bot=bot, files={})
+        form = FormData(quote_fields=False)
+        files: Dict[str, Any] = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", cached)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+def telegram_api() -> TelegramAPIServer:
+    if not TELEGRAM_API_URL:
+        return PRODUCTION
+    return TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)
+
+class ChatEventIsolation(BaseEventIsolation):
+    """Изоляция событий FSM: апдейты одного ключа FSM (чат + пользователь) — по очереди.
+
+    FSMContextMiddleware берёт этот замок до чтения состояния, поэтому два быстрых
+    сообщения на одном шаге анкеты не попадут в один и тот же хендлер. Разные ключи
+    идут параллельно, но хендлеров одновременно не больше limit. Замок ключа живёт,
+    пока его кто-то держит или ждёт.
+    """
+
+    def __init__(self, limit: int = 32):
+        self._slots = asyncio.Semaphore(limit)
+        # ключ FSM -> [замок, апдейтов у замка]
+        self._locks: Dict[StorageKey, list] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def close(self):
+        self._locks.clear()
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_state (тот же DB_FILE) с LRU-кэшем в памяти.
+
+    Каждое изменение пишется сквозь кэш групповым коммитом, так что начатая
+    бронь переживает деплой. Сессия, не менявшаяся дольше ttl секунд, читается
+    как пустая; строки удаляет sweep() из планировщика. В памяти — не больше
+    maxsize последних сессий, сколько бы гостей ни бросило диалог.
+    """
+
+    EMPTY: Tuple[Optional[str], Dict[str, Any], float] = (None, {}, 0.0)
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 86400.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._keys = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        # ключ -> (state, data, updated_at); пустая сессия тоже кэшируется
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, k: str, rec):
+        if self.maxsize <= 0:
+            return
+        self._cache[k] = rec
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _get(self, key: StorageKey):
+        k = self._keys.build(key)
+        rec = self._cache.get(k)
+        if rec is not None:
+            self.hits += 1
+            self._cache.move_to_end(k)
+        else:
+            self.misses += 1
+            row = await db.fsm_load(k)
+            rec = self._cache.get(k)  # пока шёл запрос, сессию могли изменить
+            if rec is None:
+                rec = (row["state"], json.loads(row["data"] or "{}"), row["updated_at"]) if row else self.EMPTY
+                self._remember(k, rec)
+        if rec[2] and rec[2] < time.time() - self.ttl:
+            rec = self.EMPTY
+        return k, rec
+
+    async def _put(self, k: str, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data:
+            if self._cache.get(k) == self.EMPTY:
+                return  # state.clear() в уже пустой сессии — без записи
+            self._remember(k, self.EMPTY)
+            await db.fsm_delete(k)
+            return
+        now = time.time()
+        self._remember(k, (state, data, now))
+        await db.fsm_save(k, state, json.dumps(data, ensure_ascii=False) if data else None, now)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, (_, data, _) = await self._get(key)
+        await self._put(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key))[1][0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        k, (state, _, _) = await self._get(key)
+        await self._put(k, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(key))[1][1].copy()
+
+    async def close(self) -> None:
+        pass
+
+    async def sweep(self) -> int:
+        cutoff = time.time() - self.ttl
+        for k in [k for k, rec in self._cache.items() if rec[2] and rec[2] < cutoff]:
+            del self._cache[k]
+        return await db.fsm_sweep(cutoff)
+
+    def stats(self) -> str:
+        return f"FSM: {len(self._cache)}/{self.maxsize} в памяти, попаданий {self.hits}, промахов {self.misses}"
+
+bot = Bot(API_TOKEN, session=KeyboardCachingSession(api=telegram_api()),
+          default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+storage = SQLiteStorage(maxsize=FSM_CACHE_SIZE, ttl=FSM_TTL)
+# FSM-middleware подключается ниже, после очереди чата: сначала отсев лишнего,
+# потом замок ключа FSM, и только под ним чтение состояния
+dp = Dispatcher(storage=storage, events_isolation=ChatEventIsolation(limit=UPDATE_CONCURRENCY), disable_fsm=True)
 router = Router()
 dp.include_router(router)
 
-scheduler = AsyncIOScheduler()
+scheduler = make_scheduler()
+
+# -----------------------------------------------------------------------------
+# Уведомления staff/admin (фоновая очередь с лимитами Telegram)
+# -----------------------------------------------------------------------------
+class TokenBucket:
+    # классический token bucket: rate токенов в секунду, не больше capacity за раз
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class NotificationDispatcher:
+    """Фоновая рассылка уведомлений staff/admin.
+
+    Хендлеры только кладут сообщения в очередь (enqueue), отправкой занимается
+    ограниченный пул воркеров с учётом лимитов Telegram: общий token bucket
+    и минимальный интервал между сообщениями в один чат. На RetryAfter
+    ждём указанное время, на сетевые ошибки — повтор с экспоненциальной паузой.
+    """
+
+    def __init__(self, workers: int = 4, global_rate: float = 25.0, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, queue_size: int = 10000):
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(global_rate)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._chat_next: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, chat_id: int, text: str, **kwargs) -> bool:
+        try:
+            self._queue.put_nowait((chat_id, text, kwargs))
+            return True
+        except asyncio.QueueFull:
+            logger.error("notification queue is full, dropped message for %s", chat_id)
+            return False
+
+    def enqueue_many(self, chat_ids, text: str, **kwargs) -> int:
+        return sum(1 for cid in chat_ids if self.enqueue(cid, text, **kwargs))
+
+    async def _wait_slot(self, chat_id: int):
+        # глобальная пауза после RetryAfter, интервал на чат, затем общий лимит
+        now = time.monotonic()
+        if self._paused_until > now:
+            await asyncio.sleep(self._paused_until - now)
+        now = time.monotonic()
+        next_at = max(self._chat_next.get(chat_id, 0.0), now)
+        self._chat_next[chat_id] = next_at + self.per_chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        await self._bucket.acquire()
+
+    async def _send(self, chat_id: int, text: str, kwargs: Dict[str, Any]):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_slot(chat_id)
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return
+            except TelegramRetryAfter as e:
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning("RetryAfter %ss while notifying %s", e.retry_after, chat_id)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                await asyncio.sleep(min(2 ** attempt, 30))
+                logger.warning("notify %s failed (attempt %d): %s", chat_id, attempt + 1, e)
+            except Exception as e:
+                # заблокировали бота, чат не найден и т.п. — повтор не поможет
+                logger.error("notify %s error: %s", chat_id, e)
+                return
+        logger.error("notify %s: retries exhausted", chat_id)
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs = await self._queue.get()
+            try:
+                await self._send(chat_id, text, kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("notification worker error: %s", e)
+            finally:
+                self._queue.task_done()
+
+notifier = NotificationDispatcher(
+    workers=int(os.environ.get("NOTIFY_WORKERS", "4")),
+    global_rate=float(os.environ.get("NOTIFY_GLOBAL_RATE", "25")),
+    per_chat_interval=float(os.environ.get("NOTIFY_CHAT_INTERVAL", "1.0")),
+)
 
 # -----------------------------------------------------------------------------
 # Роли
@@ -90,6 +475,9 @@ class UserEditFSM(StatesGroup):
     field = State()
     value = State()
 
+class UserPickFSM(StatesGroup):
+    query = State()
+
 class MenuAddFSM(StatesGroup):
     title = State()
     description = State()
@@ -104,8 +492,443 @@ class PhotoReplaceFSM(StatesGroup):
 # -----------------------------------------------------------------------------
 # База данных
 # -----------------------------------------------------------------------------
-conn = sqlite3.connect(DB_FILE)
-conn.row_factory = sqlite3.Row
+PRAGMA_ORDER = ("busy_timeout", "journal_mode", "synchronous", "cache_size", "temp_store", "mmap_size")
+PRAGMA_CHOICES = {
+    "journal_mode": {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"},
+    "synchronous": {"OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"},
+    "temp_store": {"DEFAULT", "FILE", "MEMORY", "0", "1", "2"},
+}
+
+def db_profile() -> Dict[str, str]:
+    return {
+        "busy_timeout": DB_BUSY_TIMEOUT,
+        "journal_mode": DB_JOURNAL_MODE,
+        "synchronous": DB_SYNCHRONOUS,
+        "cache_size": DB_CACHE_SIZE,
+        "temp_store": DB_TEMP_STORE,
+        "mmap_size": DB_MMAP_SIZE,
+    }
+
+class Database:
+    """Доступ к SQLite вне event loop.
+
+    Все запросы выполняются в одном выделенном потоке (sqlite3-соединение
+    не рассчитано на параллельную запись из нескольких потоков), у каждой
+    операции — свой курсор, поэтому конкурентные хендлеры не видят чужих
+    результатов. Хендлеры вызывают только async-методы.
+    """
+
+    def __init__(self, path: str, pragmas: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.pragmas = self._apply_pragmas(db_profile() if pragmas is None else pragmas)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vera-db")
+        # групповой коммит (живёт в event loop)
+        self.commit_batch = max(1, DB_COMMIT_BATCH)
+        self.commit_delay = max(0.0, DB_COMMIT_DELAY_MS) / 1000
+        self._pending: List[Tuple[Any, tuple, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: set = set()
+        self._inflight = 0
+        self.commits = 0
+        self.writes = 0
+
+    def _apply_pragmas(self, pragmas: Dict[str, str]) -> Dict[str, Any]:
+        # busy_timeout первым: смена journal_mode требует блокировки файла
+        applied = {}
+        for name in PRAGMA_ORDER:
+            value = (pragmas.get(name) or "").strip()
+            if not value or value.lower() == "default":
+                continue
+            allowed = PRAGMA_CHOICES.get(name)
+            if allowed is not None:
+                value = value.upper()
+                ok = value in allowed
+            else:
+                ok = value.lstrip("-").isdigit()
+            if not ok:
+                logger.warning("PRAGMA %s=%r не поддерживается — пропускаю", name, value)
+                continue
+            self.conn.execute(f"PRAGMA {name}={value}")
+            row = self.conn.execute(f"PRAGMA {name}").fetchone()
+            applied[name] = row[0] if row else None
+        if applied:
+            logger.info("SQLite %s: %s", self.path, ", ".join(f"{k}={v}" for k, v in applied.items()))
+        return applied
+
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.conn.close()
+
+    def connect_aux(self) -> sqlite3.Connection:
+        # отдельное соединение для долгих операций (экспорт, импорт) в потоке пула,
+        # чтобы не занимать поток БД; профиль PRAGMA — как у основного
+        conn = sqlite3.connect(self.path)
+        for name, value in self.pragmas.items():
+            if name != "journal_mode":  # режим журнала хранится в файле БД
+                conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    # ---- групповой коммит ----
+    async def write(self, fn, *args):
+        """Выполняет fn(*args) в потоке БД внутри общей транзакции.
+
+        Записи конкурентных хендлеров копятся commit_delay секунд (или до
+        commit_batch штук) и фиксируются одним COMMIT; await возвращается
+        только после него. Каждая запись — в своём SAVEPOINT, поэтому ошибка
+        одной не откатывает соседние. fn не должна сама делать commit.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((fn, args, fut))
+        if len(self._pending) >= self.commit_batch:
+            self._start_flush()
+        elif self._flush_handle is None and not self._inflight:
+            # пока идёт предыдущий коммит, записи просто копятся — он сам запустит следующий
+            self._flush_handle = loop.call_later(self.commit_delay, self._start_flush)
+        return await fut
+
+    async def flush(self):
+        # дождаться фиксации всего накопленного (перед остановкой)
+        self._start_flush()
+        while self._flush_tasks:
+            await asyncio.gather(*list(self._flush_tasks), return_exceptions=True)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self._inflight += 1
+        task = asyncio.get_running_loop().create_task(self._flush(batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await self.run(self._commit_batch, [(fn, args) for fn, args, _ in batch])
+        except Exception as e:
+            logger.exception("Групповой коммит не удался (%d записей)", len(batch))
+            results = [e] * len(batch)
+        finally:
+            self._inflight -= 1
+        for (_, _, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+        if self._pending and not self._inflight:
+            self._start_flush()
+
+    def _commit_batch(self, ops) -> list:
+        results = []
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        try:
+            for fn, args in ops:
+                self.conn.execute("SAVEPOINT write_op")
+                try:
+                    results.append(fn(*args))
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO write_op")
+                    results.append(e)
+                self.conn.execute("RELEASE write_op")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.commits += 1
+        self.writes += len(ops)
+        return results
+
+    # ---- базовые операции (выполняются в потоке БД) ----
+    def _fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        cur = self.conn.execute(sql, params)
+        try:
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        cur = self.conn.execute(sql, params)
+        try:
+            return cur.fetchone()
+        finally:
+            cur.close()
+
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        # без commit: вызывается внутри транзакции группового коммита
+        cur = self.conn.execute(sql, params)
+        try:
+            return cur.lastrowid
+        finally:
+            cur.close()
+
+    def _executemany(self, sql: str, seq) -> int:
+        # без commit: как и _execute, фиксируется групповым коммитом
+        cur = self.conn.executemany(sql, seq)
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return await self.run(self._fetchall, sql, params)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run(self._fetchone, sql, params)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        return await self.write(self._execute, sql, params)
+
+    async def executemany(self, sql: str, seq) -> int:
+        return await self.write(self._executemany, sql, list(seq))
+
+    # ---- пользователи ----
+    async def get_role_value(self, user_id: int) -> Any:
+        r = await self.fetchone("SELECT role FROM users WHERE user_id=?", (user_id,))
+        return r["role"] if r else None
+
+    async def get_user(self, user_id: int) -> Optional[sqlite3.Row]:
+        return await self.fetchone("SELECT * FROM users WHERE user_id=?", (user_id,))
+
+    async def list_users(self) -> List[sqlite3.Row]:
+        return await self.fetchall("SELECT user_id, fullname, username FROM users ORDER BY COALESCE(fullname,'') ASC")
+
+    def _pick_users(self, cursor_uid: Optional[int], backward: bool, roles: Optional[List[int]],
+                    name_prefix: Optional[str], username_prefix: Optional[str], limit: int) -> Optional[List[sqlite3.Row]]:
+        # keyset: (ключ, user_id) по индексам idx_users_name / idx_users_role_name / idx_users_username;
+        # каждая страница — ограниченный индексный запрос, сколько бы гостей ни было в таблице
+        key = USER_PICK_KEYS["username" if username_prefix else "name"]
+        where, params = [], []
+        if name_prefix:
+            where.append(f"{key} >= ? AND {key} < ?")
+            params += [name_prefix, name_prefix + PREFIX_TOP]
+        if username_prefix:
+            where.append(f"{key} >= ? AND {key} < ?")
+            params += [username_prefix, username_prefix + PREFIX_TOP]
+        if cursor_uid is not None:
+            row = self._fetchone(f"SELECT {key} AS k FROM users WHERE user_id=?", (cursor_uid,))
+            if row is None or row["k"] is None:
+                # курсор удалён (или потерял @username) — продолжить с того же места нельзя
+                return None
+            op, strict = ("<=", "<") if backward else (">=", ">")
+            where.append(f"{key} {op} ? AND ({key} {strict} ? OR user_id {strict} ?)")
+            params += [row["k"], row["k"], cursor_uid]
+        order = "DESC" if backward else "ASC"
+        sql = (f"SELECT user_id, fullname, username, role FROM users WHERE {{}} "
+               f"ORDER BY {key} {order}, user_id {order} LIMIT ?")
+        if not roles:
+            rows = self._fetchall(sql.format(" AND ".join(where) or "1"), (*params, limit))
+        else:
+            # по запросу на роль (индекс role, ключ, user_id) и слияние — вместо IN, который сканирует всех
+            rows = []
+            for role in roles:
+                rows += self._fetchall(sql.format(" AND ".join(["role = ?"] + where)), (role, *params, limit))
+            rows.sort(key=lambda r: (_user_pick_key(r, bool(username_prefix)), r["user_id"]), reverse=backward)
+            rows = rows[:limit]
+        return rows[::-1] if backward else rows
+
+    async def pick_users(self, cursor_uid: Optional[int] = None, backward: bool = False,
+                         roles: Optional[List[int]] = None, name_prefix: Optional[str] = None,
+                         username_prefix: Optional[str] = None, limit: int = 20) -> Optional[List[sqlite3.Row]]:
+        # None — пользователя-курсора больше нет в списке
+        return await self.run(self._pick_users, cursor_uid, backward, roles, name_prefix, username_prefix, limit)
+
+    async def list_user_ids_by_roles(self, roles: List[int]) -> List[int]:
+        rows = await self.fetchall("SELECT user_id FROM users WHERE role IN (%s)" % ",".join("?" * len(roles)),
+                                   tuple(roles))
+        return [r["user_id"] for r in rows]
+
+    def _ensure_user(self, user_id: int, username: Optional[str]):
+        row = self._fetchone("SELECT username FROM users WHERE user_id=?", (user_id,))
+        if row is None:
+            self.conn.execute("INSERT INTO users (user_id, username, role) VALUES (?,?,?)",
+                              (user_id, username, ROLE_GUEST))
+        elif username and row["username"] != username:
+            self.conn.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+
+    async def ensure_user(self, user_id: int, username: Optional[str] = None):
+        await self.write(self._ensure_user, user_id, username)
+
+    def _upsert_user(self, user_id: int, fields: Dict[str, Any]):
+        exists = self._fetchone("SELECT user_id FROM users WHERE user_id=?", (user_id,)) is not None
+        if not exists:
+            self.conn.execute(
+                "INSERT INTO users (user_id, role, fullname, phone, username, passport) VALUES (?,?,?,?,?,?)",
+                (user_id, fields.get("role", ROLE_GUEST), fields.get("fullname"), fields.get("phone"),
+                 fields.get("username"), fields.get("passport")))
+        elif fields:
+            self.conn.execute(f"UPDATE users SET {', '.join(k + '=?' for k in fields)} WHERE user_id=?",
+                              (*fields.values(), user_id))
+
+    async def upsert_user(self, user_id: int, **fields):
+        # None — «не менять»; в UPDATE попадают только переданные поля
+        fields = {k: v for k, v in fields.items() if v is not None and k in USER_FIELDS}
+        await self.write(self._upsert_user, user_id, fields)
+
+    async def delete_user(self, user_id: int):
+        await self.execute("DELETE FROM users WHERE user_id=?", (user_id,))
+
+    # ---- бронирования ----
+    BOOKING_INSERT = """
+        INSERT INTO bookings (user_id, fullname, phone, datetime, source, notes, status, consent, starts_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    async def add_booking(self, user_id: Optional[int], fullname: str, phone: str, dt_text: str,
+                          source: str = "", notes: str = "", status: str = "pending",
+                          consent: str = "Нет") -> int:
+        return await self.execute(self.BOOKING_INSERT, (user_id, fullname, phone, dt_text, source, notes, status,
+                                                        consent, booking_starts_at(dt_text)))
+
+    def _add_booking_once(self, key: str, params: tuple) -> Optional[int]:
+        # ключ и бронь — в одном SAVEPOINT: либо обе записи, либо ни одной
+        if not self._claim_key(key):
+            return None
+        return self._execute(self.BOOKING_INSERT, params)
+
+    async def add_booking_once(self, key: str, user_id: Optional[int], fullname: str, phone: str, dt_text: str,
+                               source: str = "", notes: str = "", status: str = "pending",
+                               consent: str = "Нет") -> Optional[int]:
+        # None — бронь с этим ключом уже создана
+        return await self.write(self._add_booking_once, key, (user_id, fullname, phone, dt_text, source, notes,
+                                                              status, consent, booking_starts_at(dt_text)))
+
+    async def list_bookings(self) -> List[sqlite3.Row]:
+        return await self.fetchall("SELECT * FROM bookings ORDER BY id DESC")
+
+    def _booking_page(self, render, sep: str, budget: int, since: str, cursor_id: Optional[int],
+                      backward: bool) -> Optional[Tuple[List[Tuple[int, str]], bool]]:
+        # keyset по (starts_at, id) через idx_bookings_starts_at; строки читаются курсором
+        # и сразу рендерятся, пока страница помещается в budget — остальное из БД не выбирается
+        where, params = ["starts_at >= ?"], [since]
+        if cursor_id is not None:
+            row = self._fetchone("SELECT starts_at FROM bookings WHERE id=?", (cursor_id,))
+            if row is None or row["starts_at"] is None:
+                # бронь-курсор удалена — продолжить с того же места нельзя
+                return None
+            op, strict = ("<=", "<") if backward else (">=", ">")
+            where.append(f"starts_at {op} ? AND (starts_at {strict} ? OR id {strict} ?)")
+            params += [row["starts_at"], row["starts_at"], cursor_id]
+        order = "DESC" if backward else "ASC"
+        cur = self.conn.execute(f"SELECT * FROM bookings WHERE {' AND '.join(where)} "
+                                f"ORDER BY starts_at {order}, id {order}", params)
+        page, used, more = [], 0, False
+        try:
+            for r in cur:
+                text = render(r)[:budget]
+                cost = tg_len(text) + (len(sep) if page else 0)
+                if page and used + cost > budget:
+                    more = True
+                    break
+                page.append((r["id"], text))
+                used += cost
+        finally:
+            cur.close()
+        return (page[::-1] if backward else page), more
+
+    async def booking_page(self, render, sep: str, budget: int, since: str,
+                           cursor_id: Optional[int] = None,
+                           backward: bool = False) -> Optional[Tuple[List[Tuple[int, str]], bool]]:
+        # None — брони-курсора больше нет
+        return await self.run(self._booking_page, render, sep, budget, since, cursor_id, backward)
+
+    async def delete_bookings(self, ids: List[int]) -> int:
+        return await self.executemany("DELETE FROM bookings WHERE id=?", [(i,) for i in ids])
+
+    # ---- фото ----
+    async def list_photos(self) -> List[sqlite3.Row]:
+        return await self.fetchall("SELECT * FROM photos ORDER BY id DESC")
+
+    async def add_photo(self, file_id: str, caption: str, added_by: Optional[int]) -> int:
+        return await self.execute("INSERT INTO photos (file_id, caption, added_by) VALUES (?,?,?)",
+                                  (file_id, caption, added_by))
+
+    # ---- кухня (stop | togo) ----
+    async def list_kitchen(self, kind: str) -> List[sqlite3.Row]:
+        return await self.fetchall("SELECT * FROM kitchen_lists WHERE kind=? ORDER BY id DESC", (kind,))
+
+    async def add_kitchen_item(self, kind: str, title: str) -> int:
+        return await self.execute("INSERT INTO kitchen_lists (kind, item_title) VALUES (?,?)", (kind, title))
+
+    async def delete_kitchen_item(self, kind: str, item_id: int):
+        await self.execute("DELETE FROM kitchen_lists WHERE id=? AND kind=?", (item_id, kind))
+
+    # ---- FSM ----
+    async def fsm_load(self, key: str) -> Optional[sqlite3.Row]:
+        return await self.fetchone("SELECT state, data, updated_at FROM fsm_state WHERE key=?", (key,))
+
+    async def fsm_save(self, key: str, state: Optional[str], data: Optional[str], updated_at: float):
+        await self.execute("""
+            INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+        """, (key, state, data, updated_at))
+
+    async def fsm_delete(self, key: str):
+        await self.execute("DELETE FROM fsm_state WHERE key=?", (key,))
+
+    def _fsm_sweep(self, before: float) -> int:
+        # по idx_fsm_state_updated: просматриваются только просроченные строки
+        cur = self.conn.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,))
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def fsm_sweep(self, before: float) -> int:
+        return await self.write(self._fsm_sweep, before)
+
+    # ---- идемпотентность ----
+    def _claim_key(self, key: str) -> bool:
+        # True — ключ новый и теперь занят; False — такая запись уже была
+        cur = self.conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, created_at) VALUES (?, ?)",
+                                (key, time.time()))
+        try:
+            return cur.rowcount == 1
+        finally:
+            cur.close()
+
+    async def has_idempotency_key(self, key: str) -> bool:
+        return await self.fetchone("SELECT 1 FROM idempotency_keys WHERE key=?", (key,)) is not None
+
+    async def list_idempotency_keys(self) -> List[str]:
+        return [r[0] for r in await self.fetchall("SELECT key FROM idempotency_keys")]
+
+    def _idempotency_sweep(self, before: float) -> int:
+        cur = self.conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (before,))
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def idempotency_sweep(self, before: float) -> int:
+        return await self.write(self._idempotency_sweep, before)
+
+USER_FIELDS = {"role", "fullname", "phone", "username", "passport"}
+
+# Ключи сортировки выборщика пользователей (совпадают с выражениями индексов)
+USER_PICK_KEYS = {"name": "COALESCE(fullname,'')", "username": "username COLLATE NOCASE"}
+PREFIX_TOP = "\U0010ffff"  # верхняя граница диапазона «начинается с»
+
+def _user_pick_key(r: sqlite3.Row, by_username: bool) -> str:
+    # то же упорядочивание, что у SQLite: BINARY для ФИО, NOCASE (ASCII) для username
+    return (r["username"] or "").lower() if by_username else (r["fullname"] or "")
+
+db = Database(DB_FILE)
+# Синхронный курсор — только для схемы и миграций при старте.
+# Во время работы бота все запросы идут через db.
+conn = db.conn
 cursor = conn.cursor()
 
 cursor.execute("""
@@ -184,6 +1007,48 @@ def ensure_bookings_consent_column():
         logger.error("Migration consent column error: %s", e)
 ensure_bookings_consent_column()
 
+# ---- Миграции: нормализованное время брони starts_at (+ индекс) ----
+# Формат хранения — ISO «YYYY-MM-DD HH:MM:SS», строки сравниваются лексикографически,
+# поэтому списки будущих броней выбираются по индексу, без разбора каждой строки.
+BOOKING_TS_FMT = "%Y-%m-%d %H:%M:%S"
+
+def _parse_booking_dt(dt_text: Optional[str], now: datetime) -> Optional[datetime]:
+    for fmt in ("%d.%m %H:%M", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"):
+        try:
+            dt = datetime.strptime(dt_text, fmt)
+        except Exception:
+            continue
+        if dt.year == 1900:
+            dt = dt.replace(year=now.year)
+        return dt
+    return None
+
+def booking_starts_at(dt_text: Optional[str]) -> Optional[str]:
+    dt = _parse_booking_dt(dt_text, datetime.now())
+    return dt.strftime(BOOKING_TS_FMT) if dt else None
+
+def ensure_bookings_starts_at_column():
+    try:
+        cursor.execute("PRAGMA table_info(bookings)")
+        cols = [r[1] for r in cursor.fetchall()]
+        if "starts_at" not in cols:
+            cursor.execute("ALTER TABLE bookings ADD COLUMN starts_at TEXT")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_starts_at ON bookings(starts_at)")
+        # разовый бэкфилл: старые записи без starts_at
+        cursor.execute("SELECT id, datetime FROM bookings WHERE starts_at IS NULL")
+        updates = []
+        for r in cursor.fetchall():
+            ts = booking_starts_at(r[1])
+            if ts:
+                updates.append((ts, r[0]))
+        if updates:
+            cursor.executemany("UPDATE bookings SET starts_at=? WHERE id=?", updates)
+            logger.info("Backfilled starts_at for %d bookings", len(updates))
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration starts_at column error: %s", e)
+ensure_bookings_starts_at_column()
+
 # ---- Миграции: добавляем username и passport в users ----
 def ensure_users_extra_columns():
     try:
@@ -202,163 +1067,481 @@ def ensure_users_extra_columns():
         logger.error("Migration users columns error: %s", e)
 ensure_users_extra_columns()
 
+# ---- Индексы для постраничного выбора пользователей ----
+def ensure_users_pick_indexes():
+    try:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users(COALESCE(fullname,''), user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_role_name ON users(role, COALESCE(fullname,''), user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE, user_id)")
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration users indexes error: %s", e)
+ensure_users_pick_indexes()
+
+# ---- Хранилище FSM: состояние и данные незаконченных диалогов (переживают рестарт) ----
+def ensure_fsm_table():
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_state (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)")
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration fsm_state table error: %s", e)
+ensure_fsm_table()
+
+# ---- Ключи идемпотентности: уже выполненные записи (создание брони) ----
+def ensure_idempotency_table():
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                created_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)")
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration idempotency_keys table error: %s", e)
+ensure_idempotency_table()
+
 # -----------------------------------------------------------------------------
 # Хелперы БД
 # -----------------------------------------------------------------------------
-def is_admin(user_id: int) -> bool:
-    if user_id in ADMIN_IDS:
-        return True
-    cursor.execute("SELECT role FROM users WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
-    if not row:
-        return False
+def _role_from_value(value: Any) -> int:
     try:
-        r = int(row["role"])
+        return int(value)
     except Exception:
         # если в базе "admin"/"staff" строкой — приводим
         role_map = {"guest": ROLE_GUEST, "staff": ROLE_STAFF, "admin": ROLE_ADMIN}
-        r = role_map.get(str(row["role"]).lower(), ROLE_GUEST)
-    return r == ROLE_ADMIN
+        return role_map.get(str(value).lower(), ROLE_GUEST)
+
+class RoleCache:
+    """LRU-кэш ролей с TTL (user_id -> роль), чтобы проверки доступа не ходили в БД.
 
-def is_staff_or_admin(user_id: int) -> bool:
+    generation увеличивается при каждой инвалидации: чтение, начатое до записи,
+    не положит в кэш устаревшую роль.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[int]:
+        item = self._data.get(user_id)
+        if item is not None and item[1] > time.monotonic():
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return item[0]
+        if item is not None:
+            del self._data[user_id]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, role: int, generation: int):
+        if generation != self.generation:
+            return
+        self._data[user_id] = (role, time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        # без user_id — сбросить всё (импорт сотрудников)
+        self.generation += 1
+        if user_id is None:
+            self._data.clear()
+        else:
+            self._data.pop(user_id, None)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = (self.hits / total * 100) if total else 0.0
+        return (f"роли: {len(self._data)}/{self.maxsize}, попаданий {self.hits}, "
+                f"промахов {self.misses} ({ratio:.0f}% из кэша)")
+
+role_cache = RoleCache(
+    maxsize=int(os.environ.get("ROLE_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("ROLE_CACHE_TTL", "0" if MULTI_WORKER else "300")),
+)
+
+async def get_role(user_id: int) -> int:
     if user_id in ADMIN_IDS:
-        return True
-    cursor.execute("SELECT role FROM users WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
-    if not row:
-        return False
-    try:
-        r = int(row["role"])
-    except Exception:
-        role_map = {"guest": ROLE_GUEST, "staff": ROLE_STAFF, "admin": ROLE_ADMIN}
-        r = role_map.get(str(row["role"]).lower(), ROLE_GUEST)
-    return r in (ROLE_STAFF, ROLE_ADMIN)
-
-def ensure_user(user_id: int, username: Optional[str] = None):
-    cursor.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
-    if row is None:
-        cursor.execute("INSERT INTO users (user_id, username, role) VALUES (?,?,?)",
-                       (user_id, username, ROLE_GUEST))
-        conn.commit()
-    else:
-        if username and row["username"] != username:
-            cursor.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
-            conn.commit()
+        return ROLE_ADMIN
+    role = role_cache.get(user_id)
+    if role is None:
+        generation = role_cache.generation
+        value = await db.get_role_value(user_id)
+        role = ROLE_GUEST if value is None else _role_from_value(value)
+        role_cache.put(user_id, role, generation)
+    return role
+
+async def is_admin(user_id: int) -> bool:
+    return await get_role(user_id) == ROLE_ADMIN
+
+async def is_staff_or_admin(user_id: int) -> bool:
+    return await get_role(user_id) in (ROLE_STAFF, ROLE_ADMIN)
+
+# Правила доступа к callback-кнопкам: минимальная роль.
+# Точное совпадение важнее префикса, из префиксов побеждает самый длинный.
+ACCESS_EXACT = {
+    "staff_menu": ROLE_STAFF,
+    "staff_bookings": ROLE_STAFF,
+    "main_admin": ROLE_ADMIN,
+}
+ACCESS_PREFIXES = sorted({
+    "adm_": ROLE_ADMIN,
+    "exp_": ROLE_ADMIN,
+    "imp_": ROLE_ADMIN,
+    "user_": ROLE_ADMIN,
+    "kitchen_": ROLE_STAFF,
+    "klist_": ROLE_STAFF,
+    "staff_bk_": ROLE_STAFF,
+}.items(), key=lambda kv: -len(kv[0]))
+
+def required_role(callback_data: str) -> int:
+    role = ACCESS_EXACT.get(callback_data)
+    if role is not None:
+        return role
+    for prefix, role in ACCESS_PREFIXES:
+        if callback_data.startswith(prefix):
+            return role
+    return ROLE_GUEST
+
+class AccessMiddleware(BaseMiddleware):
+    """Outer-middleware: роль вызывающего определяется один раз на Update.
+
+    Роль кладётся в data["role"] (хендлеры получают её аргументом role), а
+    callback-кнопки, закрытые правилами доступа, отклоняются до хендлеров.
+    """
 
-def update_user_profile(user_id: int, *, role: Optional[int] = None,
-                        fullname: Optional[str] = None, phone: Optional[str] = None,
-                        username: Optional[str] = None, passport: Optional[str] = None):
-    cursor.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    exists = cursor.fetchone() is not None
-    if not exists:
-        cursor.execute("INSERT INTO users (user_id, role, fullname, phone, username, passport) VALUES (?,?,?,?,?,?)",
-                       (user_id, role if role is not None else ROLE_GUEST,
-                        fullname, phone, username, passport))
-    else:
-        fields = []
-        params = []
-        if role is not None:
-            fields.append("role=?"); params.append(role)
-        if fullname is not None:
-            fields.append("fullname=?"); params.append(fullname)
-        if phone is not None:
-            fields.append("phone=?"); params.append(phone)
-        if username is not None:
-            fields.append("username=?"); params.append(username)
-        if passport is not None:
-            fields.append("passport=?"); params.append(passport)
-        if fields:
-            params.append(user_id)
-            cursor.execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id=?", tuple(params))
-    conn.commit()
-
-def add_booking(user_id: int, fullname: str, phone: str, dt_text: str,
-                source: str = "", notes: str = "", status: str = "pending",
-                consent: str = "Нет") -> int:
-    cursor.execute("""
-        INSERT INTO bookings (user_id, fullname, phone, datetime, source, notes, status, consent)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, fullname, phone, dt_text, source, notes, status, consent))
-    conn.commit()
-    return cursor.lastrowid
-
-def list_future_bookings_for_cards() -> List[sqlite3.Row]:
-    cursor.execute("SELECT * FROM bookings ORDER BY id DESC")
-    rows = cursor.fetchall()
-    now = datetime.now()
-    out = []
-    for r in rows:
-        dt_text = r["datetime"]
-        dt = None
-        for fmt in ("%d.%m %H:%M", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"):
-            try:
-                dt = datetime.strptime(dt_text, fmt)
-                break
-            except Exception:
-                pass
-        if dt is None:
-            continue
-        if dt.year == 1900:
-            dt = dt.replace(year=now.year)
-        if dt >= now:
-            out.append(r)
-    return out
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        user = data.get("event_from_user")
+        role = await get_role(user.id) if user else ROLE_GUEST
+        data["role"] = role
+        call = event.callback_query
+        if call is not None and call.data and role < required_role(call.data):
+            # роль могли читать из БД дольше задержки автоответа — тогда отказ
+            # придёт сообщением в чат (см. CallbackAckMiddleware)
+            return await call.answer("⛔ Нет доступа", show_alert=True)
+        return await handler(event, data)
+
+class ChatQueueMiddleware(BaseMiddleware):
+    """Outer-middleware: ограничение очереди одного чата, до FSM и его замка.
+
+    Апдейты чата выполняются по очереди под замком ChatEventIsolation, а пока ждут
+    его, занимают места приёма (UPDATE_QUEUE). Чтобы один чат, засыпающий бота,
+    не занял их все, в очереди чата не больше per_chat апдейтов. Сверх этого нажатия
+    кнопок (дребезг, повторы) отбрасываются с подсказкой, сообщения — с одним
+    ответом «подождите» на всю серию.
+    """
 
-def list_future_bookings_for_staff_list() -> List[str]:
-    rows = list_future_bookings_for_cards()
-    res = []
-    for r in rows:
-        name = r["fullname"] or "—"
-        notes = r["notes"] or "—"
-        res.append(f"• {r['datetime']} — {name}; {notes}")
-    return res
+    def __init__(self, per_chat: int = 8):
+        self.per_chat = per_chat
+        # чат -> [апдейтов в очереди, ответ о переполнении отправлен]; живёт, пока очередь не пуста
+        self._chats: Dict[int, list] = {}
+        self.dropped = 0
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat else user.id if user else None
+        if key is None:
+            return await handler(event, data)
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [0, False]
+        if entry[0] >= self.per_chat:
+            self.dropped += 1
+            logger.warning("Очередь чата %s переполнена — апдейт %s отброшен", key, event.update_id)
+            if event.callback_query is not None:
+                await event.callback_query.answer("⏳ Не так быстро — обрабатываю предыдущие нажатия")
+            elif event.message is not None and not entry[1]:
+                entry[1] = True
+                await event.message.answer("⏳ Слишком много сообщений подряд. Отвечу на предыдущие — "
+                                           "последнее, что не успел принять, пришлите ещё раз.")
+            return None
+        entry[0] += 1
+        try:
+            return await handler(event, data)
+        finally:
+            entry[0] -= 1
+            if not entry[0]:
+                del self._chats[key]
+
+class CallbackAckMiddleware(BaseMiddleware):
+    """Outer-middleware: нажатие кнопки подтверждается, не дожидаясь хендлера.
+
+    Если за delay секунд хендлер сам не вызвал call.answer(...), уходит пустой
+    answerCallbackQuery, и спиннер на кнопке гаснет. Подключается после очереди
+    чата и FSM-middleware, так что таймер идёт с начала обработки, а не с момента,
+    когда апдейт встал в очередь. Повторный ответ Telegram не примет, поэтому
+    поздние call.answer(...) перехватывает request() (middleware сессии бота):
+    alert уходит в чат обычным сообщением, текст всплывашки только пишется в лог.
+    """
+
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        # id callback-запроса -> [уже отвечен, чат, задача автоответа]
+        self._pending: Dict[str, list] = {}
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        call = event.callback_query
+        if call is None:
+            return await handler(event, data)
+        entry = self._pending[call.id] = [False, call.message.chat.id if call.message else None, None]
+
+        def fire():
+            entry[2] = asyncio.get_running_loop().create_task(self._ack(call))
 
-def cleanup_past_bookings():
+        timer = asyncio.get_running_loop().call_later(self.delay, fire)
+        try:
+            return await handler(event, data)
+        finally:
+            timer.cancel()
+            if not entry[0]:
+                await self._ack(call)
+            if entry[2] is not None:
+                await entry[2]
+            del self._pending[call.id]
+
+    @staticmethod
+    async def _ack(call: CallbackQuery):
+        try:
+            await call.answer()
+        except Exception as e:
+            logger.warning("answerCallbackQuery %s: %s", call.id, e)
+
+    async def request(self, make_request, bot: Bot, method):
+        if isinstance(method, AnswerCallbackQuery):
+            entry = self._pending.get(method.callback_query_id)
+            if entry is not None:
+                if not entry[0]:
+                    entry[0] = True
+                    return await make_request(bot, method)
+                if method.text and method.show_alert and entry[1] is not None:
+                    await bot.send_message(entry[1], method.text)
+                elif method.text:
+                    logger.info("Поздний ответ на кнопку %s не отправлен: %s",
+                                method.callback_query_id, method.text)
+                return True
+        return await make_request(bot, method)
+
+callback_acks = CallbackAckMiddleware(delay=CALLBACK_ACK_DELAY)
+bot.session.middleware(callback_acks.request)
+dp.update.outer_middleware(ChatQueueMiddleware(per_chat=CHAT_QUEUE))
+dp.update.outer_middleware(dp.fsm)
+dp.update.outer_middleware(callback_acks)
+dp.update.outer_middleware(AccessMiddleware())
+
+async def ensure_user(user_id: int, username: Optional[str] = None):
+    await db.ensure_user(user_id, username)
+
+async def update_user_profile(user_id: int, *, role: Optional[int] = None,
+                              fullname: Optional[str] = None, phone: Optional[str] = None,
+                              username: Optional[str] = None, passport: Optional[str] = None):
+    await db.upsert_user(user_id, role=role, fullname=fullname, phone=phone, username=username, passport=passport)
+    role_cache.invalidate(user_id)
+
+async def add_booking(user_id: int, fullname: str, phone: str, dt_text: str,
+                      source: str = "", notes: str = "", status: str = "pending",
+                      consent: str = "Нет") -> int:
+    return await db.add_booking(user_id, fullname, phone, dt_text, source, notes, status, consent)
+
+# ---- Идемпотентность записей
+class BloomFilter:
+    """Множество строк в битовом массиве: «нет» — точно, «да» — с ошибкой до error_rate."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterator[int]:
+        # двойное хэширование: k позиций из одного blake2b
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little")
+        b = int.from_bytes(digest[8:], "little") | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+class IdempotencyGuard:
+    """Отсев повторных записей: двойные нажатия, повторная доставка апдейта.
+
+    Окончательная проверка — ключ в idempotency_keys, который занимается в том же
+    SAVEPOINT группового коммита, что и сама запись (Database.*_once). Bloom-фильтр
+    в памяти отвечает «точно не было» без запроса к БД; в БД за подтверждением идём,
+    только когда он говорит «возможно было». Повтор отбрасывается до записи и до
+    уведомлений.
+    """
+
+    def __init__(self, capacity: int = 100000, ttl: float = 7 * 24 * 3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.bloom = BloomFilter(capacity)
+        self.dropped = 0
+
+    async def load(self):
+        bloom = BloomFilter(self.capacity)
+        for key in await db.list_idempotency_keys():
+            bloom.add(key)
+        self.bloom = bloom
+
+    async def run_once(self, key: str, write, *args):
+        """write(key, *args) -> результат или None/False, если ключ уже занят.
+
+        Возвращает None, если запись с этим ключом уже выполнялась.
+        """
+        if key in self.bloom and await db.has_idempotency_key(key):
+            self.dropped += 1
+            return None
+        result = await write(key, *args)
+        self.bloom.add(key)
+        if not result:
+            self.dropped += 1
+            return None
+        return result
+
+    async def sweep(self) -> int:
+        removed = await db.idempotency_sweep(time.time() - self.ttl)
+        if removed:
+            # из Bloom-фильтра удалять нельзя — перестраиваем по оставшимся ключам
+            await self.load()
+        return removed
+
+idempotency = IdempotencyGuard(capacity=IDEMPOTENCY_CAPACITY, ttl=IDEMPOTENCY_TTL)
+
+def booking_key(message: Message) -> str:
+    # заявка привязана к сообщению, которым её отправили: повторная доставка апдейта
+    # и второе нажатие той же кнопки дают тот же ключ, новая анкета на тот же слот — новый
+    return f"booking:{message.chat.id}:{message.message_id}"
+
+# ---- Списки будущих броней: страницы по размеру сообщения
+TEXT_LIMIT = 4096  # максимум длины сообщения
+
+def tg_len(text: str) -> int:
+    # Telegram считает длину в UTF-16: эмодзи занимают по две позиции
+    return len(text.encode("utf-16-le")) // 2
+
+def _booking_card(r: sqlite3.Row) -> str:
+    return (f"📌 Бронь #{r['id']}\n"
+            f"👤 {r['fullname'] or '—'}\n"
+            f"📞 {r['phone'] or '—'}\n"
+            f"📅 {r['datetime']}\n"
+            f"📝 {r['notes'] or '—'}\n"
+            f"🔐 Согласие: {r['consent'] or '—'}\n"
+            f"Статус: {r['status'] or '—'}")
+
+def _booking_line(r: sqlite3.Row) -> str:
+    return f"• {r['datetime']} — {r['fullname'] or '—'}; {r['notes'] or '—'}"
+
+BOOKING_LISTS = {
+    # вид -> (заголовок, строка брони, разделитель, callback «Назад»)
+    "adm": ("📋 Будущие бронирования:", _booking_card, "\n\n", "main_admin"),
+    "staff": ("Ближайшие бронирования:", _booking_line, "\n", "staff_menu"),
+}
+
+async def booking_list_page(kind: str, cursor_id: Optional[int] = None,
+                            backward: bool = False) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    """Страница списка броней: текст в пределах TEXT_LIMIT и кнопки ◀️ ▶️. None — броней нет."""
+    title, render, sep, back_cb = BOOKING_LISTS[kind]
+    since = datetime.now().strftime(BOOKING_TS_FMT)
+    page = await db.booking_page(render, sep, TEXT_LIMIT - tg_len(title) - 2, since, cursor_id, backward)
+    if page is None:
+        # бронь-курсор удалили: говорим об этом прямо и начинаем с первой страницы
+        title = "⚠️ Список изменился, показываю с начала.\n\n" + title
+        cursor_id, backward = None, False
+        page = await db.booking_page(render, sep, TEXT_LIMIT - tg_len(title) - 2, since, None, False)
+    items, more = page
+    if cursor_id is not None and (not items or (backward and not more)):
+        # упёрлись в начало списка или после курсора ничего не осталось — показываем первую страницу
+        cursor_id, backward = None, False
+        items, more = await db.booking_page(render, sep, TEXT_LIMIT - tg_len(title) - 2, since, None, False)
+    if not items:
+        return None
+    has_prev = more if backward else cursor_id is not None
+    has_next = True if backward else more
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"{kind}_bk_p_{items[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"{kind}_bk_n_{items[-1][0]}"))
+    kb = [nav] if nav else []
+    kb.append([InlineKeyboardButton(text="🔙 Назад", callback_data=back_cb)])
+    text = title + "\n\n" + sep.join(t for _, t in items)
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+async def cleanup_past_bookings():
     try:
         now = datetime.now()
-        cursor.execute("SELECT id, datetime FROM bookings")
+        rows = await db.fetchall("SELECT id, datetime FROM bookings")
         to_delete = []
-        for r in cursor.fetchall():
-            dt_text = r['datetime']
-            dt = None
-            for fmt in ("%d.%m %H:%M", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"):
-                try:
-                    dt = datetime.strptime(dt_text, fmt)
-                    break
-                except:
-                    pass
+        for r in rows:
+            dt = _parse_booking_dt(r['datetime'], now)
             if dt is None:
                 continue
-            if dt.year == 1900:
-                dt = dt.replace(year=now.year)
             if dt.date() < now.date():
                 to_delete.append(r['id'])
         if to_delete:
-            cursor.executemany("DELETE FROM bookings WHERE id=?", [(i,) for i in to_delete])
-            conn.commit()
+            await db.delete_bookings(to_delete)
     except Exception as e:
         logger.error("cleanup_past_bookings error: %s", e)
 
 # -----------------------------------------------------------------------------
 # Клавиатуры
 # -----------------------------------------------------------------------------
+# Реестр готовых клавиатур: статические строятся один раз при импорте, ролевые —
+# по одной на роль. Объекты общие для всех апдейтов, поэтому их нельзя менять
+# после создания. JSON для Telegram сериализуется тоже один раз
+# (см. KeyboardCachingSession).
+_KB_REGISTRY: Dict[int, InlineKeyboardMarkup] = {}
+_KB_JSON: Dict[int, str] = {}
+
+def register_kb(markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+    _KB_REGISTRY[id(markup)] = markup
+    return markup
+
+def static_kb(fn):
+    markup = register_kb(fn())
+
+    @functools.wraps(fn)
+    def wrapper() -> InlineKeyboardMarkup:
+        return markup
+    return wrapper
+
+@static_kb
 def back_main_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🏠 На главную", callback_data="go_main")]
     ])
 
+@static_kb
 def booking_nav_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="book_back"),
          InlineKeyboardButton(text="✖️ Отмена", callback_data="book_cancel")]
     ])
 
-def main_menu_inline(user_id: int) -> InlineKeyboardMarkup:
+def _build_main_menu(role: int) -> InlineKeyboardMarkup:
     role_row = []
-    if is_staff_or_admin(user_id):
+    if role in (ROLE_STAFF, ROLE_ADMIN):
         role_row.append(InlineKeyboardButton(text="👨‍🍳 Staff-меню", callback_data="staff_menu"))
-    if is_admin(user_id):
+    if role == ROLE_ADMIN:
         role_row.append(InlineKeyboardButton(text="⚙️ Админ-меню", callback_data="main_admin"))
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📅 Забронировать столик", callback_data="main_book")],
@@ -368,6 +1551,13 @@ def main_menu_inline(user_id: int) -> InlineKeyboardMarkup:
         kb.inline_keyboard.append(role_row)
     return kb
 
+MAIN_MENU_BY_ROLE = {role: register_kb(_build_main_menu(role)) for role in (ROLE_GUEST, ROLE_STAFF, ROLE_ADMIN)}
+
+async def main_menu_inline(user_id: int) -> InlineKeyboardMarkup:
+    # одна клавиатура на роль, а не на пользователя
+    return MAIN_MENU_BY_ROLE.get(await get_role(user_id), MAIN_MENU_BY_ROLE[ROLE_GUEST])
+
+@static_kb
 def admin_menu_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👥 Пользователи", callback_data="adm_users")],
@@ -377,6 +1567,7 @@ def admin_menu_inline() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")],
     ])
 
+@static_kb
 def staff_menu_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🍳 Кухня", callback_data="kitchen_main")],
@@ -384,6 +1575,7 @@ def staff_menu_inline() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")],
     ])
 
+@static_kb
 def feedback_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🌐 Официальный сайт", url="https://example.com")],
@@ -391,6 +1583,7 @@ def feedback_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_main")],
     ])
 
+@static_kb
 def contacts_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👩‍💼 Управляющая", url="https://t.me/AnnaBardo_nova")],
@@ -398,6 +1591,7 @@ def contacts_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="feedback")],
     ])
 
+@static_kb
 def users_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Создать", callback_data="adm_users_create"),
@@ -406,6 +1600,7 @@ def users_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="main_admin")],
     ])
 
+@static_kb
 def io_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬇️ Экспорт CSV", callback_data="adm_export")],
@@ -413,6 +1608,7 @@ def io_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="main_admin")],
     ])
 
+@static_kb
 def export_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📃 Список бронирований", callback_data="exp_bookings")],
@@ -421,6 +1617,7 @@ def export_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="adm_io")],
     ])
 
+@static_kb
 def import_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📃 Бронирования (CSV)", callback_data="imp_bookings")],
@@ -429,6 +1626,7 @@ def import_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="adm_io")],
     ])
 
+@static_kb
 def kitchen_main_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛑 Stop-list", callback_data="kitchen_stop")],
@@ -445,6 +1643,7 @@ def kitchen_list_kb(kind: str, items: List[sqlite3.Row]) -> InlineKeyboardMarkup
     kb.button(text="🔙 Назад", callback_data="kitchen_main")
     return kb.as_markup()
 
+@static_kb
 def photos_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Добавить фото", callback_data="adm_photo_add")],
@@ -457,27 +1656,33 @@ def photos_menu_kb() -> InlineKeyboardMarkup:
 # -----------------------------------------------------------------------------
 @router.message(CommandStart())
 async def on_start(message: Message):
-    ensure_user(message.from_user.id, message.from_user.username)
+    await ensure_user(message.from_user.id, message.from_user.username)
     text = (
         "👋 Добро пожаловать в наш ресторан!\n"
         "Мы рады видеть вас. Чем можем быть полезны сегодня?"
     )
-    await message.answer(text, reply_markup=main_menu_inline(message.from_user.id))
+    await message.answer(text, reply_markup=await main_menu_inline(message.from_user.id))
 
 @router.message(Command("version"))
 async def on_version(message: Message):
     await message.answer(f"VERA Bot {VERSION}")
 
+@router.message(Command("stats"))
+async def cmd_stats(message: Message, role: int):
+    if role != ROLE_ADMIN:
+        return
+    await message.answer(f"Кэш {role_cache.stats()}\nКэш {storage.stats()}")
+
 # ---- Главная навигация
 @router.callback_query(F.data == "go_main")
 async def go_main(call: CallbackQuery):
-    ensure_user(call.from_user.id, call.from_user.username)
-    await call.message.answer("🏠 Главный экран", reply_markup=main_menu_inline(call.from_user.id))
+    await ensure_user(call.from_user.id, call.from_user.username)
+    await call.message.answer("🏠 Главный экран", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 @router.callback_query(F.data == "back_main")
 async def back_main(call: CallbackQuery):
-    await call.message.answer("🏠 Главный экран", reply_markup=main_menu_inline(call.from_user.id))
+    await call.message.answer("🏠 Главный экран", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 # ---- Обратная связь
@@ -494,15 +1699,11 @@ async def contacts(call: CallbackQuery):
 # ---- Staff/Admin меню
 @router.callback_query(F.data == "staff_menu")
 async def staff_menu(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("👨‍🍳 Staff-меню", reply_markup=staff_menu_inline())
     await call.answer()
 
 @router.callback_query(F.data == "main_admin")
 async def main_admin(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("⚙️ Админ-меню", reply_markup=admin_menu_inline())
     await call.answer()
 
@@ -543,18 +1744,18 @@ async def book_back(call: CallbackQuery, state: FSMContext):
         await call.message.answer("🧑‍🦰 Ваше имя (ФИО):", reply_markup=booking_nav_kb())
     else:
         await state.clear()
-        await call.message.answer("Бронирование отменено.", reply_markup=main_menu_inline(call.from_user.id))
+        await call.message.answer("Бронирование отменено.", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 @router.callback_query(F.data == "book_cancel")
 async def book_cancel(call: CallbackQuery, state: FSMContext):
     await state.clear()
-    await call.message.answer("Бронирование отменено. Если передумаете — всегда рады помочь 🌸", reply_markup=main_menu_inline(call.from_user.id))
+    await call.message.answer("Бронирование отменено. Если передумаете — всегда рады помочь 🌸", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 @router.message(BookingFSM.fullname)
 async def booking_fullname(message: Message, state: FSMContext):
-    ensure_user(message.from_user.id, message.from_user.username)
+    await ensure_user(message.from_user.id, message.from_user.username)
     await state.update_data(fullname=message.text.strip())
     await state.set_state(BookingFSM.phone)
     await message.answer("📞 Оставьте номер телефона для связи:", reply_markup=booking_nav_kb())
@@ -633,14 +1834,15 @@ async def booking_notes(message: Message, state: FSMContext):
 async def book_consent_cb(call: CallbackQuery, state: FSMContext):
     consent = "Да" if call.data.endswith("yes") else "Нет"
     data = await state.get_data()
-    cursor.execute("""
-        INSERT INTO bookings (user_id, fullname, phone, datetime, source, notes, status, consent)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """,
-        (call.from_user.id, data.get("fullname"), data.get("phone"), data.get("datetime"),
-         data.get("source",""), data.get("notes",""), "pending", consent)
-    )
-    conn.commit()
+    if not data.get("fullname"):
+        # кнопка от уже завершённой анкеты
+        return await call.answer("Заявка уже отправлена 💐")
+    bid = await idempotency.run_once(booking_key(call.message), db.add_booking_once,
+                                     call.from_user.id, data.get("fullname"), data.get("phone"), data.get("datetime"),
+                                     data.get("source",""), data.get("notes",""), "pending", consent)
+    if bid is None:
+        await state.clear()
+        return await call.answer("Эта заявка уже принята 💐")
     await call.message.answer("Спасибо! Ваша заявка на бронь принята. Мы свяжемся с вами при необходимости 💐", reply_markup=back_main_kb())
     await state.clear()
     # Уведомление staff & admin
@@ -652,13 +1854,8 @@ async def book_consent_cb(call: CallbackQuery, state: FSMContext):
                 f"📌 Источник: {data.get('source','—') or '—'}\n"
                 f"📝 Пожелания: {data.get('notes','—') or '—'}\n"
                 f"🔐 Согласие: {consent}")
-        cursor.execute("SELECT user_id FROM users WHERE role IN (?,?)", (ROLE_STAFF, ROLE_ADMIN))
-        rows = cursor.fetchall()
-        for r in rows:
-            try:
-                await bot.send_message(r['user_id'], card)
-            except Exception:
-                pass
+        staff_ids = await db.list_user_ids_by_roles([ROLE_STAFF, ROLE_ADMIN])
+        notifier.enqueue_many(staff_ids, card)
     except Exception as e:
         logger.error("notify error: %s", e)
     await call.answer()
@@ -666,15 +1863,11 @@ async def book_consent_cb(call: CallbackQuery, state: FSMContext):
 # ---- ADMIN: Пользователи
 @router.callback_query(F.data == "adm_users")
 async def adm_users(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Управление сотрудниками:", reply_markup=users_menu_kb())
     await call.answer()
 
 @router.callback_query(F.data == "adm_users_create")
 async def adm_users_create(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await state.set_state(UserCreateFSM.fio)
     await call.message.answer("Введите ФИО нового сотрудника:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Назад", callback_data="adm_users")]
@@ -713,33 +1906,116 @@ async def user_create_passport(message: Message, state: FSMContext):
                          f"Когда сотрудник напишет боту, назначьте ему роль в разделе «Изменить».")
     await state.clear()
 
-@router.callback_query(F.data == "adm_users_edit")
-async def adm_users_edit(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
+# ---- Выбор пользователя: keyset-страницы, фильтр по роли, поиск по ФИО / @username
+USER_PICK_PAGE = 20
+USER_PICK_MODES = {
+    # mode -> (заголовок, префикс callback для выбранного пользователя)
+    "edit": ("Выберите сотрудника для редактирования:", "user_edit_"),
+    "del": ("Кого удалить?", "user_del_"),
+}
 
-    cursor.execute("SELECT user_id, fullname, username FROM users ORDER BY COALESCE(fullname,'') ASC")
-    rows = cursor.fetchall()
-    if not rows:
-        await call.message.answer("Пока нет пользователей.", reply_markup=users_menu_kb())
-        return await call.answer()
+async def show_user_picker(call_or_message, state: FSMContext, mode: str,
+                           cursor_uid: Optional[int] = None, backward: bool = False, edit: bool = False):
+    data = await state.get_data()
+    query = data.get("pick_query") or ""
+    staff_only = bool(data.get("pick_staff"))
+    title, item_cb = USER_PICK_MODES[mode]
+    pick = functools.partial(
+        db.pick_users,
+        roles=[ROLE_STAFF, ROLE_ADMIN] if staff_only else None,
+        name_prefix=query if query and not query.startswith("@") else None,
+        username_prefix=query[1:] if query.startswith("@") else None,
+        limit=USER_PICK_PAGE + 1)
+    rows = await pick(cursor_uid=cursor_uid, backward=backward)
+    changed = rows is None
+    if changed:
+        # курсор пропал из списка: говорим об этом прямо и начинаем с первой страницы
+        cursor_uid, backward = None, False
+        rows = await pick()
+    # лишняя строка показывает, есть ли страница дальше по направлению движения
+    more = len(rows) > USER_PICK_PAGE
+    if more:
+        rows = rows[1:] if backward else rows[:-1]
+    has_prev = more if backward else cursor_uid is not None
+    has_next = True if backward else more
 
     kb = InlineKeyboardBuilder()
     for r in rows:
         fio = r["fullname"] or "—"
         uname = f"@{r['username']}" if r["username"] else ""
-        kb.button(text=f"{fio} {uname}".strip(), callback_data=f"user_edit_{r['user_id']}")
-    kb.button(text="🔙 Назад", callback_data="adm_users")
-    await call.message.answer("Выберите сотрудника для редактирования:", reply_markup=kb.as_markup())
+        kb.row(InlineKeyboardButton(text=f"{fio} {uname}".strip(), callback_data=f"{item_cb}{r['user_id']}"))
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"adm_up_{mode}_p_{rows[0]['user_id']}"))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"adm_up_{mode}_n_{rows[-1]['user_id']}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(InlineKeyboardButton(text="🔎 Поиск", callback_data=f"adm_up_{mode}_s"),
+           InlineKeyboardButton(text="👥 Все" if staff_only else "👔 Только сотрудники",
+                                callback_data=f"adm_up_{mode}_f"))
+    if query:
+        kb.row(InlineKeyboardButton(text=f"✖️ Сбросить «{query[:20]}»", callback_data=f"adm_up_{mode}_x"))
+    kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="adm_users"))
+
+    text = title
+    if changed:
+        text = "⚠️ Список изменился, показываю с начала.\n\n" + text
+    if query or staff_only:
+        text += "\n" + ", ".join(filter(None, [f"поиск: {query}" if query else "",
+                                              "только сотрудники" if staff_only else ""]))
+    if not rows:
+        text += "\n\nНикого не найдено."
+    if edit:
+        try:
+            return await call_or_message.edit_text(text, reply_markup=kb.as_markup())
+        except Exception:
+            pass
+    await call_or_message.answer(text, reply_markup=kb.as_markup())
+
+@router.callback_query(F.data == "adm_users_edit")
+async def adm_users_edit(call: CallbackQuery, state: FSMContext):
+    await state.update_data(pick_query="", pick_staff=False)
+    await show_user_picker(call.message, state, "edit")
     await call.answer()
 
+@router.callback_query(F.data.startswith("adm_up_"))
+async def user_picker_cb(call: CallbackQuery, state: FSMContext):
+    # adm_up_<mode>_<n|p>_<user_id> | adm_up_<mode>_<s|f|x>
+    parts = call.data.split("_")
+    mode, action = parts[2], parts[3]
+    if mode not in USER_PICK_MODES:
+        return await call.answer()
+    if action in ("n", "p"):
+        await show_user_picker(call.message, state, mode, cursor_uid=int(parts[4]), backward=action == "p", edit=True)
+    elif action == "f":
+        data = await state.get_data()
+        await state.update_data(pick_staff=not data.get("pick_staff"))
+        await show_user_picker(call.message, state, mode, edit=True)
+    elif action == "x":
+        await state.update_data(pick_query="")
+        await show_user_picker(call.message, state, mode, edit=True)
+    elif action == "s":
+        await state.update_data(pick_mode=mode)
+        await state.set_state(UserPickFSM.query)
+        await call.message.answer("Введите начало ФИО или @username:")
+    await call.answer()
+
+@router.message(UserPickFSM.query)
+async def user_picker_query(message: Message, state: FSMContext):
+    query = (message.text or "").strip()
+    if query and not query.startswith("@"):
+        # ФИО хранятся с заглавной буквы, сравнение по префиксу регистрозависимое
+        query = query[:1].upper() + query[1:]
+    data = await state.get_data()
+    await state.set_state(None)
+    await state.update_data(pick_query="" if query in ("", "-", "@") else query)
+    await show_user_picker(message, state, data.get("pick_mode") or "edit")
+
 @router.callback_query(F.data.startswith("user_edit_"))
 async def user_edit_card(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     uid = int(call.data.split("_")[-1])
-    cursor.execute("SELECT * FROM users WHERE user_id=?", (uid,))
-    r = cursor.fetchone()
+    r = await db.get_user(uid)
     if not r:
         await call.message.answer("Пользователь не найден.", reply_markup=users_menu_kb())
         return await call.answer()
@@ -765,19 +2041,15 @@ async def user_edit_card(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("user_setrole_"))
 async def user_setrole(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     parts = call.data.split("_")
     uid = int(parts[2])
     role = int(parts[3])
-    update_user_profile(uid, role=role)
+    await update_user_profile(uid, role=role)
     await call.message.answer("Роль обновлена.", reply_markup=users_menu_kb())
     await call.answer()
 
 @router.callback_query(F.data.startswith("user_edit_field_"))
 async def user_edit_field(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     _, _, field, uid = call.data.split("_")
     await state.update_data(edit_uid=int(uid), edit_field=field)
     await state.set_state(UserEditFSM.value)
@@ -794,36 +2066,22 @@ async def user_edit_value(message: Message, state: FSMContext):
     field = data["edit_field"]
     value = message.text.strip()
     if field == "fio":
-        update_user_profile(uid, fullname=value)
+        await update_user_profile(uid, fullname=value)
     elif field == "phone":
-        update_user_profile(uid, phone=value)
+        await update_user_profile(uid, phone=value)
     elif field == "passport":
-        update_user_profile(uid, passport=value)
+        await update_user_profile(uid, passport=value)
     await message.answer("Изменения сохранены.", reply_markup=users_menu_kb())
     await state.clear()
 
 @router.callback_query(F.data == "adm_users_delete")
-async def adm_users_delete(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT user_id, fullname, username FROM users ORDER BY COALESCE(fullname,'') ASC")
-    rows = cursor.fetchall()
-    if not rows:
-        await call.message.answer("Пока нет пользователей.", reply_markup=users_menu_kb())
-        return await call.answer()
-    kb = InlineKeyboardBuilder()
-    for r in rows:
-        fio = r["fullname"] or "—"
-        uname = f"@{r['username']}" if r["username"] else ""
-        kb.button(text=f"{fio} {uname}".strip(), callback_data=f"user_del_{r['user_id']}")
-    kb.button(text="🔙 Назад", callback_data="adm_users")
-    await call.message.answer("Кого удалить?", reply_markup=kb.as_markup())
+async def adm_users_delete(call: CallbackQuery, state: FSMContext):
+    await state.update_data(pick_query="", pick_staff=False)
+    await show_user_picker(call.message, state, "del")
     await call.answer()
 
 @router.callback_query(F.data.startswith("user_del_"))
 async def user_del_ask(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     uid = int(call.data.split("_")[-1])
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"user_del_yes_{uid}")],
@@ -834,11 +2092,9 @@ async def user_del_ask(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("user_del_yes_"))
 async def user_del_yes(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     uid = int(call.data.split("_")[-1])
-    cursor.execute("DELETE FROM users WHERE user_id=?", (uid,))
-    conn.commit()
+    await db.delete_user(uid)
+    role_cache.invalidate(uid)
     await call.message.answer("🗑 Сотрудник удалён.", reply_markup=users_menu_kb())
     try:
         await call.answer()
@@ -849,186 +2105,411 @@ async def user_del_yes(call: CallbackQuery):
 # ---- ADMIN: Импорт/Экспорт
 @router.callback_query(F.data == "adm_io")
 async def adm_io(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Импорт/экспорт данных:", reply_markup=io_menu_kb())
     await call.answer()
 
 @router.callback_query(F.data == "adm_export")
 async def adm_export(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Что экспортировать в CSV?", reply_markup=export_menu_kb())
     await call.answer()
 
+# Экспорт идёт потоково: строки читаются из курсора пачками по EXPORT_CHUNK на
+# отдельном read-only соединении (в WAL оно не мешает потоку БД), кодируются
+# инкрементально и пишутся в SpooledTemporaryFile — до EXPORT_SPOOL_MAX байт в
+# памяти, дальше во временный файл без общего имени на диске.
+class SpooledInputFile(InputFile):
+    """Загрузка результата экспорта кусками, без чтения файла целиком."""
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot: Bot):
+        loop = asyncio.get_running_loop()
+        self.file.seek(0)
+        while True:
+            chunk = await loop.run_in_executor(None, self.file.read, self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def _export_csv(sql: str, params: tuple, headers: List[str], filename: str, compression: str):
+    # выполняется в потоке пула; возвращает (файл, имя для отправки, число строк)
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    archive = None
+    if compression == "gzip":
+        sink = gzip.GzipFile(filename=filename, mode="wb", fileobj=spool)
+        filename += ".gz"
+    elif compression == "zip":
+        archive = zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED)
+        sink = archive.open(filename, "w", force_zip64=True)
+        filename = os.path.splitext(filename)[0] + ".zip"
+    else:
+        sink = spool
+    conn = db.connect_aux()
+    count = 0
+    try:
+        conn.execute("PRAGMA query_only=ON")
+        cur = conn.execute(sql, params)
+        buf = io.StringIO()
+        w = csv.writer(buf, delimiter=";")
+        encoder = codecs.getincrementalencoder("utf-8")()
+        w.writerow(headers)
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK)
+            w.writerows(rows)
+            sink.write(encoder.encode(buf.getvalue(), final=not rows))
+            buf.seek(0)
+            buf.truncate()
+            if not rows:
+                break
+            count += len(rows)
+        if sink is not spool:
+            sink.close()
+        if archive is not None:
+            archive.close()
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        conn.close()
+    return spool, filename, count
+
+async def send_csv_export(message: Message, sql: str, headers: List[str], filename: str,
+                          caption: str, params: tuple = ()):
+    loop = asyncio.get_running_loop()
+    spool, filename, count = await loop.run_in_executor(
+        None, _export_csv, sql, params, headers, filename, EXPORT_COMPRESSION)
+    try:
+        await message.answer_document(SpooledInputFile(spool, filename), caption=caption)
+    finally:
+        spool.close()
+    logger.info("Export %s: %d rows", filename, count)
+
+# колонки экспорта совпадают с заголовками импорта (CSV_HEAD_*)
 @router.callback_query(F.data == "exp_bookings")
 async def exp_bookings(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    fn = "bookings_export.csv"
-    with open(fn, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f, delimiter=";")
-        w.writerow(["id","user_id","fullname","phone","datetime","source","notes","status","consent"])
-        cursor.execute("SELECT id,user_id,fullname,phone,datetime,source,notes,status,consent FROM bookings")
-        for r in cursor.fetchall():
-            w.writerow([r["id"], r["user_id"], r["fullname"], r["phone"], r["datetime"], r["source"], r["notes"], r["status"], r["consent"]])
-    await call.message.answer_document(types.FSInputFile(fn), caption="Экспорт бронирований")
+    await send_csv_export(call.message, f"SELECT {','.join(CSV_HEAD_BOOKINGS)} FROM bookings",
+                          CSV_HEAD_BOOKINGS, "bookings_export.csv", "Экспорт бронирований")
 
 @router.callback_query(F.data == "exp_users")
 async def exp_users(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    fn = "users_export.csv"
-    with open(fn, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f, delimiter=";")
-        w.writerow(["user_id","username","fullname","phone","passport","role"])
-        cursor.execute("SELECT user_id,username,fullname,phone,passport,role FROM users")
-        for r in cursor.fetchall():
-            w.writerow([r["user_id"], r["username"], r["fullname"], r["phone"], r["passport"], r["role"]])
-    await call.message.answer_document(types.FSInputFile(fn), caption="Экспорт сотрудников")
+    await send_csv_export(call.message, f"SELECT {','.join(CSV_HEAD_USERS)} FROM users",
+                          CSV_HEAD_USERS, "users_export.csv", "Экспорт сотрудников")
 
 @router.callback_query(F.data == "exp_menu")
 async def exp_menu(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    fn = "menu_export.csv"
-    with open(fn, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f, delimiter=";")
-        w.writerow(["id","title","description","price","category","photo_file_id"])
-        cursor.execute("SELECT id,title,description,price,category,photo_file_id FROM menu")
-        for r in cursor.fetchall():
-            w.writerow([r["id"], r["title"], r["description"], r["price"], r["category"], r["photo_file_id"]])
-    await call.message.answer_document(types.FSInputFile(fn), caption="Экспорт меню")
+    await send_csv_export(call.message, f"SELECT {','.join(CSV_HEAD_MENU)} FROM menu",
+                          CSV_HEAD_MENU, "menu_export.csv", "Экспорт меню")
 
 @router.callback_query(F.data == "adm_import")
 async def adm_import(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Что импортировать из CSV?", reply_markup=import_menu_kb())
     await call.answer()
 
 @router.callback_query(F.data == "imp_bookings")
 async def imp_bookings(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Отправьте CSV-файл с бронированиями (id;user_id;fullname;phone;datetime;source;notes;status;consent). Импорт произойдёт автоматически.")
 
 @router.callback_query(F.data == "imp_users")
 async def imp_users(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Отправьте CSV-файл с пользователями (user_id;username;fullname;phone;passport;role). Импорт произойдёт автоматически.")
 
 @router.callback_query(F.data == "imp_menu")
 async def imp_menu(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Отправьте CSV-файл с меню (id;title;description;price;category;photo_file_id). Импорт произойдёт автоматически.")
 
+CSV_HEAD_BOOKINGS = ["id","user_id","fullname","phone","datetime","source","notes","status","consent"]
+CSV_HEAD_USERS = ["user_id","username","fullname","phone","passport","role"]
+CSV_HEAD_MENU = ["id","title","description","price","category","photo_file_id"]
+
+# ---- Импорт: разбор, проверка и запись пачками
+# Импорт идёт на отдельном соединении в потоке пула: поток БД и event loop
+# остаются свободны. Пачка из IMPORT_BATCH строк пишется одним executemany с
+# upsert по ключу в своей короткой транзакции — между пачками блокировка записи
+# отпускается и записи хендлеров не ждут конца импорта. При сбое записанные
+# пачки остаются, отчёт называет строку обрыва. Строки с ошибками пропускаются.
+IMPORT_ERRORS_SHOWN = 20
+
+def _opt_int(value: Optional[str], name: str) -> Optional[int]:
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name}: не число «{value}»")
+
+def _import_booking_row(row: Dict[str, str]) -> tuple:
+    dt = (row.get("datetime") or "").strip()
+    return (_opt_int(row.get("id"), "id"), _opt_int(row.get("user_id"), "user_id"), row.get("fullname"),
+            row.get("phone"), dt, row.get("source"), row.get("notes"), row.get("status") or "pending",
+            row.get("consent") or "Нет", _import_starts_at(dt))
+
+def _import_user_row(row: Dict[str, str]) -> tuple:
+    user_id = _opt_int(row.get("user_id"), "user_id")
+    if user_id is None:
+        raise ValueError("пустой user_id")
+    role = _opt_int(row.get("role"), "role")
+    if role not in (ROLE_GUEST, ROLE_STAFF, ROLE_ADMIN):
+        raise ValueError(f"role: недопустимая роль «{row.get('role')}»")
+    return (user_id, row.get("username"), row.get("fullname"), row.get("phone"), row.get("passport"), role)
+
+def _import_menu_row(row: Dict[str, str]) -> tuple:
+    title = (row.get("title") or "").strip()
+    if not title:
+        raise ValueError("пустое название (title)")
+    price = (row.get("price") or "").strip()
+    try:
+        price = float(price.replace(",", "."))
+    except ValueError:
+        raise ValueError(f"price: не число «{price}»")
+    return (_opt_int(row.get("id"), "id"), title, row.get("description"), price,
+            row.get("category"), row.get("photo_file_id"))
+
+# strptime дорог, а время броней в выгрузках повторяется (слоты) — кэш на время импорта
+_import_starts_at = functools.lru_cache(maxsize=4096)(booking_starts_at)
+
+# вид -> (заголовок CSV, таблица, ключ upsert, колонки, разбор строки, название в отчёте)
+IMPORT_SPECS = {
+    "bookings": (CSV_HEAD_BOOKINGS, "bookings", "id", tuple(CSV_HEAD_BOOKINGS) + ("starts_at",),
+                 _import_booking_row, "Импорт бронирований"),
+    "users": (CSV_HEAD_USERS, "users", "user_id", tuple(CSV_HEAD_USERS), _import_user_row, "Импорт сотрудников"),
+    "menu": (CSV_HEAD_MENU, "menu", "id", tuple(CSV_HEAD_MENU), _import_menu_row, "Импорт меню"),
+}
+
+def _upsert_sql(table: str, key: str, cols: Tuple[str, ...]) -> str:
+    # NULL в INTEGER PRIMARY KEY — новая строка, существующий ключ — обновление
+    updates = ", ".join(f"{c}=excluded.{c}" for c in cols if c != key)
+    return (f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT({key}) DO UPDATE SET {updates}")
+
+def _import_batch(conn: sqlite3.Connection, sql: str, table: str, key: str,
+                  batch: List[Tuple[int, tuple]], errors: List[Tuple[int, str]]) -> Tuple[int, int]:
+    # одна пачка: executemany в SAVEPOINT; при ошибке БД — построчно, чтобы найти виновные строки
+    keys = [values[0] for _, values in batch if values[0] is not None]
+    existing = set()
+    if keys:
+        existing = {r[0] for r in conn.execute(
+            f"SELECT {key} FROM {table} WHERE {key} IN ({', '.join('?' * len(keys))})", keys)}
+    conn.execute("SAVEPOINT import_batch")
+    try:
+        conn.executemany(sql, [values for _, values in batch])
+        done = batch
+    except sqlite3.DatabaseError:
+        conn.execute("ROLLBACK TO import_batch")
+        done = []
+        for line, values in batch:
+            conn.execute("SAVEPOINT import_row")
+            try:
+                conn.execute(sql, values)
+                done.append((line, values))
+            except sqlite3.DatabaseError as e:
+                conn.execute("ROLLBACK TO import_row")
+                errors.append((line, str(e)))
+            conn.execute("RELEASE import_row")
+    conn.execute("RELEASE import_batch")
+    updated = sum(1 for _, values in done if values[0] in existing)
+    return len(done) - updated, updated
+
+def _import_csv_lines(lines: Iterable[str]) -> Tuple[Optional[str], str]:
+    # выполняется в потоке пула; вид импорта определяется по заголовку, строки читаются один раз
+    reader = csv.reader(lines, delimiter=";")
+    head = next(reader, [])
+    kind = next((k for k, spec in IMPORT_SPECS.items() if spec[0] == head), None)
+    if kind is None:
+        return None, "Неизвестный формат CSV."
+    _, table, key, cols, parse_row, title = IMPORT_SPECS[kind]
+    sql = _upsert_sql(table, key, cols)
+    _import_starts_at.cache_clear()
+    inserted = updated = 0
+    errors: List[Tuple[int, str]] = []
+    failed: Optional[Tuple[int, Exception]] = None
+    conn = db.connect_aux()
+    try:
+        while True:
+            # чтение и разбор — вне транзакции: файл может догружаться по сети
+            batch, start = [], reader.line_num
+            for values in itertools.islice(reader, IMPORT_BATCH):
+                try:
+                    batch.append((reader.line_num, parse_row(dict(zip(head, values)))))
+                except ValueError as e:
+                    errors.append((reader.line_num, str(e)))
+            if reader.line_num == start:
+                break
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ins, upd = _import_batch(conn, sql, table, key, batch, errors)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            inserted += ins
+            updated += upd
+    except Exception as e:
+        if not inserted + updated:
+            raise
+        failed = (start, e)  # start — последняя строка записанных пачек
+    finally:
+        conn.close()
+    report = f"{title}: добавлено {inserted}, обновлено {updated}."
+    if failed:
+        logger.error("CSV import stopped, committed up to line %s: %s", *failed)
+        report += f"\n⚠️ Импорт прерван: {failed[1]}. Записаны строки по {failed[0]} включительно."
+    if errors:
+        report += f"\nПропущено строк с ошибками: {len(errors)}"
+        report += "".join(f"\n• строка {n}: {msg}" for n, msg in errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            report += "\n…"
+    return kind, report
+
+class DocumentTextStream:
+    """Текст документа Telegram потоком, без записи на диск и без копии в памяти.
+
+    Скачивание и декодирование идут в event loop, строки читает поток пула
+    (итерация по объекту блокирует — только из run_in_executor). Между ними —
+    ограниченная очередь: пока импорт не разобрал пачку, загрузка ждёт.
+    Кодировка определяется по первому куску: BOM/UTF-8, иначе cp1251.
+    """
+
+    def __init__(self, bot: Bot, document, chunk_size: int = 64 * 1024):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=IMPORT_QUEUE_CHUNKS)
+        self.chunk_size = chunk_size
+        self._task = self.loop.create_task(self._feed(bot, document))
+
+    async def _chunks(self, bot: Bot, document):
+        file = await bot.get_file(document.file_id)
+        if bot.session.api.is_local:
+            with open(bot.session.api.wrap_local_file.to_local(file.file_path), "rb") as f:
+                while True:
+                    chunk = await self.loop.run_in_executor(None, f.read, self.chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+        url = bot.session.api.file_url(bot.token, file.file_path)
+        async for chunk in bot.session.stream_content(url=url, timeout=60, chunk_size=self.chunk_size,
+                                                      raise_for_status=True):
+            yield chunk
+
+    @staticmethod
+    def _decoder_for(head: bytes):
+        if head.startswith(codecs.BOM_UTF8):
+            return codecs.getincrementaldecoder("utf-8-sig")()
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(head)
+            return codecs.getincrementaldecoder("utf-8")()
+        except UnicodeDecodeError:
+            return codecs.getincrementaldecoder("cp1251")()
+
+    async def _feed(self, bot: Bot, document):
+        try:
+            decoder = None
+            async for chunk in self._chunks(bot, document):
+                if decoder is None:
+                    decoder = self._decoder_for(chunk)
+                text = decoder.decode(chunk)
+                if text:
+                    await self.queue.put(text)
+            if decoder is not None:
+                await self.queue.put(decoder.decode(b"", final=True))
+            await self.queue.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.queue.put(e)
+
+    def _get(self):
+        item = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self) -> Iterator[str]:
+        # строки с сохранённым "\n" — csv сам склеивает поля с переводами строк
+        tail = ""
+        while True:
+            text = self._get()
+            if text is None:
+                break
+            parts = (tail + text).split("\n")
+            tail = parts.pop()
+            for part in parts:
+                yield part + "\n"
+        if tail:
+            yield tail
+
+    def close(self):
+        self._task.cancel()
+
 @router.message(F.document)
-async def handle_csv(message: Message):
-    if not is_admin(message.from_user.id):
+async def handle_csv(message: Message, role: int):
+    if role != ROLE_ADMIN:
         return
     doc = message.document
     if not doc.file_name.lower().endswith(".csv"):
         return await message.answer("Ожидаю CSV-файл.")
-    path = f"upload_{doc.file_name}"
-    await bot.download(doc, destination=path)
-    # определяем тип по заголовку:
-    with open(path, "r", encoding="utf-8") as f:
-        head = f.readline().strip().split(";")
+    stream = DocumentTextStream(bot, doc)
     try:
-        if head == ["id","user_id","fullname","phone","datetime","source","notes","status","consent"]:
-            # bookings
-            with open(path, "r", encoding="utf-8") as f:
-                r = csv.DictReader(f, delimiter=";")
-                for row in r:
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO bookings (id,user_id,fullname,phone,datetime,source,notes,status,consent)
-                        VALUES (?,?,?,?,?,?,?,?,?)
-                    """, (int(row["id"]) if row["id"] else None, row["user_id"], row["fullname"], row["phone"],
-                          row["datetime"], row["source"], row["notes"], row["status"], row.get("consent") or "Нет"))
-            conn.commit()
-            await message.answer("Импорт бронирований завершён.")
-        elif head == ["user_id","username","fullname","phone","passport","role"]:
-            with open(path, "r", encoding="utf-8") as f:
-                r = csv.DictReader(f, delimiter=";")
-                for row in r:
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO users (user_id,username,fullname,phone,passport,role)
-                        VALUES (?,?,?,?,?,?)
-                    """, (int(row["user_id"]), row["username"], row["fullname"], row["phone"], row["passport"], int(row["role"])))
-            conn.commit()
-            await message.answer("Импорт сотрудников завершён.")
-        elif head == ["id","title","description","price","category","photo_file_id"]:
-            with open(path, "r", encoding="utf-8") as f:
-                r = csv.DictReader(f, delimiter=";")
-                for row in r:
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO menu (id,title,description,price,category,photo_file_id)
-                        VALUES (?,?,?,?,?,?)
-                    """, (int(row["id"]) if row["id"] else None, row["title"], row["description"], float(row["price"]), row["category"], row["photo_file_id"]))
-            conn.commit()
-            await message.answer("Импорт меню завершён.")
-        else:
-            await message.answer("Неизвестный формат CSV.")
+        kind, report = await asyncio.get_running_loop().run_in_executor(None, _import_csv_lines, stream)
+        if kind == "users":
+            role_cache.invalidate()
+        await message.answer(report)
     except Exception as e:
         logger.exception("CSV import error")
         await message.answer(f"Ошибка импорта: {e}")
+    finally:
+        stream.close()
 
 # ---- ADMIN: Бронирования списком (карточки гостей)
 @router.callback_query(F.data == "adm_bookings")
 async def adm_bookings_list(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    rows = list_future_bookings_for_cards()
-    if not rows:
+    page = await booking_list_page("adm")
+    if page is None:
         await call.message.answer("Нет будущих бронирований.", reply_markup=admin_menu_inline())
         return await call.answer()
-    for r in rows:
-        card = (f"📌 Бронь #{r['id']}\n"
-                f"👤 {r['fullname'] or '—'}\n"
-                f"📞 {r['phone'] or '—'}\n"
-                f"📅 {r['datetime']}\n"
-                f"📝 {r['notes'] or '—'}\n"
-                f"🔐 Согласие: {r['consent'] or '—'}\n"
-                f"Статус: {r['status'] or '—'}")
-        await call.message.answer(card)
-    await call.message.answer("— Конец списка —", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_admin")]
-    ]))
+    text, kb = page
+    await call.message.answer(text, reply_markup=kb)
     await call.answer()
 
 # ---- STAFF: Бронирования списком (без карточек)
 @router.callback_query(F.data == "staff_bookings")
 async def staff_bookings_list(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    lines = list_future_bookings_for_staff_list()
-    if not lines:
+    page = await booking_list_page("staff")
+    if page is None:
         await call.message.answer("Нет будущих бронирований.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="staff_menu")]
         ]))
         return await call.answer()
-    await call.message.answer("Ближайшие бронирования:\n" + "\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="staff_menu")]
-    ]))
+    text, kb = page
+    await call.message.answer(text, reply_markup=kb)
+    await call.answer()
+
+# ---- Листание списков броней: одно сообщение редактируется на месте
+@router.callback_query(F.data.startswith("adm_bk_") | F.data.startswith("staff_bk_"))
+async def bookings_list_page_cb(call: CallbackQuery):
+    # <adm|staff>_bk_<n|p>_<id брони-курсора>
+    kind, _, direction, cursor_id = call.data.split("_")
+    page = await booking_list_page(kind, int(cursor_id), backward=direction == "p")
+    if page is None:
+        # страница собирается запросом к БД; опоздавший alert придёт сообщением
+        return await call.answer("Нет будущих бронирований.", show_alert=True)
+    text, kb = page
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except Exception:
+        await call.message.answer(text, reply_markup=kb)
     await call.answer()
 
 # ---- ADMIN: Управление фото
 @router.callback_query(F.data == "adm_photos")
 async def adm_photos_cb(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Управление фото:", reply_markup=photos_menu_kb())
     await call.answer()
 
 @router.callback_query(F.data == "adm_photos_list")
 async def adm_photos_list(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT * FROM photos ORDER BY id DESC")
-    rows = cursor.fetchall()
+    rows = await db.list_photos()
     # очистим предыдущие кэшированные сообщения
     PHOTO_MSG_CACHE[call.from_user.id] = []
     if not rows:
@@ -1072,8 +2553,6 @@ async def adm_photos_back(call: CallbackQuery):
 
 @router.callback_query(F.data == "adm_photo_add")
 async def adm_photo_add(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await state.set_state(PhotoReplaceFSM.waiting_photo)
     await call.message.answer("Пришлите фото, которое нужно добавить.\n\n", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Назад", callback_data="adm_photos")]
@@ -1084,30 +2563,23 @@ async def adm_photo_add(call: CallbackQuery, state: FSMContext):
 async def adm_photo_receive(message: Message, state: FSMContext):
     largest = message.photo[-1]
     file_id = largest.file_id
-    cursor.execute("INSERT INTO photos (file_id, caption, added_by) VALUES (?,?,?)",
-                   (file_id, message.caption or "", message.from_user.id))
-    conn.commit()
+    await db.add_photo(file_id, message.caption or "", message.from_user.id)
     await message.answer("Фото добавлено ✔️", reply_markup=photos_menu_kb())
     await state.clear()
 
 # ---- Кухня: Stop-list / To-go list
-def kitchen_items(kind: str) -> List[sqlite3.Row]:
-    cursor.execute("SELECT * FROM kitchen_lists WHERE kind=? ORDER BY id DESC", (kind,))
-    return cursor.fetchall()
+async def kitchen_items(kind: str) -> List[sqlite3.Row]:
+    return await db.list_kitchen(kind)
 
 @router.callback_query(F.data == "kitchen_main")
 async def kitchen_main(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Кухня:", reply_markup=kitchen_main_kb())
     await call.answer()
 
 @router.callback_query(F.data.in_({"kitchen_stop", "kitchen_togo"}))
 async def kitchen_list_open(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     kind = "stop" if call.data == "kitchen_stop" else "togo"
-    items = kitchen_items(kind)
+    items = await kitchen_items(kind)
     await call.message.answer(
         "Список позиций:" if items else "Список пуст.",
         reply_markup=kitchen_list_kb(kind, items)
@@ -1116,8 +2588,6 @@ async def kitchen_list_open(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("klist_add_"))
 async def klist_add(call: CallbackQuery, state: FSMContext):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     kind = call.data.split("_")[-1]
     await state.update_data(kind=kind)
     await state.set_state(UserEditFSM.value)
@@ -1128,10 +2598,8 @@ async def klist_add(call: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.startswith("klist_del_"))
 async def klist_del(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     kind = call.data.split("_")[-1]
-    items = kitchen_items(kind)
+    items = await kitchen_items(kind)
     if not items:
         await call.message.answer("Список пуст.", reply_markup=kitchen_main_kb())
         return await call.answer()
@@ -1144,11 +2612,8 @@ async def klist_del(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("klist_rm_"))
 async def klist_rm(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     _, _, kind, sid = call.data.split("_")
-    cursor.execute("DELETE FROM kitchen_lists WHERE id=? AND kind=?", (int(sid), kind))
-    conn.commit()
+    await db.delete_kitchen_item(kind, int(sid))
     await call.message.answer("Удалено.", reply_markup=kitchen_main_kb())
     await call.answer()
 
@@ -1164,8 +2629,7 @@ async def klist_add_value_or_user_edit_value(message: Message, state: FSMContext
     if "kind" in data:
         title = message.text.strip()
         kind = data["kind"]
-        cursor.execute("INSERT INTO kitchen_lists (kind, item_title) VALUES (?,?)", (kind, title))
-        conn.commit()
+        await db.add_kitchen_item(kind, title)
         await message.answer("Добавлено.", reply_markup=kitchen_main_kb())
         await state.clear()
     else:
@@ -1174,46 +2638,6 @@ async def klist_add_value_or_user_edit_value(message: Message, state: FSMContext
         await message.answer("Готово.", reply_markup=users_menu_kb())
         await state.clear()
 
-# -----------------------------------------------------------------------------
-# ADMIN/STAFF списки бронирований (добавлено по ТЗ)
-# -----------------------------------------------------------------------------
-@router.callback_query(F.data == "adm_bookings")
-async def adm_bookings_list(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    rows = list_future_bookings_for_cards()
-    if not rows:
-        await call.message.answer("Нет будущих бронирований.", reply_markup=admin_menu_inline())
-        return await call.answer()
-    for r in rows:
-        card = (f"📌 Бронь #{r['id']}\n"
-                f"👤 {r['fullname'] or '—'}\n"
-                f"📞 {r['phone'] or '—'}\n"
-                f"📅 {r['datetime']}\n"
-                f"📝 {r['notes'] or '—'}\n"
-                f"🔐 Согласие: {r['consent'] or '—'}\n"
-                f"Статус: {r['status'] or '—'}")
-        await call.message.answer(card)
-    await call.message.answer("— Конец списка —", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_admin")]
-    ]))
-    await call.answer()
-
-@router.callback_query(F.data == "staff_bookings")
-async def staff_bookings_list(call: CallbackQuery):
-    if not is_staff_or_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    lines = list_future_bookings_for_staff_list()
-    if not lines:
-        await call.message.answer("Нет будущих бронирований.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="staff_menu")]
-        ]))
-        return await call.answer()
-    await call.message.answer("Ближайшие бронирования:\n" + "\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="staff_menu")]
-    ]))
-    await call.answer()
-
 # ------------------------- Самопроверки -------------------------
 # (оставляем раздел как маркер)
 
@@ -1224,23 +2648,105 @@ async def morning_digest_job():
     # Здесь может быть логика отправки утреннего дайджеста
     pass
 
+async def fsm_sweep_job():
+    removed = await storage.sweep()
+    if removed:
+        logger.info("FSM: удалено просроченных сессий: %d", removed)
+
+async def idempotency_sweep_job():
+    removed = await idempotency.sweep()
+    if removed:
+        logger.info("Идемпотентность: удалено старых ключей: %d", removed)
+
 # -----------------------------------------------------------------------------
 # Регистрация планировщика и запуск бота
 # -----------------------------------------------------------------------------
+def _add_periodic_jobs():
+    scheduler.add_job(morning_digest_job, "cron", hour=7, minute=50, id="morning_digest", replace_existing=True)
+    scheduler.add_job(cleanup_past_bookings, 'cron', hour=23, minute=59, id='cleanup_past', replace_existing=True)
+    scheduler.add_job(fsm_sweep_job, "interval", seconds=FSM_SWEEP_INTERVAL, id="fsm_sweep", replace_existing=True)
+    scheduler.add_job(idempotency_sweep_job, "interval", hours=1, id="idempotency_sweep", replace_existing=True)
+
 async def on_startup():
-    scheduler.add_job(morning_digest_job, "cron", hour=7, minute=50, id="morning_digest")
-    scheduler.add_job(cleanup_past_bookings, 'cron', hour=23, minute=59, id='cleanup_past')
+    notifier.start()
+    await idempotency.load()
+    if not RUN_SCHEDULER:
+        # задачи по расписанию выполняет воркер с RUN_SCHEDULER=1
+        logger.info("Scheduler disabled in this worker (RUN_SCHEDULER=0)")
+        return
     scheduler.start()
+    # jobstore — в том же файле БД: запись задач идёт в потоке БД, а не в event loop
+    await db.run(_add_periodic_jobs)
     logger.info("Scheduler started")
 
 def setup_handlers():
     # Все обработчики уже навешаны через router
     pass
 
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook-обработчик: отвечает Telegram сразу, апдейт обрабатывается в фоне.
+
+    Фоновых задач не больше limit: когда все заняты, ответ на очередной POST
+    задерживается, и Telegram сам притормаживает доставку (обратное давление).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, limit: int):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self):
+        # при остановке сервера: дождаться апдейтов в обработке, потом закрыть сессию бота
+        if self._background_feed_update_tasks:
+            await asyncio.wait(set(self._background_feed_update_tasks), timeout=10)
+        await super().close()
+
+async def run_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook: задайте WEBHOOK_URL")
+    app = web.Application()
+    BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET, limit=UPDATE_QUEUE).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_REUSE_PORT or None).start()
+    # только те типы апдейтов, на которые есть хендлеры
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types(),
+                          max_connections=min(100, UPDATE_CONCURRENCY))
+    logger.info("Webhook: %s -> http://%s:%s%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     setup_handlers()
     await on_startup()
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # webhook от прошлого запуска мешает getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_QUEUE)
+    finally:
+        await notifier.stop()
+        await db.flush()
+        db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,115 @@
+# Очередь чата и изоляция FSM: быстрые сообщения на одном шаге анкеты
+# обрабатываются по очереди, а один чат не может занять все места приёма.
+# Боты загружаются из файлов с временной БД, запросы к Bot API перехватываются.
+
+import asyncio
+import datetime
+import importlib.util
+import itertools
+import os
+
+import pytest
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message, Update, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOTS = ["vera_assistant_v0.4.1.py", "bot_0,4,2_test.py"]
+_ids = itertools.count(1000)
+
+
+class RecordingSession(BaseSession):
+    """Сессия без сети: запоминает методы, на sendMessage отвечает сообщением."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, SendMessage):
+            return Message(message_id=next(_ids), date=datetime.datetime.now(),
+                           chat=Chat(id=int(method.chat_id), type="private"), text=method.text)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture(scope="module", params=BOTS)
+def bot_module(request, tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("bot")
+    os.environ["DB_FILE"] = str(workdir / "bot.db")
+    os.environ["KEYFILE"] = str(workdir / "bot.key")
+    spec = importlib.util.spec_from_file_location(f"bot_under_test_{BOTS.index(request.param)}",
+                                                  os.path.join(ROOT, request.param))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    if mod.router.parent_router is None:
+        mod.dp.include_router(mod.router)
+    session = RecordingSession()
+    session.middleware(mod.callback_acks.request)
+    mod.bot.session = session
+    yield mod
+    asyncio.run(mod.db.flush())
+
+
+def text_update(chat_id: int, text: str) -> Update:
+    user = User(id=chat_id, is_bot=False, first_name="Гость")
+    return Update(update_id=next(_ids), message=Message(
+        message_id=next(_ids), date=datetime.datetime.now(),
+        chat=Chat(id=chat_id, type="private"), from_user=user, text=text))
+
+
+def test_back_to_back_messages_in_one_state(bot_module):
+    m = bot_module
+    chat_id = 4242
+
+    async def scenario():
+        ctx = m.dp.fsm.resolve_context(m.bot, chat_id, chat_id)
+        await ctx.set_state(m.BookingFSM.fullname)
+        await ctx.set_data({})
+        await asyncio.gather(m.dp.feed_update(m.bot, text_update(chat_id, "Иван Петров")),
+                             m.dp.feed_update(m.bot, text_update(chat_id, "+79990001122")))
+        return await ctx.get_state(), await ctx.get_data()
+
+    state, data = asyncio.run(scenario())
+    assert state == m.BookingFSM.datetime.state
+    assert data["fullname"] == "Иван Петров"
+    assert data["phone"] == "+79990001122"
+
+
+def test_flooding_chat_is_bounded(bot_module):
+    m = bot_module
+    queue = m.ChatQueueMiddleware(per_chat=2)
+    handled = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def handler(event, data):
+            await gate.wait()
+            handled.append(event.update_id)
+
+        updates = [text_update(7, f"сообщение {i}") for i in range(5)]
+        for u in updates:
+            u.message.as_(m.bot)
+        tasks = [asyncio.ensure_future(queue(handler, u, {"event_chat": u.message.chat,
+                                                         "event_from_user": u.message.from_user}))
+                 for u in updates]
+        await asyncio.sleep(0.05)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return updates
+
+    m.bot.session.calls.clear()
+    updates = asyncio.run(scenario())
+    # в очереди чата не больше per_chat апдейтов, остальные отклонены одним ответом
+    assert handled == [u.update_id for u in updates[:2]]
+    assert queue.dropped == 3
+    assert not queue._chats
+    replies = [c for c in m.bot.session.calls if isinstance(c, SendMessage) and c.chat_id == 7]
+    assert len(replies) == 1
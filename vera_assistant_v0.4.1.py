@@ -8,32 +8,56 @@
 # - Меню управления, Кухня (Stop-list / To-go list) — сохранены и работают
 # - Управление фото (замена/удаление) — сохранено
 # - Везде где уместно — «Назад» (кроме главного меню)
-# Требования: aiogram>=3.7.0, apscheduler, sqlite3, (опционально cryptography)
-# Установка: pip install aiogram apscheduler cryptography
+# Требования: aiogram>=3.7.0, apscheduler, sqlite3, (опционально cryptography, sqlalchemy)
+# Установка: pip install aiogram apscheduler cryptography sqlalchemy
 
 import asyncio
 import logging
 import sqlite3
 import base64
 import os
+import re
+import signal
 import traceback
 import csv
+import codecs
+import gzip
 import io
+import json
+import time
+import functools
+import hashlib
+import itertools
+import math
+import tempfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Iterable, Iterator
 
-from aiogram import Bot, Dispatcher, F, types, Router
+from aiogram import Bot, Dispatcher, F, types, Router, BaseMiddleware
+from aiogram.methods import AnswerCallbackQuery
 from aiogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
-    BufferedInputFile, ContentType
+    ContentType, InputMediaPhoto, InputFile, InlineQuery, InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto, InputTextMessageContent
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.filters import CommandStart, Command
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, DataNotDictLikeError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import FormData, web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
 
 # ---------------------------------------------------------
 # ЛОГИ
@@ -55,6 +79,74 @@ ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "1077878777").split(","
 DB_FILE = os.environ.get("DB_FILE", "vera.db")
 KEYFILE = os.environ.get("KEYFILE", "vera.key")
 
+# Профиль хранилища SQLite (PRAGMA при открытии соединения).
+# Пустое значение или "default" — оставить настройку SQLite по умолчанию.
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_MMAP_SIZE = os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024))  # байт
+DB_CACHE_SIZE = os.environ.get("DB_CACHE_SIZE", "-16000")              # <0 — в КиБ
+DB_TEMP_STORE = os.environ.get("DB_TEMP_STORE", "MEMORY")
+DB_BUSY_TIMEOUT = os.environ.get("DB_BUSY_TIMEOUT", "5000")            # мс
+# Групповой коммит: записи копятся до DB_COMMIT_BATCH штук или DB_COMMIT_DELAY_MS мс.
+# 0 — до следующего шага event loop; пока идёт COMMIT, новые записи всё равно
+# собираются в следующую пачку, так что под нагрузкой окно растёт само.
+DB_COMMIT_BATCH = int(os.environ.get("DB_COMMIT_BATCH", "64"))
+DB_COMMIT_DELAY_MS = float(os.environ.get("DB_COMMIT_DELAY_MS", "0"))
+# Импорт CSV: строк в одной пачке executemany; кусков по 64 КиБ в очереди загрузки
+IMPORT_BATCH = int(os.environ.get("IMPORT_BATCH", "1000"))
+IMPORT_QUEUE_CHUNKS = int(os.environ.get("IMPORT_QUEUE_CHUNKS", "16"))
+# Экспорт CSV: размер пачки чтения, порог выгрузки буфера на диск, сжатие ("", gzip, zip)
+EXPORT_CHUNK = int(os.environ.get("EXPORT_CHUNK", "1000"))
+EXPORT_SPOOL_MAX = int(os.environ.get("EXPORT_SPOOL_MAX", str(4 * 1024 * 1024)))  # байт
+EXPORT_COMPRESSION = os.environ.get("EXPORT_COMPRESSION", "").strip().lower()
+# Поиск по меню: сколько позиций отдавать и сколько секунд Telegram кэширует inline-ответ
+SEARCH_LIMIT = int(os.environ.get("SEARCH_LIMIT", "10"))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))
+
+# Получение обновлений: polling (по умолчанию) или webhook со встроенным aiohttp-сервером.
+# В webhook-режиме Telegram (или локальный стенд из TELEGRAM_API_URL) шлёт POST на
+# WEBHOOK_URL; обратный прокси передаёт его на WEBHOOK_HOST:WEBHOOK_PORT + WEBHOOK_PATH.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")             # https://bot.example.com/tg
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/tg")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+# пусто — выводится из токена: у всех воркеров один и тот же секрет
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+# несколько процессов на одном порту (SO_REUSEPORT), ядро делит соединения между ними.
+# Процессы видят общую БД, но не память друг друга: кэши процесса (роли, FSM, меню)
+# по умолчанию выключены, а порядок апдейтов одного чата соблюдается только внутри
+# процесса — соседние апдейты чата могут попасть в разные воркеры.
+WEBHOOK_REUSE_PORT = os.environ.get("WEBHOOK_REUSE_PORT", "0") == "1"
+MULTI_WORKER = BOT_MODE == "webhook" and WEBHOOK_REUSE_PORT
+# планировщик (напоминания, дайджест, чистки) — ровно в одном процессе: ему RUN_SCHEDULER=1,
+# остальным воркерам 0 (их задачи всё равно пишутся в общий jobstore)
+RUN_SCHEDULER = os.environ.get("RUN_SCHEDULER", "0" if MULTI_WORKER else "1") == "1"
+# Обработка обновлений: внутри чата — строго по очереди, между чатами — параллельно.
+# UPDATE_CONCURRENCY — хендлеров одновременно; UPDATE_QUEUE — апдейтов в работе вместе
+# с ожидающими (лимит polling/webhook); CHAT_QUEUE — очередь одного чата, сверх неё
+# нажатия кнопок отбрасываются, на лишние сообщения бот просит подождать.
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+UPDATE_QUEUE = int(os.environ.get("UPDATE_QUEUE", "256"))
+CHAT_QUEUE = int(os.environ.get("CHAT_QUEUE", "8"))
+# Через сколько секунд нажатая кнопка подтверждается сама, если хендлер ещё не ответил
+CALLBACK_ACK_DELAY = float(os.environ.get("CALLBACK_ACK_DELAY", "0.1"))
+# Свой Bot API сервер (telegram-bot-api --local или тестовый стенд); пусто — api.telegram.org
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+TELEGRAM_API_LOCAL = os.environ.get("TELEGRAM_API_LOCAL", "0") == "1"
+
+# FSM (незаконченные диалоги) хранится в DB_FILE; сессия без изменений дольше FSM_TTL
+# секунд сбрасывается и удаляется фоновой чисткой раз в FSM_SWEEP_INTERVAL секунд.
+FSM_TTL = float(os.environ.get("FSM_TTL", str(24 * 3600)))
+FSM_SWEEP_INTERVAL = int(os.environ.get("FSM_SWEEP_INTERVAL", "600"))
+# горячие сессии в памяти процесса; 0 — без кэша (несколько воркеров на одной БД)
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "0" if MULTI_WORKER else "2048"))
+
+# Идемпотентность создания брони (повторная доставка, двойное нажатие): ключи живут
+# IDEMPOTENCY_TTL секунд; IDEMPOTENCY_CAPACITY — расчётное число ключей для Bloom-фильтра
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", str(7 * 24 * 3600)))
+IDEMPOTENCY_CAPACITY = int(os.environ.get("IDEMPOTENCY_CAPACITY", "100000"))
+
 VERSION = "v0.4.0-patch"
 
 # Роли
@@ -93,6 +185,45 @@ if HAS_FERNET:
 else:
     FERNET = None
 
+# Хранилище задач планировщика (опционально SQLAlchemy): таймеры переживают рестарт
+try:
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    from sqlalchemy import create_engine, event as sa_event
+    HAS_SQLALCHEMY = True
+except Exception:
+    HAS_SQLALCHEMY = False
+
+SCHEDULER_MISFIRE_GRACE = int(os.environ.get("SCHEDULER_MISFIRE_GRACE", "3600"))  # сек.
+# несколько воркеров: как часто планировщик перечитывает общий jobstore, сек.
+SCHEDULER_POLL = float(os.environ.get("SCHEDULER_POLL", "30"))
+
+def _jobstore_engine():
+    # тот же файл, что у Database, — и тот же профиль PRAGMA (busy_timeout, synchronous…);
+    # профиль берётся при подключении, когда db уже открыта и перевела файл в WAL
+    engine = create_engine(f"sqlite:///{DB_FILE}", connect_args={"check_same_thread": False})
+
+    @sa_event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_conn, _record):
+        for name, value in db.pragmas.items():
+            if name != "journal_mode":  # режим журнала хранится в файле БД
+                dbapi_conn.execute(f"PRAGMA {name}={value}")
+
+    return engine
+
+def make_scheduler() -> AsyncIOScheduler:
+    # задачи хранятся в том же DB_FILE (таблица apscheduler_jobs);
+    # пропущенные за время простоя запуски схлопываются в один (coalesce).
+    # add_job/remove_job коммитят в этот файл синхронно — вызывать их через db.run
+    if HAS_SQLALCHEMY:
+        jobstore = SQLAlchemyJobStore(engine=_jobstore_engine(), tablename="apscheduler_jobs")
+    else:
+        logger.warning("sqlalchemy не установлен — задачи планировщика хранятся только в памяти")
+        jobstore = MemoryJobStore()
+    return AsyncIOScheduler(
+        jobstores={"default": jobstore},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": SCHEDULER_MISFIRE_GRACE}
+    )
+
 # ---------------------------------------------------------
 # Утилита безопасного редактирования сообщения
 # ---------------------------------------------------------
@@ -111,8 +242,487 @@ async def safe_edit(message: Message, text: str, reply_markup: Optional[InlineKe
 # ---------------------------------------------------------
 # БД
 # ---------------------------------------------------------
-conn = sqlite3.connect(DB_FILE)
-conn.row_factory = sqlite3.Row
+PRAGMA_ORDER = ("busy_timeout", "journal_mode", "synchronous", "cache_size", "temp_store", "mmap_size")
+PRAGMA_CHOICES = {
+    "journal_mode": {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"},
+    "synchronous": {"OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"},
+    "temp_store": {"DEFAULT", "FILE", "MEMORY", "0", "1", "2"},
+}
+
+def db_profile() -> Dict[str, str]:
+    return {
+        "busy_timeout": DB_BUSY_TIMEOUT,
+        "journal_mode": DB_JOURNAL_MODE,
+        "synchronous": DB_SYNCHRONOUS,
+        "cache_size": DB_CACHE_SIZE,
+        "temp_store": DB_TEMP_STORE,
+        "mmap_size": DB_MMAP_SIZE,
+    }
+
+class Database:
+    """Доступ к SQLite вне event loop.
+
+    Все запросы выполняются в одном выделенном потоке (sqlite3-соединение
+    не рассчитано на параллельную запись из нескольких потоков), у каждой
+    операции — свой курсор, поэтому конкурентные хендлеры не видят чужих
+    результатов. Хендлеры вызывают только async-методы.
+    """
+
+    def __init__(self, path: str, pragmas: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.pragmas = self._apply_pragmas(db_profile() if pragmas is None else pragmas)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vera-db")
+        # групповой коммит (живёт в event loop)
+        self.commit_batch = max(1, DB_COMMIT_BATCH)
+        self.commit_delay = max(0.0, DB_COMMIT_DELAY_MS) / 1000
+        self._pending: List[Tuple[Any, tuple, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: set = set()
+        self._inflight = 0
+        self.commits = 0
+        self.writes = 0
+
+    def _apply_pragmas(self, pragmas: Dict[str, str]) -> Dict[str, Any]:
+        # busy_timeout первым: смена journal_mode требует блокировки файла
+        applied = {}
+        for name in PRAGMA_ORDER:
+            value = (pragmas.get(name) or "").strip()
+            if not value or value.lower() == "default":
+                continue
+            allowed = PRAGMA_CHOICES.get(name)
+            if allowed is not None:
+                value = value.upper()
+                ok = value in allowed
+            else:
+                ok = value.lstrip("-").isdigit()
+            if not ok:
+                logger.warning("PRAGMA %s=%r не поддерживается — пропускаю", name, value)
+                continue
+            self.conn.execute(f"PRAGMA {name}={value}")
+            row = self.conn.execute(f"PRAGMA {name}").fetchone()
+            applied[name] = row[0] if row else None
+        if applied:
+            logger.info("SQLite %s: %s", self.path, ", ".join(f"{k}={v}" for k, v in applied.items()))
+        return applied
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.conn.close()
+
+    def connect_aux(self) -> sqlite3.Connection:
+        # отдельное соединение для долгих операций (экспорт, импорт) в потоке пула,
+        # чтобы не занимать поток БД; профиль PRAGMA — как у основного
+        conn = sqlite3.connect(self.path)
+        for name, value in self.pragmas.items():
+            if name != "journal_mode":  # режим журнала хранится в файле БД
+                conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    # ---- групповой коммит ----
+    async def write(self, fn, *args):
+        """Выполняет fn(*args) в потоке БД внутри общей транзакции.
+
+        Записи конкурентных хендлеров копятся commit_delay секунд (или до
+        commit_batch штук) и фиксируются одним COMMIT; await возвращается
+        только после него. Каждая запись — в своём SAVEPOINT, поэтому ошибка
+        одной не откатывает соседние. fn не должна сама делать commit.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((fn, args, fut))
+        if len(self._pending) >= self.commit_batch:
+            self._start_flush()
+        elif self._flush_handle is None and not self._inflight:
+            # пока идёт предыдущий коммит, записи просто копятся — он сам запустит следующий
+            self._flush_handle = loop.call_later(self.commit_delay, self._start_flush)
+        return await fut
+
+    async def flush(self):
+        # дождаться фиксации всего накопленного (перед остановкой)
+        self._start_flush()
+        while self._flush_tasks:
+            await asyncio.gather(*list(self._flush_tasks), return_exceptions=True)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self._inflight += 1
+        task = asyncio.get_running_loop().create_task(self._flush(batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await self.run(self._commit_batch, [(fn, args) for fn, args, _ in batch])
+        except Exception as e:
+            logger.exception("Групповой коммит не удался (%d записей)", len(batch))
+            results = [e] * len(batch)
+        finally:
+            self._inflight -= 1
+        for (_, _, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+        if self._pending and not self._inflight:
+            self._start_flush()
+
+    def _commit_batch(self, ops) -> list:
+        results = []
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        try:
+            for fn, args in ops:
+                self.conn.execute("SAVEPOINT write_op")
+                try:
+                    results.append(fn(*args))
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO write_op")
+                    results.append(e)
+                self.conn.execute("RELEASE write_op")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.commits += 1
+        self.writes += len(ops)
+        return results
+
+    # ---- базовые операции (выполняются в потоке БД) ----
+    def _fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        cur = self.conn.execute(sql, params)
+        try:
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        cur = self.conn.execute(sql, params)
+        try:
+            return cur.fetchone()
+        finally:
+            cur.close()
+
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        # без commit: вызывается внутри транзакции группового коммита
+        cur = self.conn.execute(sql, params)
+        try:
+            return cur.lastrowid
+        finally:
+            cur.close()
+
+    def _executemany(self, sql: str, seq) -> int:
+        # без commit: как и _execute, фиксируется групповым коммитом
+        cur = self.conn.executemany(sql, seq)
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return await self.run(self._fetchall, sql, params)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run(self._fetchone, sql, params)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        return await self.write(self._execute, sql, params)
+
+    async def executemany(self, sql: str, seq) -> int:
+        return await self.write(self._executemany, sql, list(seq))
+
+    # ---- пользователи ----
+    async def get_role_value(self, user_id: int) -> Any:
+        r = await self.fetchone("SELECT role FROM users WHERE user_id=?", (user_id,))
+        return r["role"] if r else None
+
+    async def get_user(self, user_id: int) -> Optional[sqlite3.Row]:
+        return await self.fetchone(
+            "SELECT user_id, role, fullname, phone, username, passport FROM users WHERE user_id=?", (user_id,))
+
+    async def get_username(self, user_id: int) -> Optional[str]:
+        r = await self.fetchone("SELECT username FROM users WHERE user_id=?", (user_id,))
+        return r["username"] if r and r["username"] else None
+
+    async def list_users(self, limit: int = 50) -> List[sqlite3.Row]:
+        return await self.fetchall(
+            "SELECT user_id, role, fullname, phone, username, passport FROM users ORDER BY user_id DESC LIMIT ?", (limit,))
+
+    async def list_users_by_roles(self, roles: Optional[List[int]] = None) -> List[sqlite3.Row]:
+        if roles:
+            return await self.fetchall(
+                "SELECT user_id, fullname, username FROM users WHERE role IN (%s) ORDER BY fullname COLLATE NOCASE"
+                % ",".join("?" * len(roles)), tuple(roles))
+        return await self.fetchall("SELECT user_id, fullname, username FROM users ORDER BY fullname COLLATE NOCASE")
+
+    async def list_user_ids_by_role(self, role: int) -> List[int]:
+        rows = await self.fetchall("SELECT user_id FROM users WHERE role=?", (role,))
+        return [r["user_id"] for r in rows]
+
+    def _touch_user(self, user_id: int, fullname: Optional[str], username: Optional[str]):
+        # /start: создаём гостя, дописываем ФИО и username, если они ещё пусты
+        self.conn.execute("INSERT OR IGNORE INTO users (user_id, role) VALUES (?, ?)", (user_id, ROLE_GUEST))
+        if fullname:
+            self.conn.execute("UPDATE users SET fullname=? WHERE user_id=? AND (fullname IS NULL OR fullname='')",
+                              (fullname, user_id))
+        if username:
+            self.conn.execute("UPDATE users SET username=? WHERE user_id=? AND (username IS NULL OR username='')",
+                              (username, user_id))
+
+    async def touch_user(self, user_id: int, fullname: Optional[str] = None, username: Optional[str] = None):
+        await self.write(self._touch_user, user_id, fullname, username)
+
+    def _set_role(self, user_id: int, role: int):
+        self.conn.execute("INSERT OR IGNORE INTO users (user_id, role) VALUES (?,?)", (user_id, role))
+        self.conn.execute("UPDATE users SET role=? WHERE user_id=?", (role, user_id))
+
+    async def set_role(self, user_id: int, role: int):
+        await self.write(self._set_role, user_id, role)
+
+    def _upsert_user(self, user_id: int, fields: Dict[str, Any]):
+        exists = self._fetchone("SELECT user_id FROM users WHERE user_id=?", (user_id,)) is not None
+        if not exists:
+            self.conn.execute(
+                "INSERT INTO users (user_id, role, fullname, phone, username, passport) VALUES (?,?,?,?,?,?)",
+                (user_id, fields.get("role", ROLE_GUEST), fields.get("fullname"), fields.get("phone"),
+                 fields.get("username"), fields.get("passport")))
+        elif fields:
+            self.conn.execute(f"UPDATE users SET {', '.join(k + '=?' for k in fields)} WHERE user_id=?",
+                              (*fields.values(), user_id))
+
+    async def upsert_user(self, user_id: int, **fields):
+        # None — «не менять»; в UPDATE попадают только переданные поля
+        fields = {k: v for k, v in fields.items() if v is not None and k in USER_FIELDS}
+        await self.write(self._upsert_user, user_id, fields)
+
+    async def update_user_field(self, user_id: int, field: str, value: Any):
+        if field not in USER_FIELDS:
+            raise ValueError(f"unknown users field: {field}")
+        await self.execute(f"UPDATE users SET {field}=? WHERE user_id=?", (value, user_id))
+
+    async def delete_user(self, user_id: int):
+        await self.execute("DELETE FROM users WHERE user_id=?", (user_id,))
+
+    # ---- бронирования ----
+    BOOKING_INSERT = """
+        INSERT INTO bookings (user_id, fullname, phone, datetime, source, notes, status, starts_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    async def add_booking(self, user_id: Optional[int], fullname: str, phone: str, dt_text: str,
+                          source: str, notes: str, status: str, starts_at: Optional[str]) -> int:
+        return await self.execute(self.BOOKING_INSERT,
+                                  (user_id, fullname, phone, dt_text, source, notes, status, starts_at))
+
+    def _add_booking_once(self, key: str, params: tuple) -> Optional[int]:
+        # ключ и бронь — в одном SAVEPOINT: либо обе записи, либо ни одной
+        if not self._claim_key(key):
+            return None
+        return self._execute(self.BOOKING_INSERT, params)
+
+    async def add_booking_once(self, key: str, user_id: Optional[int], fullname: str, phone: str, dt_text: str,
+                               source: str, notes: str, status: str, starts_at: Optional[str]) -> Optional[int]:
+        # None — бронь с этим ключом уже создана
+        return await self.write(self._add_booking_once, key,
+                                (user_id, fullname, phone, dt_text, source, notes, status, starts_at))
+
+    async def get_booking(self, booking_id: int) -> Optional[sqlite3.Row]:
+        return await self.fetchone("SELECT * FROM bookings WHERE id=?", (booking_id,))
+
+    async def set_booking_status(self, booking_id: int, status: str):
+        await self.execute("UPDATE bookings SET status=? WHERE id=?", (status, booking_id))
+
+    def _set_booking_status_if_changed(self, booking_id: int, status: str) -> Optional[str]:
+        row = self._fetchone("SELECT status FROM bookings WHERE id=?", (booking_id,))
+        if row is None:
+            return None
+        before = row["status"] or "pending"
+        if before != status:
+            self._execute("UPDATE bookings SET status=? WHERE id=?", (status, booking_id))
+        return before
+
+    async def set_booking_status_if_changed(self, booking_id: int, status: str) -> Optional[str]:
+        # прежний статус (равен status — повторное нажатие, ничего не записано); None — брони нет.
+        # Смотрит на текущую строку, так что «подтвердить → отменить → подтвердить» проходит
+        return await self.write(self._set_booking_status_if_changed, booking_id, status)
+
+    async def list_bookings_starting_between(self, start: str, end: Optional[str] = None) -> List[sqlite3.Row]:
+        # диапазонный запрос по индексу idx_bookings_starts_at
+        if end is None:
+            return await self.fetchall("SELECT * FROM bookings WHERE starts_at > ? ORDER BY starts_at", (start,))
+        return await self.fetchall(
+            "SELECT * FROM bookings WHERE starts_at BETWEEN ? AND ? ORDER BY starts_at", (start, end))
+
+    # ---- меню ----
+    async def list_active_menu(self) -> List[sqlite3.Row]:
+        # порядок совпадает с idx_menu_active_cat — без отдельной сортировки
+        return await self.fetchall("SELECT * FROM menu_items WHERE is_active=1 ORDER BY category, title")
+
+    async def count_active_categories(self) -> List[sqlite3.Row]:
+        return await self.fetchall(
+            "SELECT category, COUNT(*) AS n FROM menu_items WHERE is_active=1 GROUP BY category")
+
+    def _search_menu_scan(self, words: List[str], limit: int) -> List[sqlite3.Row]:
+        # запасной путь без FTS5: LIKE в SQLite не сворачивает регистр кириллицы
+        found = []
+        for r in self._fetchall("SELECT * FROM menu_items WHERE is_active=1 ORDER BY category, title"):
+            hay = " ".join(r[k] or "" for k in ("title", "description", "category")).casefold().replace("ё", "е")
+            if all(w in hay for w in words):
+                found.append(r)
+                if len(found) >= limit:
+                    break
+        return found
+
+    async def search_menu(self, query: str, limit: int = SEARCH_LIMIT) -> List[sqlite3.Row]:
+        words = re.findall(r"\w+", query.casefold().replace("ё", "е"))
+        if not words:
+            return []
+        if not HAS_FTS5:
+            return await self.run(self._search_menu_scan, words, limit)
+        # слово — префикс ("бор" найдёт «Борщ»), кроме однобуквенных: такой префикс
+        # совпадает почти со всем меню; название весит больше описания
+        match = " ".join(f'"{w}"*' if len(w) > 1 else f'"{w}"' for w in words)
+        return await self.fetchall("""
+            SELECT m.* FROM menu_fts JOIN menu_items m ON m.id = menu_fts.rowid
+            WHERE menu_fts MATCH ? AND m.is_active=1
+            ORDER BY bm25(menu_fts, 10.0, 2.0, 1.0) LIMIT ?
+        """, (match, limit))
+
+    def _menu_state(self, item_id: int) -> Optional[Tuple[str, int]]:
+        r = self._fetchone("SELECT category, is_active FROM menu_items WHERE id=?", (item_id,))
+        return (r["category"] or "", r["is_active"]) if r else None
+
+    async def list_menu_items(self) -> List[sqlite3.Row]:
+        return await self.fetchall("SELECT * FROM menu_items ORDER BY id DESC")
+
+    async def get_menu_item(self, item_id: int) -> Optional[sqlite3.Row]:
+        return await self.fetchone("SELECT * FROM menu_items WHERE id=?", (item_id,))
+
+    async def add_menu_item(self, title: str, description: str, price: float, category: str,
+                            photo_url: str, is_active: int = 1) -> int:
+        return await self.execute(
+            "INSERT INTO menu_items (title, description, price, category, photo_url, is_active) VALUES (?, ?, ?, ?, ?, ?)",
+            (title, description, price, category, photo_url, is_active))
+
+    def _update_menu_field(self, item_id: int, field: str, value: Any):
+        before = self._menu_state(item_id)
+        # ручная правка сбрасывает row_hash: следующий импорт перезапишет позицию из CSV
+        self._execute(f"UPDATE menu_items SET {field}=?, row_hash=NULL WHERE id=?", (value, item_id))
+        return before, self._menu_state(item_id)
+
+    async def update_menu_field(self, item_id: int, field: str, value: Any):
+        # возвращает (категория, is_active) позиции до и после правки
+        if field not in MENU_FIELDS:
+            raise ValueError(f"unknown menu_items field: {field}")
+        return await self.write(self._update_menu_field, item_id, field, value)
+
+    def _delete_menu_item(self, item_id: int) -> Optional[Tuple[str, int]]:
+        before = self._menu_state(item_id)
+        self._execute("DELETE FROM menu_items WHERE id=?", (item_id,))
+        return before
+
+    async def delete_menu_item(self, item_id: int) -> Optional[Tuple[str, int]]:
+        return await self.write(self._delete_menu_item, item_id)
+
+    # ---- фото ----
+    async def list_photos(self, limit: Optional[int] = None, offset: int = 0) -> List[sqlite3.Row]:
+        if limit:
+            return await self.fetchall("SELECT * FROM photos ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset))
+        return await self.fetchall("SELECT * FROM photos ORDER BY id DESC")
+
+    async def add_photo(self, file_id: str, caption: str, added_by: Optional[int]) -> int:
+        return await self.execute("INSERT INTO photos (file_id, caption, added_by) VALUES (?, ?, ?)",
+                                  (file_id, caption, added_by))
+
+    async def update_photo_file(self, photo_id: int, file_id: str):
+        await self.execute("UPDATE photos SET file_id=? WHERE id=?", (file_id, photo_id))
+
+    async def delete_photo(self, photo_id: int):
+        await self.execute("DELETE FROM photos WHERE id=?", (photo_id,))
+
+    # ---- кухня (stop-list / to-go list) ----
+    @staticmethod
+    def _kitchen_table(list_type: str) -> str:
+        return "stop_list" if list_type == "stop" else "togo_list"
+
+    async def list_kitchen(self, list_type: str) -> List[sqlite3.Row]:
+        return await self.fetchall(f"SELECT * FROM {self._kitchen_table(list_type)} ORDER BY id DESC")
+
+    async def add_kitchen_item(self, list_type: str, title: str) -> int:
+        return await self.execute(f"INSERT INTO {self._kitchen_table(list_type)} (title) VALUES(?)", (title,))
+
+    async def delete_kitchen_item(self, list_type: str, item_id: int):
+        await self.execute(f"DELETE FROM {self._kitchen_table(list_type)} WHERE id=?", (item_id,))
+
+    # ---- FSM ----
+    async def fsm_load(self, key: str) -> Optional[sqlite3.Row]:
+        return await self.fetchone("SELECT state, data, updated_at FROM fsm_state WHERE key=?", (key,))
+
+    async def fsm_save(self, key: str, state: Optional[str], data: Optional[str], updated_at: float):
+        await self.execute("""
+            INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+        """, (key, state, data, updated_at))
+
+    async def fsm_delete(self, key: str):
+        await self.execute("DELETE FROM fsm_state WHERE key=?", (key,))
+
+    def _fsm_sweep(self, before: float) -> int:
+        # по idx_fsm_state_updated: просматриваются только просроченные строки
+        cur = self.conn.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,))
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def fsm_sweep(self, before: float) -> int:
+        return await self.write(self._fsm_sweep, before)
+
+    # ---- идемпотентность ----
+    def _claim_key(self, key: str) -> bool:
+        # True — ключ новый и теперь занят; False — такая запись уже была
+        cur = self.conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, created_at) VALUES (?, ?)",
+                                (key, time.time()))
+        try:
+            return cur.rowcount == 1
+        finally:
+            cur.close()
+
+    async def has_idempotency_key(self, key: str) -> bool:
+        return await self.fetchone("SELECT 1 FROM idempotency_keys WHERE key=?", (key,)) is not None
+
+    async def list_idempotency_keys(self) -> List[str]:
+        return [r[0] for r in await self.fetchall("SELECT key FROM idempotency_keys")]
+
+    def _idempotency_sweep(self, before: float) -> int:
+        cur = self.conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (before,))
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def idempotency_sweep(self, before: float) -> int:
+        return await self.write(self._idempotency_sweep, before)
+
+USER_FIELDS = {"role", "fullname", "phone", "username", "passport"}
+MENU_FIELDS = {"title", "description", "price", "category", "photo_url", "is_active"}
+
+db = Database(DB_FILE)
+# Синхронный курсор — только для схемы, миграций и самопроверок при старте.
+# Во время работы бота все запросы идут через db.
+conn = db.conn
 cursor = conn.cursor()
 
 # Таблицы
@@ -171,6 +781,52 @@ def ensure_bookings_status_column():
         logger.error("Migration status column error: %s", e)
 ensure_bookings_status_column()
 
+# ---- Миграции: нормализованное время брони starts_at (+ индекс) ----
+# Формат хранения — ISO «YYYY-MM-DD HH:MM:SS», строки сравниваются лексикографически,
+# поэтому выборка «ближайших» броней идёт по индексу, без strptime на каждую строку.
+BOOKING_TS_FMT = "%Y-%m-%d %H:%M:%S"
+BOOKING_INPUT_FORMATS = ("%d.%m %H:%M", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M")
+
+def parse_booking_datetime(text: Optional[str], now: Optional[datetime] = None) -> Optional[datetime]:
+    if not text:
+        return None
+    text = text.strip()
+    for fmt in BOOKING_INPUT_FORMATS:
+        try:
+            dt = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if dt.year == 1900:
+            dt = dt.replace(year=(now or datetime.now()).year)
+        return dt
+    return None
+
+def booking_starts_at(text: Optional[str]) -> Optional[str]:
+    dt = parse_booking_datetime(text)
+    return dt.strftime(BOOKING_TS_FMT) if dt else None
+
+def ensure_bookings_starts_at_column():
+    try:
+        cursor.execute("PRAGMA table_info(bookings)")
+        cols = [r[1] for r in cursor.fetchall()]
+        if "starts_at" not in cols:
+            cursor.execute("ALTER TABLE bookings ADD COLUMN starts_at TEXT")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_starts_at ON bookings(starts_at)")
+        # разовый бэкфилл: старые записи без starts_at
+        cursor.execute("SELECT id, datetime FROM bookings WHERE starts_at IS NULL")
+        updates = []
+        for r in cursor.fetchall():
+            ts = booking_starts_at(r["datetime"])
+            if ts:
+                updates.append((ts, r["id"]))
+        if updates:
+            cursor.executemany("UPDATE bookings SET starts_at=? WHERE id=?", updates)
+            logger.info("Backfilled starts_at for %d bookings", len(updates))
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration starts_at column error: %s", e)
+ensure_bookings_starts_at_column()
+
 # ---- Миграции: добавляем username и passport в users ----
 def ensure_users_extra_columns():
     try:
@@ -185,59 +841,355 @@ def ensure_users_extra_columns():
         logger.error("Migration users extra columns error: %s", e)
 ensure_users_extra_columns()
 
+# ---- Миграции: хэш содержимого позиции меню (для повторных импортов) ----
+def ensure_menu_row_hash_column():
+    try:
+        cursor.execute("PRAGMA table_info(menu_items)")
+        cols = [r[1] for r in cursor.fetchall()]
+        if "row_hash" not in cols:
+            cursor.execute("ALTER TABLE menu_items ADD COLUMN row_hash TEXT")
+            conn.commit()
+    except Exception as e:
+        logger.error("Migration menu row_hash column error: %s", e)
+ensure_menu_row_hash_column()
+
+# ---- Индекс активного меню по категориям (гостевой просмотр, счётчики категорий) ----
+def ensure_menu_category_index():
+    try:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_menu_active_cat ON menu_items(is_active, category, title)")
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration menu category index error: %s", e)
+ensure_menu_category_index()
+
+# ---- Полнотекстовый поиск по меню: FTS5 поверх menu_items, синхронизация триггерами ----
+# Без FTS5 в сборке SQLite поиск идёт перебором активных позиций (HAS_FTS5 = False).
+# unicode61 не снимает «диакритику» с кириллицы, поэтому ё→е делаем сами — и при
+# индексации, и в запросе (Database.search_menu).
+def _fts_values(row: str) -> str:
+    return ", ".join(f"replace(replace({row}.{col}, 'ё', 'е'), 'Ё', 'Е')"
+                     for col in ("title", "description", "category"))
+
+MENU_FTS_TRIGGERS = {
+    "menu_fts_ai": f"""
+        CREATE TRIGGER menu_fts_ai AFTER INSERT ON menu_items BEGIN
+            INSERT INTO menu_fts(rowid, title, description, category)
+            VALUES (new.id, {_fts_values("new")});
+        END""",
+    "menu_fts_ad": f"""
+        CREATE TRIGGER menu_fts_ad AFTER DELETE ON menu_items BEGIN
+            INSERT INTO menu_fts(menu_fts, rowid, title, description, category)
+            VALUES ('delete', old.id, {_fts_values("old")});
+        END""",
+    "menu_fts_au": f"""
+        CREATE TRIGGER menu_fts_au AFTER UPDATE OF title, description, category ON menu_items BEGIN
+            INSERT INTO menu_fts(menu_fts, rowid, title, description, category)
+            VALUES ('delete', old.id, {_fts_values("old")});
+            INSERT INTO menu_fts(rowid, title, description, category)
+            VALUES (new.id, {_fts_values("new")});
+        END""",
+}
+
+def ensure_menu_fts() -> bool:
+    try:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='menu_fts'")
+        created = cursor.fetchone() is None
+        if created:
+            # external content: текст хранится только в menu_items, в FTS — лишь индекс;
+            # prefix — отдельные индексы коротких префиксов для поиска по мере набора
+            cursor.execute("""
+                CREATE VIRTUAL TABLE menu_fts USING fts5(
+                    title, description, category,
+                    content='menu_items', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+            """)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND tbl_name='menu_items'")
+        existing = {r[0] for r in cursor.fetchall()}
+        for name, sql in MENU_FTS_TRIGGERS.items():
+            if name not in existing:
+                cursor.execute(sql)
+        if created:
+            cursor.execute(f"INSERT INTO menu_fts(rowid, title, description, category) "
+                           f"SELECT id, {_fts_values('menu_items')} FROM menu_items")
+        conn.commit()
+        return True
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        logger.warning("FTS5 недоступен, поиск по меню — перебором: %s", e)
+        return False
+HAS_FTS5 = ensure_menu_fts()
+
+# ---- Хранилище FSM: состояние и данные незаконченных диалогов (переживают рестарт) ----
+def ensure_fsm_table():
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_state (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)")
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration fsm_state table error: %s", e)
+ensure_fsm_table()
+
+# ---- Ключи идемпотентности: уже выполненные записи (создание брони) ----
+def ensure_idempotency_table():
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                created_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)")
+        conn.commit()
+    except Exception as e:
+        logger.error("Migration idempotency_keys table error: %s", e)
+ensure_idempotency_table()
+
 # ---------------------------------------------------------
 # Хелперы ролей и доступа
 # ---------------------------------------------------------
-def get_role(user_id: int) -> int:
-    # супер-админ через конфиг
-    if user_id in ADMIN_IDS:
-        return ROLE_ADMIN
-    cursor.execute("SELECT role FROM users WHERE user_id=?", (user_id,))
-    r = cursor.fetchone()
-    if not r:
+class RoleCache:
+    """LRU-кэш ролей с TTL (user_id -> роль), чтобы проверки доступа не ходили в БД.
+
+    generation увеличивается при каждой инвалидации: чтение, начатое до записи,
+    не положит в кэш устаревшую роль.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[int]:
+        item = self._data.get(user_id)
+        if item is not None and item[1] > time.monotonic():
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return item[0]
+        if item is not None:
+            del self._data[user_id]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, role: int, generation: int):
+        if generation != self.generation:
+            return
+        self._data[user_id] = (role, time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        # без user_id — сбросить всё (импорт сотрудников)
+        self.generation += 1
+        if user_id is None:
+            self._data.clear()
+        else:
+            self._data.pop(user_id, None)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = (self.hits / total * 100) if total else 0.0
+        return (f"роли: {len(self._data)}/{self.maxsize}, попаданий {self.hits}, "
+                f"промахов {self.misses} ({ratio:.0f}% из кэша)")
+
+role_cache = RoleCache(
+    maxsize=int(os.environ.get("ROLE_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("ROLE_CACHE_TTL", "0" if MULTI_WORKER else "300")),
+)
+
+def _role_from_value(role_value: Any) -> int:
+    if role_value is None:
         return ROLE_GUEST
-    role_value = r["role"]
     if isinstance(role_value, str):
         role_map = {"guest": ROLE_GUEST, "staff": ROLE_STAFF, "admin": ROLE_ADMIN}
         return role_map.get(role_value.lower(), ROLE_GUEST)
     return int(role_value or 0)
 
-def is_admin(user_id: int) -> bool:
-    return get_role(user_id) == ROLE_ADMIN
-
-def is_staff(user_id: int) -> bool:
-    return get_role(user_id) in (ROLE_STAFF, ROLE_ADMIN)
-
-def set_role(user_id: int, role: int):
-    cursor.execute("INSERT OR IGNORE INTO users (user_id, role) VALUES (?,?)", (user_id, role))
-    cursor.execute("UPDATE users SET role=? WHERE user_id=?", (role, user_id))
-    conn.commit()
-
-def set_or_update_user(user_id: int, role: Optional[int]=None, fullname: Optional[str]=None,
-                       phone: Optional[str]=None, username: Optional[str]=None, passport: Optional[str]=None):
-    cursor.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    exists = cursor.fetchone() is not None
-    if not exists:
-        cursor.execute("INSERT INTO users (user_id, role, fullname, phone, username, passport) VALUES (?,?,?,?,?,?)",
-                       (user_id, role if role is not None else ROLE_GUEST,
-                        fullname, phone, username, passport))
-    else:
-        fields = []
-        params = []
-        if role is not None:
-            fields.append("role=?"); params.append(role)
-        if fullname is not None:
-            fields.append("fullname=?"); params.append(fullname)
-        if phone is not None:
-            fields.append("phone=?"); params.append(phone)
-        if username is not None:
-            fields.append("username=?"); params.append(username)
-        if passport is not None:
-            fields.append("passport=?"); params.append(passport)
-        if fields:
-            params.append(user_id)
-            cursor.execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id=?", tuple(params))
-    conn.commit()
+async def get_role(user_id: int) -> int:
+    # супер-админ через конфиг
+    if user_id in ADMIN_IDS:
+        return ROLE_ADMIN
+    role = role_cache.get(user_id)
+    if role is None:
+        generation = role_cache.generation
+        role = _role_from_value(await db.get_role_value(user_id))
+        role_cache.put(user_id, role, generation)
+    return role
+
+async def is_admin(user_id: int) -> bool:
+    return await get_role(user_id) == ROLE_ADMIN
+
+async def is_staff(user_id: int) -> bool:
+    return await get_role(user_id) in (ROLE_STAFF, ROLE_ADMIN)
+
+# Правила доступа к callback-кнопкам: минимальная роль.
+# Точное совпадение важнее префикса, из префиксов побеждает самый длинный.
+ACCESS_EXACT = {
+    "adm_users": ROLE_STAFF,        # сотруднику — вежливый отказ в самом хендлере
+    "main_admin": ROLE_STAFF,       # то же
+    "adm_menu_manage": ROLE_STAFF,
+    "staff_menu": ROLE_STAFF,
+    "menu_inside": ROLE_GUEST,
+}
+ACCESS_PREFIXES = sorted({
+    "adm_": ROLE_ADMIN,
+    "io_": ROLE_ADMIN,
+    "user_": ROLE_ADMIN,
+    "staff_": ROLE_ADMIN,
+    "set_role_": ROLE_ADMIN,
+    "menu_cat_": ROLE_GUEST,
+    "menu_": ROLE_STAFF,
+    "addcat_": ROLE_STAFF,
+    "kitchen_": ROLE_STAFF,
+}.items(), key=lambda kv: -len(kv[0]))
+
+def required_role(callback_data: str) -> int:
+    role = ACCESS_EXACT.get(callback_data)
+    if role is not None:
+        return role
+    for prefix, role in ACCESS_PREFIXES:
+        if callback_data.startswith(prefix):
+            return role
+    return ROLE_GUEST
+
+class AccessMiddleware(BaseMiddleware):
+    """Outer-middleware: роль вызывающего определяется один раз на Update.
+
+    Роль кладётся в data["role"] (хендлеры получают её аргументом role), а
+    callback-кнопки, закрытые правилами доступа, отклоняются до хендлеров.
+    """
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        user = data.get("event_from_user")
+        role = await get_role(user.id) if user else ROLE_GUEST
+        data["role"] = role
+        call = event.callback_query
+        if call is not None and call.data and role < required_role(call.data):
+            # роль могли читать из БД дольше задержки автоответа — тогда отказ
+            # придёт сообщением в чат (см. CallbackAckMiddleware)
+            return await call.answer("⛔ Нет доступа", show_alert=True)
+        return await handler(event, data)
+
+class ChatQueueMiddleware(BaseMiddleware):
+    """Outer-middleware: ограничение очереди одного чата, до FSM и его замка.
+
+    Апдейты чата выполняются по очереди под замком ChatEventIsolation, а пока ждут
+    его, занимают места приёма (UPDATE_QUEUE). Чтобы один чат, засыпающий бота,
+    не занял их все, в очереди чата не больше per_chat апдейтов. Сверх этого нажатия
+    кнопок (дребезг, повторы) отбрасываются с подсказкой, сообщения — с одним
+    ответом «подождите» на всю серию.
+    """
+
+    def __init__(self, per_chat: int = 8):
+        self.per_chat = per_chat
+        # чат -> [апдейтов в очереди, ответ о переполнении отправлен]; живёт, пока очередь не пуста
+        self._chats: Dict[int, list] = {}
+        self.dropped = 0
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat else user.id if user else None
+        if key is None:
+            return await handler(event, data)
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [0, False]
+        if entry[0] >= self.per_chat:
+            self.dropped += 1
+            logger.warning("Очередь чата %s переполнена — апдейт %s отброшен", key, event.update_id)
+            if event.callback_query is not None:
+                await event.callback_query.answer("⏳ Не так быстро — обрабатываю предыдущие нажатия")
+            elif event.message is not None and not entry[1]:
+                entry[1] = True
+                await event.message.answer("⏳ Слишком много сообщений подряд. Отвечу на предыдущие — "
+                                           "последнее, что не успел принять, пришлите ещё раз.")
+            return None
+        entry[0] += 1
+        try:
+            return await handler(event, data)
+        finally:
+            entry[0] -= 1
+            if not entry[0]:
+                del self._chats[key]
+
+class CallbackAckMiddleware(BaseMiddleware):
+    """Outer-middleware: нажатие кнопки подтверждается, не дожидаясь хендлера.
+
+    Если за delay секунд хендлер сам не вызвал call.answer(...), уходит пустой
+    answerCallbackQuery, и спиннер на кнопке гаснет. Подключается после очереди
+    чата и FSM-middleware, так что таймер идёт с начала обработки, а не с момента,
+    когда апдейт встал в очередь. Повторный ответ Telegram не примет, поэтому
+    поздние call.answer(...) перехватывает request() (middleware сессии бота):
+    alert уходит в чат обычным сообщением, текст всплывашки только пишется в лог.
+    """
+
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        # id callback-запроса -> [уже отвечен, чат, задача автоответа]
+        self._pending: Dict[str, list] = {}
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]):
+        call = event.callback_query
+        if call is None:
+            return await handler(event, data)
+        entry = self._pending[call.id] = [False, call.message.chat.id if call.message else None, None]
+
+        def fire():
+            entry[2] = asyncio.get_running_loop().create_task(self._ack(call))
+
+        timer = asyncio.get_running_loop().call_later(self.delay, fire)
+        try:
+            return await handler(event, data)
+        finally:
+            timer.cancel()
+            if not entry[0]:
+                await self._ack(call)
+            if entry[2] is not None:
+                await entry[2]
+            del self._pending[call.id]
+
+    @staticmethod
+    async def _ack(call: CallbackQuery):
+        try:
+            await call.answer()
+        except Exception as e:
+            logger.warning("answerCallbackQuery %s: %s", call.id, e)
+
+    async def request(self, make_request, bot: Bot, method):
+        if isinstance(method, AnswerCallbackQuery):
+            entry = self._pending.get(method.callback_query_id)
+            if entry is not None:
+                if not entry[0]:
+                    entry[0] = True
+                    return await make_request(bot, method)
+                if method.text and method.show_alert and entry[1] is not None:
+                    await bot.send_message(entry[1], method.text)
+                elif method.text:
+                    logger.info("Поздний ответ на кнопку %s не отправлен: %s",
+                                method.callback_query_id, method.text)
+                return True
+        return await make_request(bot, method)
+
+async def set_role(user_id: int, role: int):
+    await db.set_role(user_id, role)
+    role_cache.invalidate(user_id)
+
+async def set_or_update_user(user_id: int, role: Optional[int]=None, fullname: Optional[str]=None,
+                             phone: Optional[str]=None, username: Optional[str]=None, passport: Optional[str]=None):
+    await db.upsert_user(user_id, role=role, fullname=fullname, phone=phone, username=username, passport=passport)
+    role_cache.invalidate(user_id)
 
 # ---------------------------------------------------------
 # FSM — бронирование
@@ -298,8 +1250,32 @@ class ImportFSM(StatesGroup):
 # ---------------------------------------------------------
 # Клавиатуры
 # ---------------------------------------------------------
-def main_menu_inline(user_id: int) -> InlineKeyboardMarkup:
-    role = get_role(user_id)
+# Реестр готовых клавиатур: статические строятся один раз при импорте, ролевые —
+# по одной на роль. Объекты общие для всех апдейтов, поэтому их нельзя менять
+# после создания. JSON для Telegram сериализуется тоже один раз
+# (см. KeyboardCachingSession).
+_KB_REGISTRY: Dict[int, InlineKeyboardMarkup] = {}
+_KB_JSON: Dict[int, str] = {}
+
+def register_kb(markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+    _KB_REGISTRY[id(markup)] = markup
+    return markup
+
+def unregister_kb(markup: Optional[InlineKeyboardMarkup]):
+    # для перестраиваемых клавиатур: старый объект больше не отдаётся
+    if markup is not None and _KB_REGISTRY.get(id(markup)) is markup:
+        del _KB_REGISTRY[id(markup)]
+        _KB_JSON.pop(id(markup), None)
+
+def static_kb(fn):
+    markup = register_kb(fn())
+
+    @functools.wraps(fn)
+    def wrapper() -> InlineKeyboardMarkup:
+        return markup
+    return wrapper
+
+def _build_main_menu(role: int) -> InlineKeyboardMarkup:
     kb = [
         [InlineKeyboardButton(text="📅 Забронировать столик", callback_data="main_book")],
         [InlineKeyboardButton(text="📖 Посмотреть меню", callback_data="main_menu")],
@@ -311,11 +1287,19 @@ def main_menu_inline(user_id: int) -> InlineKeyboardMarkup:
         kb.append([InlineKeyboardButton(text="⚙️ Админ меню", callback_data="main_admin")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+MAIN_MENU_BY_ROLE = {role: register_kb(_build_main_menu(role)) for role in (ROLE_GUEST, ROLE_STAFF, ROLE_ADMIN)}
+
+async def main_menu_inline(user_id: int) -> InlineKeyboardMarkup:
+    # одна клавиатура на роль, а не на пользователя
+    return MAIN_MENU_BY_ROLE.get(await get_role(user_id), MAIN_MENU_BY_ROLE[ROLE_GUEST])
+
+@static_kb
 def back_main_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 В главное меню", callback_data="back_main")]
     ])
 
+@static_kb
 def feedback_root_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🌐 Официальный сайт", url=OFFICIAL_SITE_URL)],
@@ -323,6 +1307,7 @@ def feedback_root_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
     ])
 
+@static_kb
 def feedback_contacts_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👩‍💼 Управляющая", url=f"https://t.me/{MANAGER_USERNAME}")],
@@ -330,6 +1315,7 @@ def feedback_contacts_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="main_feedback")]
     ])
 
+@static_kb
 def admin_menu_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👥 Пользователи", callback_data="adm_users")],
@@ -338,6 +1324,7 @@ def admin_menu_inline() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")],
     ])
 
+@static_kb
 def users_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Создать", callback_data="adm_users_create")],
@@ -346,6 +1333,7 @@ def users_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="main_admin")]
     ])
 
+@static_kb
 def menu_manage_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Добавить позицию", callback_data="menu_add")],
@@ -353,6 +1341,7 @@ def menu_manage_inline() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="staff_menu")]
     ])
 
+@static_kb
 def menu_browse_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🌐 Открыть сайт", url="https://example.com/menu")],
@@ -360,14 +1349,7 @@ def menu_browse_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
     ])
 
-def menu_categories_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🍽 Еда", callback_data="menu_cat_Еда")],
-        [InlineKeyboardButton(text="🥤 Напитки", callback_data="menu_cat_Напитки")],
-        [InlineKeyboardButton(text="🍰 Десерты", callback_data="menu_cat_Десерты")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
-
+@static_kb
 def kitchen_root_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛑 Stop-list", callback_data="kitchen_list_stop")],
@@ -375,6 +1357,7 @@ def kitchen_root_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="staff_menu")]
     ])
 
+@static_kb
 def booking_nav_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -383,7 +1366,8 @@ def booking_nav_kb() -> InlineKeyboardMarkup:
         ]
     ])
 
-def staff_nav_kb(cancel_cb: str = "adm_users") -> InlineKeyboardMarkup:
+@static_kb
+def staff_nav_kb() -> InlineKeyboardMarkup:
     # универсальная навигация для FSM сотрудников
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -392,6 +1376,7 @@ def staff_nav_kb(cancel_cb: str = "adm_users") -> InlineKeyboardMarkup:
         ]
     ])
 
+@static_kb
 def io_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬇️ Экспорт бронирований (CSV)", callback_data="io_export_bookings")],
@@ -406,14 +1391,342 @@ def io_menu_kb() -> InlineKeyboardMarkup:
 # ---------------------------------------------------------
 # Бот, Диспетчер, Router, Планировщик
 # ---------------------------------------------------------
+class KeyboardCachingSession(AiohttpSession):
+    """aiohttp-сессия, которая не сериализует клавиатуры из реестра заново.
+
+    aiogram на каждый запрос делает model_dump всего метода вместе с
+    reply_markup; для зарегистрированной клавиатуры подставляем готовый JSON.
+    """
+
+    def build_form_data(self, bot: Bot, method):
+        markup = getattr(method, "reply_markup", None)
+        if markup is None or _KB_REGISTRY.get(id(markup)) is not markup:
+            return super().build_form_data(bot=bot, method=method)
+        cached = _KB_JSON.get(id(markup))
+        if cached is None:
+            cached = _KB_JSON[id(markup)] = self.prepare_value(markup, bot=bot, files={})
+        form = FormData(quote_fields=False)
+        files: Dict[str, Any] = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", cached)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+def telegram_api() -> TelegramAPIServer:
+    if not TELEGRAM_API_URL:
+        return PRODUCTION
+    return TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)
+
+class ChatEventIsolation(BaseEventIsolation):
+    """Изоляция событий FSM: апдейты одного ключа FSM (чат + пользователь) — по очереди.
+
+    FSMContextMiddleware берёт этот замок до чтения состояния, поэтому два быстрых
+    сообщения на одном шаге анкеты не попадут в один и тот же хендлер. Разные ключи
+    идут параллельно, но хендлеров одновременно не больше limit. Замок ключа живёт,
+    пока его кто-то держит или ждёт.
+    """
+
+    def __init__(self, limit: int = 32):
+        self._slots = asyncio.Semaphore(limit)
+        # ключ FSM -> [замок, апдейтов у замка]
+        self._locks: Dict[StorageKey, list] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def close(self):
+        self._locks.clear()
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_state (тот же DB_FILE) с LRU-кэшем в памяти.
+
+    Каждое изменение пишется сквозь кэш групповым коммитом, так что начатая
+    бронь переживает деплой. Сессия, не менявшаяся дольше ttl секунд, читается
+    как пустая; строки удаляет sweep() из планировщика. В памяти — не больше
+    maxsize последних сессий, сколько бы гостей ни бросило диалог.
+    """
+
+    EMPTY: Tuple[Optional[str], Dict[str, Any], float] = (None, {}, 0.0)
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 86400.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._keys = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        # ключ -> (state, data, updated_at); пустая сессия тоже кэшируется
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, k: str, rec):
+        if self.maxsize <= 0:
+            return
+        self._cache[k] = rec
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _get(self, key: StorageKey):
+        k = self._keys.build(key)
+        rec = self._cache.get(k)
+        if rec is not None:
+            self.hits += 1
+            self._cache.move_to_end(k)
+        else:
+            self.misses += 1
+            row = await db.fsm_load(k)
+            rec = self._cache.get(k)  # пока шёл запрос, сессию могли изменить
+            if rec is None:
+                rec = (row["state"], json.loads(row["data"] or "{}"), row["updated_at"]) if row else self.EMPTY
+                self._remember(k, rec)
+        if rec[2] and rec[2] < time.time() - self.ttl:
+            rec = self.EMPTY
+        return k, rec
+
+    async def _put(self, k: str, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data:
+            if self._cache.get(k) == self.EMPTY:
+                return  # state.clear() в уже пустой сессии — без записи
+            self._remember(k, self.EMPTY)
+            await db.fsm_delete(k)
+            return
+        now = time.time()
+        self._remember(k, (state, data, now))
+        await db.fsm_save(k, state, json.dumps(data, ensure_ascii=False) if data else None, now)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, (_, data, _) = await self._get(key)
+        await self._put(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key))[1][0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        k, (state, _, _) = await self._get(key)
+        await self._put(k, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(key))[1][1].copy()
+
+    async def close(self) -> None:
+        pass
+
+    async def sweep(self) -> int:
+        cutoff = time.time() - self.ttl
+        for k in [k for k, rec in self._cache.items() if rec[2] and rec[2] < cutoff]:
+            del self._cache[k]
+        return await db.fsm_sweep(cutoff)
+
+    def stats(self) -> str:
+        return f"FSM: {len(self._cache)}/{self.maxsize} в памяти, попаданий {self.hits}, промахов {self.misses}"
+
 bot = Bot(
     API_TOKEN,
+    session=KeyboardCachingSession(api=telegram_api()),
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+storage = SQLiteStorage(maxsize=FSM_CACHE_SIZE, ttl=FSM_TTL)
+# FSM-middleware подключается ниже, после очереди чата: сначала отсев лишнего,
+# потом замок ключа FSM, и только под ним чтение состояния
+dp = Dispatcher(storage=storage, events_isolation=ChatEventIsolation(limit=UPDATE_CONCURRENCY), disable_fsm=True)
+callback_acks = CallbackAckMiddleware(delay=CALLBACK_ACK_DELAY)
+bot.session.middleware(callback_acks.request)
+dp.update.outer_middleware(ChatQueueMiddleware(per_chat=CHAT_QUEUE))
+dp.update.outer_middleware(dp.fsm)
+dp.update.outer_middleware(callback_acks)
+dp.update.outer_middleware(AccessMiddleware())
 router = Router()
-scheduler = AsyncIOScheduler()
+scheduler = make_scheduler()
+
+# ---------------------------------------------------------
+# Уведомления staff/admin (фоновая очередь с лимитами Telegram)
+# ---------------------------------------------------------
+class TokenBucket:
+    # классический token bucket: rate токенов в секунду, не больше capacity за раз
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class NotificationDispatcher:
+    """Фоновая рассылка уведомлений staff/admin.
+
+    Хендлеры только кладут сообщения в очередь (enqueue), отправкой занимается
+    ограниченный пул воркеров с учётом лимитов Telegram: общий token bucket
+    и минимальный интервал между сообщениями в один чат. На RetryAfter
+    ждём указанное время, на сетевые ошибки — повтор с экспоненциальной паузой.
+    """
+
+    def __init__(self, workers: int = 4, global_rate: float = 25.0, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, queue_size: int = 10000):
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(global_rate)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._chat_next: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, chat_id: int, text: str, **kwargs) -> bool:
+        try:
+            self._queue.put_nowait((chat_id, text, kwargs))
+            return True
+        except asyncio.QueueFull:
+            logger.error("notification queue is full, dropped message for %s", chat_id)
+            return False
+
+    def enqueue_many(self, chat_ids, text: str, **kwargs) -> int:
+        return sum(1 for cid in chat_ids if self.enqueue(cid, text, **kwargs))
+
+    async def _wait_slot(self, chat_id: int):
+        # глобальная пауза после RetryAfter, интервал на чат, затем общий лимит
+        now = time.monotonic()
+        if self._paused_until > now:
+            await asyncio.sleep(self._paused_until - now)
+        now = time.monotonic()
+        next_at = max(self._chat_next.get(chat_id, 0.0), now)
+        self._chat_next[chat_id] = next_at + self.per_chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        await self._bucket.acquire()
+
+    async def _send(self, chat_id: int, text: str, kwargs: Dict[str, Any]):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_slot(chat_id)
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return
+            except TelegramRetryAfter as e:
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning("RetryAfter %ss while notifying %s", e.retry_after, chat_id)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                await asyncio.sleep(min(2 ** attempt, 30))
+                logger.warning("notify %s failed (attempt %d): %s", chat_id, attempt + 1, e)
+            except Exception as e:
+                # заблокировали бота, чат не найден и т.п. — повтор не поможет
+                logger.error("notify %s error: %s", chat_id, e)
+                return
+        logger.error("notify %s: retries exhausted", chat_id)
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs = await self._queue.get()
+            try:
+                await self._send(chat_id, text, kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("notification worker error: %s", e)
+            finally:
+                self._queue.task_done()
+
+notifier = NotificationDispatcher(
+    workers=int(os.environ.get("NOTIFY_WORKERS", "4")),
+    global_rate=float(os.environ.get("NOTIFY_GLOBAL_RATE", "25")),
+    per_chat_interval=float(os.environ.get("NOTIFY_CHAT_INTERVAL", "1.0")),
+)
+
+# ---------------------------------------------------------
+# Постраничная выдача: альбомы по 10 фото и текстовые страницы
+# ---------------------------------------------------------
+ALBUM_SIZE = 10          # максимум Telegram для send_media_group
+TEXT_LIMIT = 4096        # максимум длины сообщения
+
+def page_slice(items: list, page: int, size: int = ALBUM_SIZE) -> Tuple[list, int, int]:
+    pages = max(1, (len(items) + size - 1) // size)
+    page = min(max(page, 0), pages - 1)
+    return items[page * size:(page + 1) * size], page, pages
+
+def page_nav_kb(make_cb, page: int, has_next: bool, back_cb: str) -> InlineKeyboardMarkup:
+    # make_cb(page) -> callback_data соседней страницы
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="◀️ Назад", callback_data=make_cb(page - 1)))
+    if has_next:
+        row.append(InlineKeyboardButton(text="Ещё ▶️", callback_data=make_cb(page + 1)))
+    kb = [row] if row else []
+    kb.append([InlineKeyboardButton(text="🔙 К разделу", callback_data=back_cb)])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def _text_chunks(texts: List[str], sep: str = "\n") -> List[str]:
+    chunks, cur = [], ""
+    for t in texts:
+        t = t[:TEXT_LIMIT]
+        if cur and len(cur) + len(sep) + len(t) > TEXT_LIMIT:
+            chunks.append(cur)
+            cur = t
+        else:
+            cur = f"{cur}{sep}{t}" if cur else t
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+async def send_album_page(message: Message, items: List[Tuple[str, Optional[str]]],
+                          nav: Optional[InlineKeyboardMarkup] = None, nav_text: str = "…"):
+    """Отправляет страницу (подпись, file_id | None) за 1–2 запроса.
+
+    Позиции с фото уходят одним альбомом, без фото — одним текстом; навигация
+    крепится к тексту (к альбому кнопки прикрепить нельзя).
+    """
+    photos = [(text, photo) for text, photo in items if photo]
+    texts = [text for text, photo in items if not photo]
+    if len(photos) == 1:
+        try:
+            await message.answer_photo(photos[0][1], caption=photos[0][0])
+        except Exception:
+            texts.insert(0, photos[0][0])
+    elif photos:
+        try:
+            await message.answer_media_group([InputMediaPhoto(media=photo, caption=text) for text, photo in photos])
+        except Exception as e:
+            logger.error("send_media_group error: %s", e)
+            texts = [text for text, _ in photos] + texts
+    chunks = _text_chunks(texts)
+    for i, chunk in enumerate(chunks):
+        await message.answer(chunk, reply_markup=nav if i == len(chunks) - 1 else None)
+    if not chunks and nav is not None:
+        await message.answer(nav_text, reply_markup=nav)
 
 # ---------------------------------------------------------
 # /start
@@ -423,35 +1736,32 @@ async def cmd_start(message: Message):
     uid = message.from_user.id
     uname = message.from_user.username
     full_display_name = message.from_user.full_name
-    # создаём/обновляем пользователя
-    cursor.execute("INSERT OR IGNORE INTO users (user_id, role) VALUES (?, ?)", (uid, ROLE_GUEST))
-    # сохраним username и ФИО, если пусто
-    cursor.execute("SELECT fullname, username FROM users WHERE user_id=?", (uid,))
-    r = cursor.fetchone()
-    to_fullname = r["fullname"]
-    to_username = r["username"] if "username" in r.keys() else None
-    if not to_fullname and full_display_name:
-        cursor.execute("UPDATE users SET fullname=? WHERE user_id=?", (full_display_name, uid))
-    if uname and not to_username:
-        cursor.execute("UPDATE users SET username=? WHERE user_id=?", (uname, uid))
-    conn.commit()
+    # создаём/обновляем пользователя; username и ФИО сохраним, если пусто
+    await db.touch_user(uid, fullname=full_display_name, username=uname)
 
     await message.answer(
         f"Добро пожаловать в кофейню <b>VERA</b>! ✨☕️\n"
         f"Мы рады видеть вас! 🌿\n\nВерсия: {VERSION}\n"
         f"☺️ Выберите действие ниже:",
-        reply_markup=main_menu_inline(uid)
+        reply_markup=await main_menu_inline(uid)
     )
 
+@router.message(Command("stats"))
+async def cmd_stats(message: Message, role: int):
+    if role != ROLE_ADMIN:
+        return
+    await message.answer(f"Кэш {role_cache.stats()}\nКэш {menu_cache.stats()}, {category_index.stats()}\n"
+                         f"Кэш {storage.stats()}")
+
 # ---------------------------------------------------------
 # Главное меню
 # ---------------------------------------------------------
 @router.callback_query(F.data == "back_main")
 async def back_main(call: CallbackQuery):
     try:
-        await call.message.edit_text("🏠 Главное меню:", reply_markup=main_menu_inline(call.from_user.id))
+        await call.message.edit_text("🏠 Главное меню:", reply_markup=await main_menu_inline(call.from_user.id))
     except Exception:
-        await call.message.answer("🏠 Главное меню:", reply_markup=main_menu_inline(call.from_user.id))
+        await call.message.answer("🏠 Главное меню:", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 # ------ «Обратная связь» ------
@@ -472,53 +1782,301 @@ async def main_menu_browse(call: CallbackQuery):
     await safe_edit(call.message, "Как вам удобнее посмотреть меню? 🌐 На сайте или прямо здесь:", reply_markup=kb)
     await call.answer()
 
-@router.callback_query(F.data == "main_photos")
+@router.callback_query(F.data.startswith("main_photos"))
 async def main_photos(call: CallbackQuery):
-    cursor.execute("SELECT * FROM photos ORDER BY id DESC LIMIT 10")
-    rows = cursor.fetchall()
+    # main_photos | main_photos_<страница>
+    tail = call.data[len("main_photos_"):]
+    page = int(tail) if tail.isdigit() else 0
+    rows = await db.list_photos(limit=ALBUM_SIZE + 1, offset=page * ALBUM_SIZE)
     if not rows:
         return await call.message.answer("Пока нет фотографий. Загляните позже ☺️", reply_markup=back_main_kb())
-    for r in rows:
-        try:
-            await call.message.answer_photo(r["file_id"], caption=(r["caption"] or ""))
-        except:
-            pass
+    has_next = len(rows) > ALBUM_SIZE
+    nav = None
+    if has_next or page > 0:
+        nav = page_nav_kb(lambda p: f"main_photos_{p}", page, has_next, "back_main")
+    await send_album_page(call.message, [(r["caption"] or "", r["file_id"]) for r in rows[:ALBUM_SIZE]],
+                          nav=nav, nav_text=f"📸 Страница {page + 1}")
     await call.answer()
 
 # ---------------------------------------------------------
 # Меню (пользовательский просмотр)
 # ---------------------------------------------------------
+class MenuCache:
+    """Read-model гостевого меню: готовые подписи и file_id фото по категориям.
+
+    Снимок строится одним запросом на все активные позиции и живёт до
+    инвалидации (добавление, правка, удаление позиции, импорт меню), так что
+    просмотр категории не обращается к БД. enabled=False — снимок не хранится
+    (несколько воркеров: инвалидация в одном процессе не доходит до других).
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._views: Optional[Dict[str, List[Tuple[str, Optional[str]]]]] = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def render(r: sqlite3.Row) -> Tuple[str, Optional[str]]:
+        text = f"<b>{r['title']}</b>\n"
+        if r["description"]:
+            text += r["description"] + "\n"
+        text += f"💳 {r['price']:.2f}\n"
+        photo = r["photo_url"] or ""
+        return text, (photo.split(":", 1)[1] if photo.startswith("file_id:") else None)
+
+    async def category(self, category: str) -> List[Tuple[str, Optional[str]]]:
+        if self._views is not None:
+            self.hits += 1
+            return self._views.get(category, [])
+        self.misses += 1
+        generation = self.generation
+        views: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+        for r in await db.list_active_menu():
+            views.setdefault(r["category"] or "", []).append(self.render(r))
+        if generation == self.generation and self.enabled:
+            self._views = views
+        return views.get(category, [])
+
+    def invalidate(self):
+        self.generation += 1
+        self._views = None
+
+    def stats(self) -> str:
+        cats = len(self._views) if self._views is not None else 0
+        return f"меню: категорий в памяти {cats}, попаданий {self.hits}, промахов {self.misses}"
+
+menu_cache = MenuCache(enabled=not MULTI_WORKER)
+
+class CategoryIndex:
+    """Активные категории меню с числом позиций и готовая клавиатура категорий.
+
+    Загружается одним запросом GROUP BY по idx_menu_active_cat, дальше
+    поддерживается приращениями при добавлении, правке и удалении позиций;
+    после импорта меню просто перечитывается. Нажатие на категорию не ходит в БД.
+    С enabled=False индекс и клавиатура строятся заново на каждый запрос.
+    """
+
+    # известные категории — первыми и со своими значками, остальные по алфавиту
+    ICONS = {"Еда": "🍽", "Напитки": "🥤", "Десерты": "🍰"}
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._counts: Optional[Dict[str, int]] = None
+        self._kb: Optional[InlineKeyboardMarkup] = None
+        self._tokens: Dict[str, str] = {}
+        self.generation = 0
+
+    @staticmethod
+    def token(category: str) -> str:
+        # callback_data ограничена 64 байтами: длинное название (и похожее на
+        # номер страницы или хэш) заменяется коротким хэшем
+        head, sep, _ = category.partition(":")
+        if (len(f"menu_cat_999:{category}".encode("utf-8")) <= 64
+                and not category.startswith("#") and not (sep and head.isdigit())):
+            return category
+        return "#" + hashlib.sha1(category.encode("utf-8")).hexdigest()[:12]
+
+    async def _load(self) -> Dict[str, int]:
+        if self._counts is not None:
+            return self._counts
+        generation = self.generation
+        counts: Dict[str, int] = {}
+        for r in await db.count_active_categories():
+            key = r["category"] or ""
+            counts[key] = counts.get(key, 0) + r["n"]
+        if generation == self.generation and self.enabled:
+            self._counts = counts
+        return counts
+
+    def replace(self, before: Optional[Tuple[str, int]], after: Optional[Tuple[str, int]]):
+        # (категория, is_active) позиции до и после записи; None — позиции нет
+        self.generation += 1
+        if self._counts is None or before == after:
+            return
+        if before and before[1]:
+            left = self._counts.get(before[0], 0) - 1
+            if left > 0:
+                self._counts[before[0]] = left
+            else:
+                self._counts.pop(before[0], None)
+        if after and after[1]:
+            self._counts[after[0]] = self._counts.get(after[0], 0) + 1
+        self._drop_kb()
+
+    def invalidate(self):
+        self.generation += 1
+        self._counts = None
+        self._drop_kb()
+
+    def _drop_kb(self):
+        unregister_kb(self._kb)
+        self._kb = None
+
+    async def resolve(self, token: str) -> str:
+        if not token.startswith("#"):
+            return token
+        if token not in self._tokens:
+            self._tokens = {self.token(c): c for c in await self._load()}
+        return self._tokens.get(token, token)
+
+    async def keyboard(self) -> InlineKeyboardMarkup:
+        if self._kb is not None:
+            return self._kb
+        counts = await self._load()
+        known = list(self.ICONS)
+        order = [c for c in known if c in counts] + sorted(c for c in counts if c not in self.ICONS)
+        rows = [[InlineKeyboardButton(text=f"{self.ICONS.get(c, '•')} {c or 'Другое'} ({counts[c]})",
+                                      callback_data=f"menu_cat_{self.token(c)}")] for c in order]
+        rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")])
+        kb = InlineKeyboardMarkup(inline_keyboard=rows)
+        self._tokens = {self.token(c): c for c in counts}
+        if counts is self._counts:
+            self._kb = register_kb(kb)
+        return kb
+
+    def stats(self) -> str:
+        cats = len(self._counts) if self._counts is not None else 0
+        return f"категории: {cats} в индексе"
+
+category_index = CategoryIndex(enabled=not MULTI_WORKER)
+
+async def menu_categories_kb() -> InlineKeyboardMarkup:
+    return await category_index.keyboard()
+
 @router.callback_query(F.data == "menu_inside")
 async def menu_inside(call: CallbackQuery):
-    await safe_edit(call.message, "📋 Пожалуйста, выберите категорию блюд:", reply_markup=menu_categories_kb())
+    await safe_edit(call.message, "📋 Пожалуйста, выберите категорию блюд:", reply_markup=await menu_categories_kb())
     await call.answer()
 
 @router.callback_query(F.data.startswith("menu_cat_"))
 async def menu_show_category(call: CallbackQuery):
-    cat = call.data.split("_", 2)[-1]
-    cursor.execute(
-        "SELECT * FROM menu_items WHERE is_active=1 AND (category=? OR ?='' AND (category IS NULL OR category='')) ORDER BY title",
-        (cat, cat)
-    )
-    rows = cursor.fetchall()
+    # menu_cat_<категория> | menu_cat_<страница>:<категория>
+    token = call.data.split("_", 2)[-1]
+    page = 0
+    head, sep, rest = token.partition(":")
+    if sep and head.isdigit():
+        page, token = int(head), rest
+    cat = await category_index.resolve(token)
+    items = await menu_cache.category(cat)
+    if not items:
+        return await call.message.answer("Пока пусто в этой категории. Загляните чуть позже 💛", reply_markup=await menu_categories_kb())
+    chunk, page, pages = page_slice(items, page)
+    nav = None
+    if pages > 1:
+        nav = page_nav_kb(lambda p: f"menu_cat_{p}:{token}", page, page + 1 < pages, "menu_inside")
+    await send_album_page(call.message, chunk, nav=nav, nav_text=f"📋 {cat}: страница {page + 1} из {pages}")
+    await call.answer()
+
+# ------ Поиск по меню: /search и inline-режим (@bot борщ) ------
+@router.message(Command("search"))
+async def cmd_search(message: Message):
+    query = (message.text or "").partition(" ")[2].strip()
+    if not query:
+        return await message.answer(
+            "🔎 Напишите, что ищете: <code>/search борщ</code>\n"
+            "Или в любом чате: <code>@" + ((await bot.me()).username or "bot") + " борщ</code>")
+    rows = await db.search_menu(query)
     if not rows:
-        return await call.message.answer("Пока пусто в этой категории. Загляните чуть позже 💛", reply_markup=menu_categories_kb())
+        return await message.answer("Ничего не нашлось 🙈 Попробуйте другое слово или загляните в меню.",
+                                    reply_markup=await menu_categories_kb())
+    await send_album_page(message, [MenuCache.render(r) for r in rows], nav=await menu_categories_kb(),
+                          nav_text=f"🔎 Найдено: {len(rows)}")
+
+@router.inline_query()
+async def inline_search(query: InlineQuery):
+    rows = await db.search_menu(query.query) if query.query.strip() else []
+    results = []
     for r in rows:
-        text = f"<b>{r['title']}</b>\n"
-        if r["description"]:
-            text += r["description"] + "\n"
-        text += f"💳 {r['price']:.2f}\n"
-        if r["photo_url"]:
-            if r["photo_url"].startswith("file_id:"):
-                try:
-                    await call.message.answer_photo(r["photo_url"].split(":", 1)[1], caption=text)
-                except:
-                    await call.message.answer(text)
-            else:
-                await call.message.answer(text)
+        text, photo = MenuCache.render(r)
+        about = f"💳 {r['price']:.2f} · {r['category'] or 'Другое'}"
+        if photo:
+            results.append(InlineQueryResultCachedPhoto(
+                id=str(r["id"]), photo_file_id=photo, title=r["title"], description=about, caption=text))
         else:
-            await call.message.answer(text)
-    await call.answer()
+            results.append(InlineQueryResultArticle(
+                id=str(r["id"]), title=r["title"], description=about,
+                input_message_content=InputTextMessageContent(message_text=text)))
+    # ответ одинаков для всех — Telegram может отдавать его из своего кэша
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+# ---------------------------------------------------------
+# Идемпотентность записей
+# ---------------------------------------------------------
+class BloomFilter:
+    """Множество строк в битовом массиве: «нет» — точно, «да» — с ошибкой до error_rate."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterator[int]:
+        # двойное хэширование: k позиций из одного blake2b
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little")
+        b = int.from_bytes(digest[8:], "little") | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+class IdempotencyGuard:
+    """Отсев повторных записей: двойные нажатия, повторная доставка апдейта.
+
+    Окончательная проверка — ключ в idempotency_keys, который занимается в том же
+    SAVEPOINT группового коммита, что и сама запись (Database.*_once). Bloom-фильтр
+    в памяти отвечает «точно не было» без запроса к БД; в БД за подтверждением идём,
+    только когда он говорит «возможно было». Повтор отбрасывается до записи и до
+    уведомлений. У каждого воркера свой фильтр без чужих ключей — это безопасно:
+    «точно не было» ведёт к записи, а её ключ всё равно проверяет БД.
+    """
+
+    def __init__(self, capacity: int = 100000, ttl: float = 7 * 24 * 3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.bloom = BloomFilter(capacity)
+        self.dropped = 0
+
+    async def load(self):
+        bloom = BloomFilter(self.capacity)
+        for key in await db.list_idempotency_keys():
+            bloom.add(key)
+        self.bloom = bloom
+
+    async def run_once(self, key: str, write, *args):
+        """write(key, *args) -> результат или None/False, если ключ уже занят.
+
+        Возвращает None, если запись с этим ключом уже выполнялась.
+        """
+        if key in self.bloom and await db.has_idempotency_key(key):
+            self.dropped += 1
+            return None
+        result = await write(key, *args)
+        self.bloom.add(key)
+        if not result:
+            self.dropped += 1
+            return None
+        return result
+
+    async def sweep(self) -> int:
+        removed = await db.idempotency_sweep(time.time() - self.ttl)
+        if removed:
+            # из Bloom-фильтра удалять нельзя — перестраиваем по оставшимся ключам
+            await self.load()
+        return removed
+
+idempotency = IdempotencyGuard(capacity=IDEMPOTENCY_CAPACITY, ttl=IDEMPOTENCY_TTL)
+
+def booking_key(message: Message) -> str:
+    # заявка привязана к сообщению, которым её отправили: повторная доставка апдейта
+    # и второе нажатие той же кнопки дают тот же ключ, новая анкета на тот же слот — новый
+    return f"booking:{message.chat.id}:{message.message_id}"
 
 # ---------------------------------------------------------
 # Бронирование (гость) — с «Назад» и «Отмена» на каждом шаге
@@ -558,18 +2116,22 @@ async def booking_source(message: Message, state: FSMContext):
 async def booking_notes(message: Message, state: FSMContext):
     await state.update_data(notes=message.text.strip())
     data = await state.get_data()
-    cursor.execute("""
-        INSERT INTO bookings (user_id, fullname, phone, datetime, source, notes, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (message.from_user.id, data["fullname"], data["phone"], data["datetime"], data["source"], data["notes"], "pending"))
-    conn.commit()
+    starts_at = booking_starts_at(data["datetime"])
+    bid = await idempotency.run_once(booking_key(message), db.add_booking_once,
+                                     message.from_user.id, data["fullname"], data["phone"], data["datetime"],
+                                     data["source"], data["notes"], "pending", starts_at)
+    if bid is None:
+        await state.clear()
+        return await message.answer("Эта заявка уже принята 💐 Мы свяжемся с вами при необходимости.",
+                                    reply_markup=back_main_kb())
+    await schedule_booking_reminder(bid, starts_at)
     await message.answer("Спасибо! Ваша заявка на бронь принята. Мы свяжемся с вами при необходимости 💐", reply_markup=back_main_kb())
     await state.clear()
 
 @router.callback_query(F.data == "book_cancel")
 async def booking_cancel(call: CallbackQuery, state: FSMContext):
     await state.clear()
-    await call.message.answer("❌ Бронирование отменено. Возвращаемся в главное меню.", reply_markup=main_menu_inline(call.from_user.id))
+    await call.message.answer("❌ Бронирование отменено. Возвращаемся в главное меню.", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 @router.callback_query(F.data == "book_back")
@@ -578,7 +2140,7 @@ async def booking_back(call: CallbackQuery, state: FSMContext):
     # Переходим на предыдущий шаг
     if current == BookingFSM.fullname.state:
         await state.clear()
-        await call.message.answer("🏠 Главное меню:", reply_markup=main_menu_inline(call.from_user.id))
+        await call.message.answer("🏠 Главное меню:", reply_markup=await main_menu_inline(call.from_user.id))
     elif current == BookingFSM.phone.state:
         await state.set_state(BookingFSM.fullname)
         await call.message.answer("🌸 Представьтесь, пожалуйста: имя и фамилия — чтобы мы обращались к вам красиво:",
@@ -594,12 +2156,92 @@ async def booking_back(call: CallbackQuery, state: FSMContext):
         await call.message.answer("📌 Поделитесь, как вы о нас узнали (Instagram, друзья и т.п.):", reply_markup=booking_nav_kb())
     else:
         await state.clear()
-        await call.message.answer("🏠 Главное меню:", reply_markup=main_menu_inline(call.from_user.id))
+        await call.message.answer("🏠 Главное меню:", reply_markup=await main_menu_inline(call.from_user.id))
     await call.answer()
 
 # ---------------------------------------------------------
 # Напоминания о бронях (+ подтверждение/отмена)
 # ---------------------------------------------------------
+# На каждую бронь — одна date-задача планировщика ровно за час до начала.
+# Задачи ставятся при создании брони, снимаются при отмене и
+# пересобираются при старте бота (только для будущих броней).
+REMIND_BEFORE = timedelta(minutes=60)
+AUTO_CONFIRM_AFTER = timedelta(minutes=30)
+REMINDER_MISFIRE_GRACE = 10 * 60  # сек.: опоздавшее напоминание ещё имеет смысл отправить
+
+def _reminder_job_id(booking_id: int) -> str:
+    return f"remind_{booking_id}"
+
+def _autoconfirm_job_id(booking_id: int) -> str:
+    return f"autoconf_{booking_id}"
+
+# SQLAlchemyJobStore коммитит каждую правку задач синхронно в тот же DB_FILE: в event
+# loop такой commit ждал бы блокировку записи группового коммита (до busy_timeout).
+# Поэтому правки задач — синхронные _-функции ниже — выполняются через db.run, в
+# потоке БД между групповыми коммитами; планировщик сам переносит пробуждение в loop.
+def _remove_job(job_id: str):
+    try:
+        scheduler.remove_job(job_id)
+    except JobLookupError:
+        pass
+
+def _arm_reminder(booking_id: int, starts_at: Optional[str], current: Optional[Dict[str, datetime]] = None) -> bool:
+    # current — {id задачи: время запуска} из jobstore: такая же задача не перезаписывается
+    if not booking_id or not starts_at:
+        return False
+    run_date = datetime.strptime(starts_at, BOOKING_TS_FMT) - REMIND_BEFORE
+    if run_date <= datetime.now():
+        return False
+    job_id = _reminder_job_id(booking_id)
+    if current is not None and current.get(job_id) == run_date.astimezone():
+        return True
+    scheduler.add_job(
+        remind_booking_by_id, "date",
+        run_date=run_date,
+        args=[booking_id],
+        id=job_id,
+        replace_existing=True,
+        misfire_grace_time=REMINDER_MISFIRE_GRACE
+    )
+    return True
+
+def _cancel_booking_jobs(booking_id: int):
+    _remove_job(_reminder_job_id(booking_id))
+    _remove_job(_autoconfirm_job_id(booking_id))
+
+def _sync_booking_jobs(reminders: List[Tuple[int, str]], cancelled: Iterable[int] = ()) -> int:
+    # пачкой (старт, импорт): одна выборка задач, в jobstore пишутся только недостающие,
+    # сдвинутые и отменённые — повторный старт не переписывает тысячи неизменных задач
+    current = {job.id: job.next_run_time for job in scheduler.get_jobs()}
+    for bid in cancelled:
+        for job_id in (_reminder_job_id(bid), _autoconfirm_job_id(bid)):
+            if job_id in current:
+                _remove_job(job_id)
+    return sum(_arm_reminder(bid, starts_at, current) for bid, starts_at in reminders)
+
+async def schedule_booking_reminder(booking_id: int, starts_at: Optional[str]):
+    await db.run(_arm_reminder, booking_id, starts_at)
+
+async def cancel_booking_jobs(booking_id: int):
+    await db.run(_cancel_booking_jobs, booking_id)
+
+async def rebuild_booking_reminders():
+    # вызывается один раз при старте (планировщик уже запущен): будущие брони,
+    # для которых напоминание ещё впереди
+    try:
+        rows = await db.list_bookings_starting_between((datetime.now() + REMIND_BEFORE).strftime(BOOKING_TS_FMT))
+        reminders = [(r["id"], r["starts_at"]) for r in rows if (r["status"] or "pending") != "cancelled"]
+        count = await db.run(_sync_booking_jobs, reminders)
+        logger.info("Booking reminders scheduled: %d", count)
+    except Exception as e:
+        logger.error("rebuild_booking_reminders error: %s", e)
+
+async def remind_booking_by_id(booking_id: int):
+    r = await db.get_booking(booking_id)
+    if not r or (r["status"] or "pending") == "cancelled":
+        return
+    await remind_single_booking(dict(r))
+
 async def remind_single_booking(booking: dict):
     try:
         user_id = booking.get('user_id')
@@ -617,35 +2259,29 @@ async def remind_single_booking(booking: dict):
         if user_id:
             try:
                 await bot.send_message(user_id, text, reply_markup=kb)
-                cursor.execute("UPDATE bookings SET status=? WHERE id=?", ("pending", bid))
-                conn.commit()
-                scheduler.add_job(
-                    auto_confirm_booking, 'date',
-                    run_date=datetime.now() + timedelta(minutes=30),
+                await db.set_booking_status(bid, "pending")
+                await db.run(functools.partial(
+                    scheduler.add_job, auto_confirm_booking, 'date',
+                    run_date=datetime.now() + AUTO_CONFIRM_AFTER,
                     args=[bid],
-                    id=f"autoconf_{bid}_{int(datetime.now().timestamp())}"
-                )
+                    id=_autoconfirm_job_id(bid),
+                    replace_existing=True
+                ))
             except Exception as e:
                 logger.error("send reminder error: %s", e)
-        cursor.execute("SELECT user_id FROM users WHERE role=?", (ROLE_ADMIN,))
-        for r in cursor.fetchall():
-            try:
-                await bot.send_message(r['user_id'], "Напоминание (для гостя):\n" + text)
-            except:
-                pass
+        admin_ids = await db.list_user_ids_by_role(ROLE_ADMIN)
+        notifier.enqueue_many(admin_ids, "Напоминание (для гостя):\n" + text)
     except Exception:
         traceback.print_exc()
 
 async def auto_confirm_booking(booking_id: int):
     try:
-        cursor.execute("SELECT status FROM bookings WHERE id=?", (booking_id,))
-        r = cursor.fetchone()
+        r = await db.get_booking(booking_id)
         if not r:
             return
         status = r["status"] if "status" in r.keys() else None
         if status in (None, "", "pending"):
-            cursor.execute("UPDATE bookings SET status=? WHERE id=?", ("confirmed", booking_id))
-            conn.commit()
+            await db.set_booking_status(booking_id, "confirmed")
     except Exception as e:
         logger.error("auto_confirm_booking error: %s", e)
 
@@ -655,8 +2291,18 @@ async def booking_confirm_cb(call: CallbackQuery):
         bid = int(call.data.split("_")[-1])
     except:
         return await call.answer("Ошибка", show_alert=True)
-    cursor.execute("UPDATE bookings SET status=? WHERE id=?", ("confirmed", bid))
-    conn.commit()
+    before = await db.set_booking_status_if_changed(bid, "confirmed")
+    # ответы ниже идут после записи в БД и могут опоздать к автоответу: тогда
+    # «не найдена» придёт сообщением, а повторное нажатие останется только в логе
+    if before is None:
+        return await call.answer("Бронь не найдена", show_alert=True)
+    if before == "confirmed":
+        return await call.answer("Бронь уже подтверждена ✅")
+    await db.run(_remove_job, _autoconfirm_job_id(bid))
+    if before == "cancelled":
+        # отмена сняла напоминание — возвращаем его
+        r = await db.get_booking(bid)
+        await schedule_booking_reminder(bid, r["starts_at"] if r else None)
     await call.message.answer("✅ Спасибо! Ваша бронь подтверждена. Ждём вас и готовим лучший столик ✨")
     await call.answer()
 
@@ -666,57 +2312,41 @@ async def booking_cancel_cb(call: CallbackQuery):
         bid = int(call.data.split("_")[-1])
     except:
         return await call.answer("Ошибка", show_alert=True)
-    cursor.execute("UPDATE bookings SET status=? WHERE id=?", ("cancelled", bid))
-    conn.commit()
+    before = await db.set_booking_status_if_changed(bid, "cancelled")
+    # ответы ниже идут после записи в БД и могут опоздать к автоответу: тогда
+    # «не найдена» придёт сообщением, а повторное нажатие останется только в логе
+    if before is None:
+        return await call.answer("Бронь не найдена", show_alert=True)
+    if before == "cancelled":
+        return await call.answer("Бронь уже отменена")
+    await cancel_booking_jobs(bid)
     await call.message.answer("😔 Бронь отменена. Если захотите вернуться — мы всегда рады вам!")
     await call.answer()
 
-async def remind_booking_job():
-    try:
-        now = datetime.now()
-        cursor.execute("SELECT * FROM bookings")
-        for r in cursor.fetchall():
-            try:
-                when = r["datetime"]
-                dt = None
-                for fmt in ("%d.%m %H:%M", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"):
-                    try:
-                        dt = datetime.strptime(when, fmt)
-                        break
-                    except:
-                        pass
-                if not dt:
-                    continue
-                if dt.year == 1900:
-                    dt = dt.replace(year=now.year)
-                delta = dt - now
-                if timedelta(minutes=59) <= delta <= timedelta(minutes=61):
-                    await remind_single_booking(dict(r))
-            except:
-                pass
-    except:
-        traceback.print_exc()
-
 async def morning_digest_job():
     # можно добавить рассылку для админов
     pass
 
+async def fsm_sweep_job():
+    removed = await storage.sweep()
+    if removed:
+        logger.info("FSM: удалено просроченных сессий: %d", removed)
+
+async def idempotency_sweep_job():
+    removed = await idempotency.sweep()
+    if removed:
+        logger.info("Идемпотентность: удалено старых ключей: %d", removed)
+
 # ---------------------------------------------------------
 # Управление меню (Staff/Admin) — добавление/редактирование
 # ---------------------------------------------------------
 @router.callback_query(F.data == "adm_menu_manage")
 async def adm_menu_manage(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await safe_edit(call.message, "🍽 Управление меню:", reply_markup=menu_manage_inline())
     await call.answer()
 
 @router.callback_query(F.data == "menu_add")
 async def menu_add_start(call: CallbackQuery, state: FSMContext):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await state.set_state(MenuAddFSM.title)
     await call.message.answer("Введите название позиции:")
     await call.answer()
@@ -805,12 +2435,10 @@ async def menu_add_confirm_cb(call: CallbackQuery, state: FSMContext):
         return await call.answer()
     data = await state.get_data()
     try:
-        cursor.execute(
-            "INSERT INTO menu_items (title, description, price, category, photo_url, is_active) VALUES (?, ?, ?, ?, ?, ?)",
-            (data.get("title"), data.get("description") or "", data.get("price") or 0.0,
-             data.get("category") or "Еда", data.get("photo") or "", 1)
-        )
-        conn.commit()
+        await db.add_menu_item(data.get("title"), data.get("description") or "", data.get("price") or 0.0,
+                               data.get("category") or "Еда", data.get("photo") or "", 1)
+        menu_cache.invalidate()
+        category_index.replace(None, (data.get("category") or "Еда", 1))
         await call.message.answer(
             "✅ Позиция добавлена.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Назад", callback_data="adm_menu_manage")]])
@@ -820,59 +2448,46 @@ async def menu_add_confirm_cb(call: CallbackQuery, state: FSMContext):
     await state.clear()
     await call.answer()
 
-@router.callback_query(F.data == "menu_list")
+@router.callback_query(F.data.startswith("menu_list"))
 async def menu_list(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT * FROM menu_items ORDER BY id DESC")
-    rows = cursor.fetchall()
+    # одна текстовая страница на 10 позиций; кнопки правки/удаления — по строке на позицию
+    tail = call.data[len("menu_list_"):]
+    rows = await db.list_menu_items()
     if not rows:
         return await call.message.answer("Пока нет позиций меню.", reply_markup=menu_manage_inline())
-    for r in rows:
-        text = f"<b>{r['title']}</b>\n"
-        if r["description"]:
-            text += r["description"] + "\n"
-        text += f"💳 {r['price']:.2f}\nКатегория: {r['category'] or '—'}\nАктивно: {'Да' if r['is_active'] else 'Нет'}"
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"menu_edit_{r['id']}")],
-            [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"menu_delete_{r['id']}")]
-        ])
-        if r["photo_url"] and r["photo_url"].startswith("file_id:"):
-            try:
-                await call.message.answer_photo(r["photo_url"].split(":", 1)[1], caption=text, reply_markup=kb)
-            except:
-                await call.message.answer(text, reply_markup=kb)
-        else:
-            await call.message.answer(text, reply_markup=kb)
+    chunk, page, pages = page_slice(rows, int(tail) if tail.isdigit() else 0)
+    lines = [f"📋 Позиции меню — страница {page + 1} из {pages}:", ""]
+    kb = []
+    for n, r in enumerate(chunk, start=page * ALBUM_SIZE + 1):
+        lines.append(f"{n}. <b>{r['title']}</b> — 💳 {r['price']:.2f}, {r['category'] or '—'}"
+                     f"{'' if r['is_active'] else ' (скрыто)'}")
+        kb.append([InlineKeyboardButton(text=f"✏️ {n}. {r['title'][:24]}", callback_data=f"menu_edit_{r['id']}"),
+                   InlineKeyboardButton(text="🗑", callback_data=f"menu_delete_{r['id']}")])
+    kb.extend(page_nav_kb(lambda p: f"menu_list_{p}", page, page + 1 < pages, "adm_menu_manage").inline_keyboard)
+    await call.message.answer("\n".join(lines)[:TEXT_LIMIT], reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
     await call.answer()
 
 @router.callback_query(F.data.startswith("menu_delete_"))
 async def menu_delete(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     try:
         mid = int(call.data.split("_")[-1])
     except:
         return await call.answer("Неверные данные", show_alert=True)
-    cursor.execute("DELETE FROM menu_items WHERE id=?", (mid,))
-    conn.commit()
+    before = await db.delete_menu_item(mid)
+    menu_cache.invalidate()
+    category_index.replace(before, None)
     await call.message.answer("🗑 Позиция удалена.")
     await call.answer()
 
 @router.callback_query(F.data.startswith("menu_edit_"))
 async def menu_edit_start(call: CallbackQuery, state: FSMContext):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_ADMIN, ROLE_STAFF):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     try:
         mid = int(call.data.split("_")[-1])
     except:
         return await call.answer("Неверные данные", show_alert=True)
-    cursor.execute("SELECT * FROM menu_items WHERE id=?", (mid,))
-    row = cursor.fetchone()
+    row = await db.get_menu_item(mid)
     if not row:
+        # после чтения из БД alert может опоздать — тогда придёт сообщением
         return await call.answer("Позиция не найдена", show_alert=True)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Название", callback_data=f"menu_field_{mid}_title"),
@@ -916,20 +2531,18 @@ async def menu_edit_set_value(message: Message, state: FSMContext):
                 val = float(val.replace(",", "."))
             except:
                 return await message.answer("Цена должна быть числом. Попробуйте снова.")
-        cursor.execute("UPDATE menu_items SET price=? WHERE id=?", (val, mid))
+        change = await db.update_menu_field(mid, "price", val)
     elif field == "active":
         new_val = 0 if str(val).lower() in ("0", "no", "нет", "-") else 1
-        cursor.execute("UPDATE menu_items SET is_active=? WHERE id=?", (new_val, mid))
+        change = await db.update_menu_field(mid, "is_active", new_val)
     elif field == "photo":
-        if val == "-":
-            cursor.execute("UPDATE menu_items SET photo_url='' WHERE id=?", (mid,))
-        else:
-            cursor.execute("UPDATE menu_items SET photo_url=? WHERE id=?", (val, mid))
+        change = await db.update_menu_field(mid, "photo_url", "" if val == "-" else val)
     else:
         if val == "-":
             val = ""
-        cursor.execute(f"UPDATE menu_items SET {field}=? WHERE id=?", (val, mid))
-    conn.commit()
+        change = await db.update_menu_field(mid, field, val)
+    menu_cache.invalidate()
+    category_index.replace(*change)
     await state.clear()
     await message.answer("✅ Изменения сохранены.", reply_markup=menu_manage_inline())
 
@@ -937,14 +2550,14 @@ async def menu_edit_set_value(message: Message, state: FSMContext):
 # Пользователи (админ)
 # ---------------------------------------------------------
 @router.callback_query(F.data == "adm_users")
-async def adm_users(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        # красивое сообщение для сотрудника без доступа
-        if is_staff(call.from_user.id):
+async def adm_users(call: CallbackQuery, role: int):
+    if role != ROLE_ADMIN:
+        # красивое сообщение для сотрудника без доступа (гостей отсекает AccessMiddleware)
+        if role == ROLE_STAFF:
             await call.message.answer(
                 "🌟 У вас пока нет доступа к разделу администратора.\n"
                 "Если считаете, что это ошибка — свяжитесь с управляющим.",
-                reply_markup=main_menu_inline(call.from_user.id)
+                reply_markup=await main_menu_inline(call.from_user.id)
             )
             try:
                 await call.answer()
@@ -952,8 +2565,7 @@ async def adm_users(call: CallbackQuery):
                 pass
             return
         return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT user_id, role, fullname, phone, username, passport FROM users ORDER BY user_id DESC LIMIT 50")
-    rows = cursor.fetchall()
+    rows = await db.list_users(limit=50)
     text = "👥 Пользователи (последние 50):\n\n"
     for r in rows:
         text += f"{r['user_id']} — роль: {r['role']}, {r['fullname'] or ''} {('/@'+r['username']) if r['username'] else ''}\n"
@@ -963,8 +2575,6 @@ async def adm_users(call: CallbackQuery):
 # ---- Создать сотрудника ----
 @router.callback_query(F.data == "adm_users_create")
 async def adm_users_create(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await state.set_state(StaffCreateFSM.fullname)
     await call.message.answer("Введите ФИО сотрудника:", reply_markup=staff_nav_kb())
     await call.answer()
@@ -997,9 +2607,7 @@ async def staff_create_passport(message: Message, state: FSMContext):
     data = await state.get_data()
 
     # попробуем подтянуть username, если пользователь уже запускал бота
-    cursor.execute("SELECT username FROM users WHERE user_id=?", (data["user_id"],))
-    r = cursor.fetchone()
-    username = r["username"] if r and r["username"] else None
+    username = await db.get_username(data["user_id"])
 
     text = (f"Проверьте данные сотрудника:\n\n"
             f"👤 ФИО: {data['fullname']}\n"
@@ -1023,17 +2631,13 @@ async def staff_create_cancel_confirm(call: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "staff_create_confirm_yes")
 async def staff_create_confirm(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     data = await state.get_data()
     uid = data["user_id"]
     # подтягиваем username, если есть в БД (когда сотрудник ранее открывал бота)
-    cursor.execute("SELECT username FROM users WHERE user_id=?", (uid,))
-    r = cursor.fetchone()
-    username = r["username"] if r and r["username"] else None
+    username = await db.get_username(uid)
 
     # создаем/обновляем карточку
-    set_or_update_user(user_id=uid, role=ROLE_STAFF,
+    await set_or_update_user(user_id=uid, role=ROLE_STAFF,
                        fullname=data["fullname"], phone=data["phone"],
                        username=username, passport=data["passport"])
     await state.clear()
@@ -1067,19 +2671,12 @@ async def staff_back(call: CallbackQuery, state: FSMContext):
     await call.answer()
 
 # ---- Изменить карточку ----
-def _staff_list(role_filter: Optional[List[int]] = None):
-    if role_filter:
-        cursor.execute("SELECT user_id, fullname, username FROM users WHERE role IN (%s) ORDER BY fullname COLLATE NOCASE"
-                       % ",".join("?"*len(role_filter)), tuple(role_filter))
-    else:
-        cursor.execute("SELECT user_id, fullname, username FROM users ORDER BY fullname COLLATE NOCASE")
-    return cursor.fetchall()
+async def _staff_list(role_filter: Optional[List[int]] = None):
+    return await db.list_users_by_roles(role_filter)
 
 @router.callback_query(F.data == "adm_users_edit")
 async def adm_users_edit(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    rows = _staff_list(role_filter=[ROLE_STAFF, ROLE_ADMIN])
+    rows = await _staff_list(role_filter=[ROLE_STAFF, ROLE_ADMIN])
     if not rows:
         return await call.message.answer("Нет сотрудников для редактирования.", reply_markup=users_menu_kb())
     kb = []
@@ -1092,12 +2689,10 @@ async def adm_users_edit(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("user_edit_"))
 async def user_edit_open(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     uid = int(call.data.split("_")[-1])
-    cursor.execute("SELECT user_id, role, fullname, phone, username, passport FROM users WHERE user_id=?", (uid,))
-    r = cursor.fetchone()
+    r = await db.get_user(uid)
     if not r:
+        # после чтения из БД alert может опоздать — тогда придёт сообщением
         return await call.answer("Пользователь не найден", show_alert=True)
     text = (f"Карточка сотрудника:\n\n"
             f"👤 ФИО: {r['fullname'] or '—'}\n"
@@ -1141,7 +2736,7 @@ async def set_role_cb(call: CallbackQuery, state: FSMContext):
     if uid is None:
         return await call.answer("Сессия редактирования потеряна", show_alert=True)
     new_role = ROLE_STAFF if call.data == "set_role_staff" else ROLE_ADMIN
-    set_role(uid, new_role)
+    await set_role(uid, new_role)
     await call.message.answer("✅ Роль обновлена.", reply_markup=users_menu_kb())
     await call.answer()
 
@@ -1156,17 +2751,13 @@ async def staff_edit_value(message: Message, state: FSMContext):
     if field not in {"fullname","phone","passport"}:
         await state.clear()
         return await message.answer("Неверное поле.", reply_markup=users_menu_kb())
-    cursor.execute(f"UPDATE users SET {field}=? WHERE user_id=?", (val, uid))
-    conn.commit()
+    await db.update_user_field(uid, field, val)
     await state.clear()
     await message.answer("✅ Изменения сохранены.", reply_markup=users_menu_kb())
 
 @router.callback_query(F.data == "adm_users_delete")
 async def adm_users_delete(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT user_id, fullname, username FROM users WHERE role=?", (ROLE_STAFF,))
-    rows = cursor.fetchall()
+    rows = await db.list_users_by_roles([ROLE_STAFF])
     if not rows:
         return await call.message.answer("Нет сотрудников со статусом «Сотрудник».", reply_markup=users_menu_kb())
     kb = []
@@ -1179,8 +2770,6 @@ async def adm_users_delete(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("user_del_"))
 async def user_del_confirm(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     uid = int(call.data.split("_")[-1])
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"user_del_yes_{uid}")],
@@ -1191,11 +2780,9 @@ async def user_del_confirm(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("user_del_yes_"))
 async def user_del_yes(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     uid = int(call.data.split("_")[-1])
-    cursor.execute("DELETE FROM users WHERE user_id=?", (uid,))
-    conn.commit()
+    await db.delete_user(uid)
+    role_cache.invalidate(uid)
     await call.message.answer("🗑 Сотрудник удалён.", reply_markup=users_menu_kb())
     await call.answer()
 
@@ -1204,8 +2791,6 @@ async def user_del_yes(call: CallbackQuery):
 # ---------------------------------------------------------
 @router.callback_query(F.data == "adm_io")
 async def adm_io(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await safe_edit(call.message, "📦 Импорт/экспорт CSV. Выберите действие:", reply_markup=io_menu_kb())
     await call.answer()
 
@@ -1215,162 +2800,439 @@ async def adm_export_redirect(call: CallbackQuery):
     # старое меню "Экспорт" теперь ведёт в "Импорт/экспорт"
     await adm_io(call)
 
-def _rows_to_csv_buffer(headers: List[str], rows: List[sqlite3.Row]) -> bytes:
-    with io.StringIO() as f:
-        w = csv.writer(f, delimiter=';')
+# Экспорт идёт потоково: строки читаются из курсора пачками по EXPORT_CHUNK на
+# отдельном read-only соединении (в WAL оно не мешает потоку БД), кодируются
+# инкрементально и пишутся в SpooledTemporaryFile — до EXPORT_SPOOL_MAX байт в
+# памяти, дальше во временный файл без общего имени на диске.
+class SpooledInputFile(InputFile):
+    """Загрузка результата экспорта кусками, без чтения файла целиком."""
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot: Bot):
+        loop = asyncio.get_running_loop()
+        self.file.seek(0)
+        while True:
+            chunk = await loop.run_in_executor(None, self.file.read, self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def _export_csv(sql: str, params: tuple, headers: List[str], filename: str, compression: str):
+    # выполняется в потоке пула; возвращает (файл, имя для отправки, число строк)
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    archive = None
+    if compression == "gzip":
+        sink = gzip.GzipFile(filename=filename, mode="wb", fileobj=spool)
+        filename += ".gz"
+    elif compression == "zip":
+        archive = zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED)
+        sink = archive.open(filename, "w", force_zip64=True)
+        filename = os.path.splitext(filename)[0] + ".zip"
+    else:
+        sink = spool
+    conn = db.connect_aux()
+    count = 0
+    try:
+        conn.execute("PRAGMA query_only=ON")
+        cur = conn.execute(sql, params)
+        buf = io.StringIO()
+        w = csv.writer(buf, delimiter=";")
+        encoder = codecs.getincrementalencoder("utf-8")()
         w.writerow(headers)
-        for r in rows:
-            w.writerow([r[h] if h in r.keys() else "" for h in headers])
-        return f.getvalue().encode("utf-8")
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK)
+            w.writerows(rows)
+            sink.write(encoder.encode(buf.getvalue(), final=not rows))
+            buf.seek(0)
+            buf.truncate()
+            if not rows:
+                break
+            count += len(rows)
+        if sink is not spool:
+            sink.close()
+        if archive is not None:
+            archive.close()
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        conn.close()
+    return spool, filename, count
+
+async def send_csv_export(message: Message, sql: str, headers: List[str], filename: str,
+                          caption: str, params: tuple = ()):
+    loop = asyncio.get_running_loop()
+    spool, filename, count = await loop.run_in_executor(
+        None, _export_csv, sql, params, headers, filename, EXPORT_COMPRESSION)
+    try:
+        await message.answer_document(SpooledInputFile(spool, filename), caption=caption)
+    finally:
+        spool.close()
+    logger.info("Export %s: %d rows", filename, count)
 
 @router.callback_query(F.data == "io_export_menu")
 async def io_export_menu(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT id, title, description, price, category, photo_url, is_active FROM menu_items ORDER BY id DESC")
-    rows = cursor.fetchall()
-    content = _rows_to_csv_buffer(["id","title","description","price","category","photo_url","is_active"], rows)
-    file = BufferedInputFile(content, filename="menu_export.csv")
-    await call.message.answer_document(file, caption="Экспорт меню (CSV)")
+    await send_csv_export(call.message,
+                          "SELECT id, title, description, price, category, photo_url, is_active FROM menu_items ORDER BY id DESC",
+                          ["id","title","description","price","category","photo_url","is_active"],
+                          "menu_export.csv", "Экспорт меню (CSV)")
     await call.answer()
 
 @router.callback_query(F.data == "io_export_bookings")
 async def io_export_bookings(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT id, user_id, fullname, phone, datetime, source, notes, status FROM bookings ORDER BY id DESC")
-    rows = cursor.fetchall()
-    content = _rows_to_csv_buffer(["id","user_id","fullname","phone","datetime","source","notes","status"], rows)
-    file = BufferedInputFile(content, filename="bookings_export.csv")
-    await call.message.answer_document(file, caption="Экспорт бронирований (CSV)")
+    await send_csv_export(call.message,
+                          "SELECT id, user_id, fullname, phone, datetime, source, notes, status FROM bookings ORDER BY id DESC",
+                          ["id","user_id","fullname","phone","datetime","source","notes","status"],
+                          "bookings_export.csv", "Экспорт бронирований (CSV)")
     await call.answer()
 
 @router.callback_query(F.data == "io_export_staff")
 async def io_export_staff(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT user_id, role, fullname, phone, username, passport FROM users ORDER BY user_id DESC")
-    rows = cursor.fetchall()
-    content = _rows_to_csv_buffer(["user_id","role","fullname","phone","username","passport"], rows)
-    file = BufferedInputFile(content, filename="staff_export.csv")
-    await call.message.answer_document(file, caption="Экспорт сотрудников (CSV)")
+    await send_csv_export(call.message,
+                          "SELECT user_id, role, fullname, phone, username, passport FROM users ORDER BY user_id DESC",
+                          ["user_id","role","fullname","phone","username","passport"],
+                          "staff_export.csv", "Экспорт сотрудников (CSV)")
     await call.answer()
 
 def _detect_delimiter(sample: str) -> str:
     # очень простой детектор
     return ";" if sample.count(";") >= sample.count(",") else ","
 
-def _parse_csv_bytes(data: bytes) -> List[Dict[str, str]]:
-    # поддержка utf-8 и cp1251
-    for enc in ("utf-8-sig", "utf-8", "cp1251"):
-        try:
-            text = data.decode(enc)
-            break
-        except:
-            text = None
-    if text is None:
-        raise ValueError("Не удалось декодировать CSV")
-    lines = text.splitlines()
-    if not lines:
-        return []
-    delim = _detect_delimiter(lines[0])
-    reader = csv.DictReader(lines, delimiter=delim)
-    return [dict(row) for row in reader]
-
-async def _handle_import_rows(import_type: str, rows: List[Dict[str, str]]) -> str:
-    inserted = 0
-    updated = 0
-    if import_type == "menu":
-        for row in rows:
-            title = (row.get("title") or "").strip()
-            if not title:
-                continue
-            description = (row.get("description") or "").strip()
-            price = row.get("price"); 
-            try:
-                price = float(str(price).replace(",", ".")) if price not in (None, "") else 0.0
-            except:
-                price = 0.0
-            category = (row.get("category") or "").strip()
-            photo_url = (row.get("photo_url") or "").strip()
-            is_active = 1 if str(row.get("is_active","1")).strip() not in ("0","no","false","нет") else 0
-            cursor.execute("""INSERT INTO menu_items (title, description, price, category, photo_url, is_active)
-                              VALUES (?,?,?,?,?,?)""",
-                           (title, description, price, category, photo_url, is_active))
-            inserted += 1
-        conn.commit()
-        return f"Импорт меню: добавлено {inserted} позиций."
-    elif import_type == "bookings":
-        for row in rows:
-            user_id = row.get("user_id")
-            try:
-                user_id = int(user_id) if user_id not in (None, "") else None
-            except:
-                user_id = None
-            fullname = (row.get("fullname") or "").strip()
-            phone = (row.get("phone") or "").strip()
-            dt = (row.get("datetime") or "").strip()
-            source = (row.get("source") or "").strip()
-            notes = (row.get("notes") or "").strip()
-            status = (row.get("status") or "pending").strip()
-            cursor.execute("""INSERT INTO bookings (user_id, fullname, phone, datetime, source, notes, status)
-                              VALUES (?,?,?,?,?,?,?)""",
-                           (user_id, fullname, phone, dt, source, notes, status))
-            inserted += 1
-        conn.commit()
-        return f"Импорт бронирований: добавлено {inserted} записей."
-    elif import_type == "staff":
-        for row in rows:
-            try:
-                user_id = int(row.get("user_id"))
-            except:
-                continue
-            role = row.get("role")
+def _csv_dict_rows(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    # разделитель — по строке заголовка; строки читаются лениво, импорт разбирает их пачками
+    lines = iter(lines)
+    head = next(lines, None)
+    if head is None:
+        return
+    yield from csv.DictReader(itertools.chain([head], lines), delimiter=_detect_delimiter(head))
+
+# ---- Импорт: разбор, проверка и запись пачками
+# Импорт идёт на отдельном соединении в потоке пула: поток БД и event loop
+# остаются свободны. Каждая пачка из IMPORT_BATCH строк — своя короткая
+# транзакция (BEGIN IMMEDIATE … COMMIT): блокировка записи держится только на
+# время executemany, между пачками проходят записи хендлеров. Импорт поэтому
+# не атомарен: при сбое записанные пачки остаются, отчёт называет строку обрыва.
+# Строки с ошибками разбора/БД пропускаются и попадают в отчёт.
+IMPORT_ERRORS_SHOWN = 20
+BOOKING_STATUSES = ("pending", "confirmed", "cancelled")
+
+def _opt_int(value: Optional[str], name: str) -> Optional[int]:
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name}: не число «{value}»")
+
+def _import_menu_row(row: Dict[str, str]) -> tuple:
+    title = (row.get("title") or "").strip()
+    if not title:
+        raise ValueError("пустое название (title)")
+    price = (row.get("price") or "").strip()
+    try:
+        price = float(price.replace(",", ".")) if price else 0.0
+    except ValueError:
+        raise ValueError(f"price: не число «{price}»")
+    is_active = 1 if str(row.get("is_active") or "1").strip().lower() not in ("0", "no", "false", "нет") else 0
+    return (title, (row.get("description") or "").strip(), price,
+            (row.get("category") or "").strip(), (row.get("photo_url") or "").strip(), is_active)
+
+# strptime дорог, а время броней в выгрузках повторяется (слоты) — кэш на время импорта
+_import_starts_at = functools.lru_cache(maxsize=4096)(booking_starts_at)
+
+def _import_booking_row(row: Dict[str, str]) -> tuple:
+    status = (row.get("status") or "pending").strip().lower()
+    if status not in BOOKING_STATUSES:
+        raise ValueError(f"status: неизвестный статус «{status}»")
+    dt = (row.get("datetime") or "").strip()
+    return (_opt_int(row.get("id"), "id"), _opt_int(row.get("user_id"), "user_id"),
+            (row.get("fullname") or "").strip(), (row.get("phone") or "").strip(), dt,
+            (row.get("source") or "").strip(), (row.get("notes") or "").strip(), status, _import_starts_at(dt))
+
+def _import_staff_row(row: Dict[str, str]) -> tuple:
+    user_id = _opt_int(row.get("user_id"), "user_id")
+    if user_id is None:
+        raise ValueError("пустой user_id")
+    role = (row.get("role") or "").strip()
+    if role.lstrip("-").isdigit():
+        role = int(role)
+    else:
+        role = {"guest": ROLE_GUEST, "staff": ROLE_STAFF, "admin": ROLE_ADMIN}.get(role.lower(), ROLE_STAFF)
+    if role not in (ROLE_GUEST, ROLE_STAFF, ROLE_ADMIN):
+        raise ValueError(f"role: недопустимая роль {role}")
+    return (user_id, role, (row.get("fullname") or "").strip(), (row.get("phone") or "").strip(),
+            (row.get("username") or "").replace("@", "").strip() or None, (row.get("passport") or "").strip())
+
+# тип -> (заголовок отчёта, таблица, ключ upsert, колонки, разбор строки)
+IMPORT_SPECS = {
+    # меню сопоставляется по (title, category) с хэшем содержимого — см. _import_menu_batch
+    "menu": ("Импорт меню", "menu_items", None,
+             ("title", "description", "price", "category", "photo_url", "is_active"), _import_menu_row),
+    "bookings": ("Импорт бронирований", "bookings", "id",
+                 ("id", "user_id", "fullname", "phone", "datetime", "source", "notes", "status", "starts_at"),
+                 _import_booking_row),
+    "staff": ("Импорт сотрудников", "users", "user_id",
+              ("user_id", "role", "fullname", "phone", "username", "passport"), _import_staff_row),
+}
+
+def _upsert_sql(table: str, key: str, cols: Tuple[str, ...]) -> str:
+    # NULL в INTEGER PRIMARY KEY — новая строка, существующий ключ — обновление
+    updates = ", ".join(f"{c}=excluded.{c}" for c in cols if c != key)
+    return (f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT({key}) DO UPDATE SET {updates}")
+
+def _import_batch(conn: sqlite3.Connection, sql: str, table: str, key: str,
+                  batch: List[Tuple[int, tuple]], errors: List[Tuple[int, str]]) -> Tuple[int, int]:
+    # одна пачка: executemany в SAVEPOINT; при ошибке БД — построчно, чтобы найти виновные строки
+    keys = [values[0] for _, values in batch if values[0] is not None]
+    existing = set()
+    if keys:
+        existing = {r[0] for r in conn.execute(
+            f"SELECT {key} FROM {table} WHERE {key} IN ({', '.join('?' * len(keys))})", keys)}
+    done = _executemany_rows(conn, sql, batch, errors)
+    updated = sum(1 for _, values in done if values[0] in existing)
+    return len(done) - updated, updated
+
+def _executemany_rows(conn: sqlite3.Connection, sql: str, batch: List[Tuple[int, tuple]],
+                      errors: List[Tuple[int, str]]) -> List[Tuple[int, tuple]]:
+    # executemany в SAVEPOINT; при ошибке БД — построчно, чтобы найти виновные строки
+    conn.execute("SAVEPOINT import_batch")
+    try:
+        conn.executemany(sql, [values for _, values in batch])
+        done = batch
+    except sqlite3.DatabaseError:
+        conn.execute("ROLLBACK TO import_batch")
+        done = []
+        for line, values in batch:
+            conn.execute("SAVEPOINT import_row")
             try:
-                role = int(role)
-            except:
-                if isinstance(role, str):
-                    role = {"guest":0,"staff":1,"admin":2}.get(role.lower(), 1)
+                conn.execute(sql, values)
+                done.append((line, values))
+            except sqlite3.DatabaseError as e:
+                conn.execute("ROLLBACK TO import_row")
+                errors.append((line, str(e)))
+            conn.execute("RELEASE import_row")
+    conn.execute("RELEASE import_batch")
+    return done
+
+MENU_IMPORT_INSERT = ("INSERT INTO menu_items (title, description, price, category, photo_url, is_active, row_hash) "
+                      "VALUES (?,?,?,?,?,?,?)")
+MENU_IMPORT_UPDATE = ("UPDATE menu_items SET title=?, description=?, price=?, category=?, photo_url=?, is_active=?, "
+                      "row_hash=? WHERE id=?")
+
+def _menu_row_hash(values: tuple) -> str:
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+def _load_menu_index(conn: sqlite3.Connection, after_id: int = 0) -> Dict[Tuple[str, str], Tuple[int, Optional[str]]]:
+    # (title, category) -> (id, row_hash); дубли от старых импортов — побеждает последняя запись
+    return {(title, category or ""): (item_id, row_hash) for item_id, title, category, row_hash in conn.execute(
+        "SELECT id, title, category, row_hash FROM menu_items WHERE id > ? ORDER BY id", (after_id,))}
+
+def _import_menu_batch(conn: sqlite3.Connection, index: Dict[Tuple[str, str], Tuple[int, Optional[str]]],
+                       batch: List[Tuple[int, tuple]], errors: List[Tuple[int, str]]) -> Tuple[int, int, int]:
+    # возвращает (добавлено, обновлено, без изменений); строки с прежним хэшем не пишутся вовсе
+    inserts: Dict[Tuple[str, str], Tuple[int, tuple]] = {}
+    updates: List[Tuple[int, tuple]] = []
+    unchanged = 0
+    for line, values in batch:
+        row_hash = _menu_row_hash(values)
+        key = (values[0], values[3])
+        hit = index.get(key)
+        if hit is None or key in inserts:
+            # новая позиция; при повторе внутри файла остаётся последняя версия
+            inserts[key] = (line, values + (row_hash,))
+        elif hit[1] == row_hash:
+            unchanged += 1
+        else:
+            updates.append((line, values + (row_hash, hit[0])))
+            index[key] = (hit[0], row_hash)
+    updated = len(_executemany_rows(conn, MENU_IMPORT_UPDATE, updates, errors))
+    inserted = 0
+    if inserts:
+        max_id = conn.execute("SELECT MAX(id) FROM menu_items").fetchone()[0] or 0
+        inserted = len(_executemany_rows(conn, MENU_IMPORT_INSERT, list(inserts.values()), errors))
+        index.update(_load_menu_index(conn, max_id))
+    return inserted, updated, unchanged
+
+def _import_rows_sync(import_type: str, rows: Iterable[Dict[str, str]]):
+    # выполняется в потоке пула; возвращает
+    # (отчёт, число изменённых строк, [(id брони, starts_at)], [id отменённых броней])
+    title, table, key, cols, parse_row = IMPORT_SPECS[import_type]
+    sql = _upsert_sql(table, key, cols) if key else None
+    _import_starts_at.cache_clear()
+    inserted = updated = unchanged = 0
+    errors: List[Tuple[int, str]] = []
+    touched: List[tuple] = []
+    failed: Optional[Tuple[int, Exception]] = None
+    reminders, cancelled = [], []
+    conn = db.connect_aux()
+    try:
+        max_id = 0
+        if import_type == "bookings":
+            max_id = conn.execute("SELECT MAX(id) FROM bookings").fetchone()[0] or 0
+        menu_index = _load_menu_index(conn) if import_type == "menu" else None
+        rows = iter(rows)
+        line = 1  # первая строка файла — заголовок
+        try:
+            while True:
+                # чтение и разбор — вне транзакции: файл может догружаться по сети
+                batch, start = [], line
+                for row in itertools.islice(rows, IMPORT_BATCH):
+                    line += 1
+                    try:
+                        batch.append((line, parse_row(row)))
+                    except ValueError as e:
+                        errors.append((line, str(e)))
+                if line == start:
+                    break
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    same = 0
+                    if menu_index is not None:
+                        ins, upd, same = _import_menu_batch(conn, menu_index, batch, errors)
+                    else:
+                        ins, upd = _import_batch(conn, sql, table, key, batch, errors)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                inserted += ins
+                updated += upd
+                unchanged += same
+                if import_type == "bookings":
+                    # брони с явным старым id; новые строки (id > max_id) выберем одним запросом в конце
+                    touched += [(v[0], v[8], v[7]) for _, v in batch if v[0] is not None and v[0] <= max_id]
+        except Exception as e:
+            if not inserted + updated + unchanged:
+                raise
+            failed = (start, e)  # start — последняя строка записанных пачек
+        if import_type == "bookings":
+            # сюда попадут и брони, созданные ботом во время импорта, —
+            # планирование идемпотентно (replace_existing)
+            now = datetime.now().strftime(BOOKING_TS_FMT)
+            touched += conn.execute("SELECT id, starts_at, status FROM bookings WHERE id > ? AND starts_at > ?",
+                                    (max_id, now)).fetchall()
+            for bid, starts_at, status in touched:
+                if not starts_at or starts_at <= now:
+                    continue
+                if status == "cancelled":
+                    cancelled.append(bid)
                 else:
-                    role = 1
-            fullname = (row.get("fullname") or "").strip()
-            phone = (row.get("phone") or "").strip()
-            username = (row.get("username") or "").replace("@","").strip() or None
-            passport = (row.get("passport") or "").strip()
-            cursor.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-            if cursor.fetchone():
-                cursor.execute("""UPDATE users SET role=?, fullname=?, phone=?, username=?, passport=? WHERE user_id=?""",
-                               (role, fullname, phone, username, passport, user_id))
-                updated += 1
-            else:
-                cursor.execute("""INSERT INTO users (user_id, role, fullname, phone, username, passport)
-                                  VALUES (?,?,?,?,?,?)""",
-                               (user_id, role, fullname, phone, username, passport))
-                inserted += 1
-        conn.commit()
-        return f"Импорт сотрудников: добавлено {inserted}, обновлено {updated}."
-    else:
+                    reminders.append((bid, starts_at))
+    finally:
+        conn.close()
+    report = f"{title}: добавлено {inserted}, обновлено {updated}"
+    report += f", без изменений {unchanged}." if import_type == "menu" else "."
+    if failed:
+        logger.error("CSV import stopped, committed up to line %s: %s", *failed)
+        report += f"\n⚠️ Импорт прерван: {failed[1]}. Записаны строки по {failed[0]} включительно."
+    if errors:
+        report += f"\nПропущено строк с ошибками: {len(errors)}"
+        report += "".join(f"\n• строка {n}: {msg}" for n, msg in errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            report += "\n…"
+    return report, inserted + updated, reminders, cancelled
+
+async def _handle_import_rows(import_type: str, rows: Iterable[Dict[str, str]]) -> str:
+    if import_type not in IMPORT_SPECS:
         return "Неизвестный тип импорта."
+    loop = asyncio.get_running_loop()
+    result, changed, reminders, cancelled = await loop.run_in_executor(None, _import_rows_sync, import_type, rows)
+    if import_type == "staff":
+        role_cache.invalidate()
+    elif import_type == "menu" and changed:
+        menu_cache.invalidate()
+        category_index.invalidate()
+    # задачи пишутся в jobstore (тот же файл БД) — только после commit импорта, одной пачкой
+    if reminders or cancelled:
+        await db.run(_sync_booking_jobs, reminders, cancelled)
+    return result
+
+class DocumentTextStream:
+    """Текст документа Telegram потоком, без записи на диск и без копии в памяти.
+
+    Скачивание и декодирование идут в event loop, строки читает поток пула
+    (итерация по объекту блокирует — только из run_in_executor). Между ними —
+    ограниченная очередь: пока импорт не разобрал пачку, загрузка ждёт.
+    Кодировка определяется по первому куску: BOM/UTF-8, иначе cp1251.
+    """
+
+    def __init__(self, bot: Bot, document, chunk_size: int = 64 * 1024):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=IMPORT_QUEUE_CHUNKS)
+        self.chunk_size = chunk_size
+        self._task = self.loop.create_task(self._feed(bot, document))
+
+    async def _chunks(self, bot: Bot, document):
+        file = await bot.get_file(document.file_id)
+        if bot.session.api.is_local:
+            with open(bot.session.api.wrap_local_file.to_local(file.file_path), "rb") as f:
+                while True:
+                    chunk = await self.loop.run_in_executor(None, f.read, self.chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+        url = bot.session.api.file_url(bot.token, file.file_path)
+        async for chunk in bot.session.stream_content(url=url, timeout=60, chunk_size=self.chunk_size,
+                                                      raise_for_status=True):
+            yield chunk
+
+    @staticmethod
+    def _decoder_for(head: bytes):
+        if head.startswith(codecs.BOM_UTF8):
+            return codecs.getincrementaldecoder("utf-8-sig")()
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(head)
+            return codecs.getincrementaldecoder("utf-8")()
+        except UnicodeDecodeError:
+            return codecs.getincrementaldecoder("cp1251")()
 
-async def _read_document_bytes(message: Message) -> Optional[bytes]:
-    # Пытаемся скачать файл разными способами (для aiogram 3+)
-    buffer = io.BytesIO()
-    try:
-        await bot.download(message.document, destination=buffer)  # основной путь в aiogram 3.x
-        return buffer.getvalue()
-    except Exception:
+    async def _feed(self, bot: Bot, document):
         try:
-            file = await bot.get_file(message.document.file_id)
-            await bot.download_file(file.file_path, destination=buffer)
-            return buffer.getvalue()
+            decoder = None
+            async for chunk in self._chunks(bot, document):
+                if decoder is None:
+                    decoder = self._decoder_for(chunk)
+                text = decoder.decode(chunk)
+                if text:
+                    await self.queue.put(text)
+            if decoder is not None:
+                await self.queue.put(decoder.decode(b"", final=True))
+            await self.queue.put(None)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error("Download CSV failed: %s", e)
-            return None
+            await self.queue.put(e)
+
+    def _get(self):
+        item = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self) -> Iterator[str]:
+        # строки с сохранённым "\n" — csv сам склеивает поля с переводами строк
+        tail = ""
+        while True:
+            text = self._get()
+            if text is None:
+                break
+            parts = (tail + text).split("\n")
+            tail = parts.pop()
+            for part in parts:
+                yield part + "\n"
+        if tail:
+            yield tail
+
+    def close(self):
+        self._task.cancel()
 
 @router.callback_query(F.data.in_(["io_import_menu","io_import_bookings","io_import_staff"]))
 async def io_import_start(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     import_type = call.data.split("_")[-1]
     await state.update_data(import_type=import_type)
     await state.set_state(ImportFSM.waiting_file)
@@ -1381,23 +3243,23 @@ async def io_import_start(call: CallbackQuery, state: FSMContext):
 
 @router.message(ImportFSM.waiting_file, F.document)
 async def io_import_receive_doc(message: Message, state: FSMContext):
-    data = await _read_document_bytes(message)
-    if not data:
-        return await message.answer("Не удалось скачать файл. Пришлите CSV как текст или другой файл.")
+    stream = DocumentTextStream(bot, message.document)
     try:
-        rows = _parse_csv_bytes(data)
         st = await state.get_data()
         import_type = st.get("import_type")
-        result = await _handle_import_rows(import_type, rows)
+        result = await _handle_import_rows(import_type, _csv_dict_rows(stream))
         await state.clear()
         await message.answer(f"✅ {result}", reply_markup=io_menu_kb())
     except Exception as e:
+        logger.error("CSV import failed: %s", e)
         await message.answer(f"Ошибка импорта: {e}")
+    finally:
+        stream.close()
 
 @router.message(ImportFSM.waiting_file, F.text)
 async def io_import_receive_text(message: Message, state: FSMContext):
     try:
-        rows = _parse_csv_bytes(message.text.encode("utf-8"))
+        rows = _csv_dict_rows(io.StringIO(message.text))
         st = await state.get_data()
         import_type = st.get("import_type")
         result = await _handle_import_rows(import_type, rows)
@@ -1409,8 +3271,6 @@ async def io_import_receive_text(message: Message, state: FSMContext):
 # ------------------------- Управление фото (админ) -------------------------
 @router.callback_query(F.data == "adm_photos")
 async def adm_photos_cb(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Добавить фото", callback_data="adm_photos_add")],
         [InlineKeyboardButton(text="📋 Список фото", callback_data="adm_photos_list")],
@@ -1423,8 +3283,6 @@ async def adm_photos_cb(call: CallbackQuery):
 
 @router.callback_query(F.data == "adm_photos_add")
 async def adm_photos_add_start(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await call.message.answer("Отправьте фото (как фото, не документ). Подпись можно добавить в подписи к фото.")
     await state.set_state(PhotoAddFSM.waiting_photo)
     await call.answer()
@@ -1433,17 +3291,13 @@ async def adm_photos_add_start(call: CallbackQuery, state: FSMContext):
 async def adm_photos_receive(message: Message, state: FSMContext):
     fid = message.photo[-1].file_id
     caption = message.caption or ""
-    cursor.execute("INSERT INTO photos (file_id, caption, added_by) VALUES (?, ?, ?)", (fid, caption, message.from_user.id))
-    conn.commit()
+    await db.add_photo(fid, caption, message.from_user.id)
     await state.clear()
     await message.answer("✅ Фото добавлено.", reply_markup=admin_menu_inline())
 
 @router.callback_query(F.data == "adm_photos_list")
 async def adm_photos_list(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
-    cursor.execute("SELECT * FROM photos ORDER BY id DESC")
-    rows = cursor.fetchall()
+    rows = await db.list_photos()
     if not rows:
         return await call.message.answer("Пока нет фото.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="adm_photos")]
@@ -1464,21 +3318,16 @@ async def adm_photos_list(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("adm_photo_del_"))
 async def adm_photo_del(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     try:
         pid = int(call.data.split("_")[-1])
     except:
         return await call.answer("Ошибка", show_alert=True)
-    cursor.execute("DELETE FROM photos WHERE id=?", (pid,))
-    conn.commit()
+    await db.delete_photo(pid)
     await call.message.answer("🗑 Фото удалено.")
     await adm_photos_list(call)
 
 @router.callback_query(F.data.startswith("adm_photo_edit_"))
 async def adm_photo_edit(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     try:
         pid = int(call.data.split("_")[-1])
     except:
@@ -1495,17 +3344,13 @@ async def adm_photo_edit_receive(message: Message, state: FSMContext):
         await state.clear()
         return await message.answer("Сессия редактирования потеряна.")
     fid = message.photo[-1].file_id
-    cursor.execute("UPDATE photos SET file_id=? WHERE id=?", (fid, pid))
-    conn.commit()
+    await db.update_photo_file(pid, fid)
     await message.answer("✅ Фото заменено.")
     await state.clear()
 
 # ------------------------- Staff-меню -------------------------
 @router.callback_query(F.data == "staff_menu")
 async def staff_menu_cb(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🍽 Меню (управление)", callback_data="adm_menu_manage")],
         [InlineKeyboardButton(text="🍳 Кухня", callback_data="kitchen_main")],
@@ -1535,18 +3380,11 @@ class KitchenAddFSM(StatesGroup):
 
 @router.callback_query(F.data == "kitchen_main")
 async def kitchen_main_cb(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     await safe_edit(call.message, "🍳 Раздел «Кухня» — выберите список:", reply_markup=kitchen_root_kb())
     await call.answer()
 
-def _kitchen_list_markup(list_type: str):
-    if list_type == "stop":
-        cursor.execute("SELECT * FROM stop_list ORDER BY id DESC")
-    else:
-        cursor.execute("SELECT * FROM togo_list ORDER BY id DESC")
-    rows = cursor.fetchall()
+async def _kitchen_list_markup(list_type: str):
+    rows = await db.list_kitchen(list_type)
     buttons = []
     for r in rows:
         buttons.append([InlineKeyboardButton(text=f"❌ {r['title']}", callback_data=f"kitchen_del_{list_type}_{r['id']}")])
@@ -1556,18 +3394,12 @@ def _kitchen_list_markup(list_type: str):
 
 @router.callback_query(F.data.startswith("kitchen_list_"))
 async def kitchen_list_cb(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     list_type = call.data.split("_")[-1]
-    await safe_edit(call.message, f"📃 Список: {'Stop-list' if list_type=='stop' else 'To-go list'}", reply_markup=_kitchen_list_markup(list_type))
+    await safe_edit(call.message, f"📃 Список: {'Stop-list' if list_type=='stop' else 'To-go list'}", reply_markup=await _kitchen_list_markup(list_type))
     await call.answer()
 
 @router.callback_query(F.data.startswith("kitchen_add_"))
 async def kitchen_add_cb(call: CallbackQuery, state: FSMContext):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     list_type = call.data.split("_")[-1]
     await state.update_data(list_type=list_type)
     await state.set_state(KitchenAddFSM.waiting_title)
@@ -1580,41 +3412,30 @@ async def kitchen_add_save(message: Message, state: FSMContext):
     title = message.text.strip()
     if not title:
         return await message.answer("Название не может быть пустым. Попробуйте ещё раз.")
-    if list_type == "stop":
-        cursor.execute("INSERT INTO stop_list (title) VALUES(?)", (title,))
-    else:
-        cursor.execute("INSERT INTO togo_list (title) VALUES(?)", (title,))
-    conn.commit()
-    await message.answer("✅ Добавлено.", reply_markup=_kitchen_list_markup(list_type))
+    await db.add_kitchen_item(list_type, title)
+    await message.answer("✅ Добавлено.", reply_markup=await _kitchen_list_markup(list_type))
     await state.clear()
 
 @router.callback_query(F.data.startswith("kitchen_del_"))
 async def kitchen_del_cb(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    if role not in (ROLE_STAFF, ROLE_ADMIN):
-        return await call.answer("⛔ Нет доступа", show_alert=True)
     _, _, list_type, id_str = call.data.split("_", 3)
     try:
         iid = int(id_str)
     except:
         return await call.answer("Ошибка", show_alert=True)
-    if list_type == "stop":
-        cursor.execute("DELETE FROM stop_list WHERE id=?", (iid,))
-    else:
-        cursor.execute("DELETE FROM togo_list WHERE id=?", (iid,))
-    conn.commit()
-    await safe_edit(call.message, "🗑 Удалено.", reply_markup=_kitchen_list_markup(list_type))
+    await db.delete_kitchen_item(list_type, iid)
+    await safe_edit(call.message, "🗑 Удалено.", reply_markup=await _kitchen_list_markup(list_type))
     await call.answer()
 
 # ------------------------- Админ меню (корневой обработчик) -------------------------
 @router.callback_query(F.data == "main_admin")
-async def main_admin_cb(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        if is_staff(call.from_user.id):
+async def main_admin_cb(call: CallbackQuery, role: int):
+    if role != ROLE_ADMIN:
+        if role == ROLE_STAFF:
             await call.message.answer(
                 "🌟 У вас пока нет доступа к разделу администратора.\n"
                 "Если считаете, что это ошибка — свяжитесь с управляющим.",
-                reply_markup=main_menu_inline(call.from_user.id)
+                reply_markup=await main_menu_inline(call.from_user.id)
             )
             try:
                 await call.answer()
@@ -1656,17 +3477,92 @@ def run_self_checks():
         logger.error("Self-checks error: %s", e)
 
 # ------------------------- Старт / Планировщик -------------------------
+async def poll_jobstore():
+    # задачи, добавленные другими воркерами, планировщик видит только при пробуждении —
+    # будим его чаще, чем срабатывают свои интервальные задачи
+    while True:
+        await asyncio.sleep(SCHEDULER_POLL)
+        scheduler.wakeup()
+
+def _add_periodic_jobs():
+    scheduler.add_job(morning_digest_job, "cron", hour=7, minute=50, id="morning_digest", replace_existing=True)
+    scheduler.add_job(fsm_sweep_job, "interval", seconds=FSM_SWEEP_INTERVAL, id="fsm_sweep", replace_existing=True)
+    scheduler.add_job(idempotency_sweep_job, "interval", hours=1, id="idempotency_sweep", replace_existing=True)
+
 async def on_startup():
-    scheduler.add_job(remind_booking_job, "interval", minutes=1, id="remind_every_min")
-    scheduler.add_job(morning_digest_job, "cron", hour=7, minute=50, id="morning_digest")
+    await idempotency.load()
+    notifier.start()
+    if not RUN_SCHEDULER:
+        # на паузе задачи только пишутся в jobstore, выполняет их воркер с RUN_SCHEDULER=1
+        scheduler.start(paused=True)
+        logger.info("Scheduler paused in this worker (RUN_SCHEDULER=0)")
+        if not HAS_SQLALCHEMY:
+            logger.warning("jobstore в памяти: напоминания по броням этого воркера не сработают")
+        return
     scheduler.start()
+    await rebuild_booking_reminders()
+    await db.run(_add_periodic_jobs)
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook-обработчик: отвечает Telegram сразу, апдейт обрабатывается в фоне.
+
+    Фоновых задач не больше limit: когда все заняты, ответ на очередной POST
+    задерживается, и Telegram сам притормаживает доставку (обратное давление).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, limit: int):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self):
+        # при остановке сервера: дождаться апдейтов в обработке, потом закрыть сессию бота
+        if self._background_feed_update_tasks:
+            await asyncio.wait(set(self._background_feed_update_tasks), timeout=10)
+        await super().close()
+
+async def run_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook: задайте WEBHOOK_URL")
+    app = web.Application()
+    BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET, limit=UPDATE_QUEUE).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_REUSE_PORT or None).start()
+    # только те типы апдейтов, на которые есть хендлеры
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types(),
+                          max_connections=min(100, UPDATE_CONCURRENCY))
+    logger.info("Webhook: %s -> http://%s:%s%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    poll = asyncio.create_task(poll_jobstore()) if MULTI_WORKER and RUN_SCHEDULER else None
+    try:
+        await stop.wait()
+    finally:
+        if poll:
+            poll.cancel()
+        await runner.cleanup()
 
 async def main():
     logger.info("🤖 Бот запускается... %s", VERSION)
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-    except Exception:
-        pass
+    if BOT_MODE != "webhook":
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+        except Exception:
+            pass
 
     run_self_checks()
 
@@ -1674,12 +3570,18 @@ async def main():
 
     await on_startup()
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_QUEUE)
     finally:
         try:
             scheduler.shutdown(wait=False)
         except:
             pass
+        await notifier.stop()
+        await db.flush()
+        db.close()
 
 if __name__ == "__main__":
     try: